@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""批次结果检查点
+
+每个批次完成后立即把结果追加写入检查点文件（JSONL），键为批次内容的哈希。
+进程崩溃或超时后使用 --resume 重新运行，已完成的批次直接读取检查点，只重新发送缺失的批次。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+# 检查点文件路径
+CHECKPOINT_FILE = os.getenv("LLM_CHECKPOINT_FILE", "text_to_json.checkpoint.jsonl")
+
+
+class BatchCheckpoint:
+    def __init__(self, path=CHECKPOINT_FILE, resume=False):
+        """打开检查点文件；resume为False时清空旧的检查点"""
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = {}
+
+        if resume:
+            self._load()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            print("没有找到检查点文件，将处理全部批次")
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 进程被杀时最后一行可能只写了一半
+                    continue
+                self.results[entry["key"]] = entry["result"]
+        print(f"已从检查点加载 {len(self.results)} 个已完成的批次")
+
+    @staticmethod
+    def make_key(batch_text, company_name, version):
+        """根据批次内容计算检查点键"""
+        payload = json.dumps([batch_text, company_name, version], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """返回已完成批次的结果副本，没有则返回None"""
+        with self.lock:
+            result = self.results.get(key)
+        return json.loads(json.dumps(result)) if result is not None else None
+
+    def save(self, key, result):
+        """追加写入一个已完成批次的结果"""
+        entry = json.dumps({"key": key, "result": result, "finished_at": time.time()}, ensure_ascii=False)
+        with self.lock:
+            self.results[key] = json.loads(entry)["result"]
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(entry + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def clear(self):
+        """整个流程完成后删除检查点文件"""
+        with self.lock:
+            self.results = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
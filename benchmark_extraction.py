@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""GPT提取阶段的离线压测
+
+启动本地模拟服务（mock_azure_server.py），用合成的聊天记录运行 TextProcessor.process_lines_in_batches，
+报告每个数据规模下的批次吞吐、批次延迟分位数和token吞吐，用于离线调整并发数和批次大小。
+
+用法:
+    python benchmark_extraction.py --lines 100,1000,10000 --workers 8 --latency-ms 500 --rate-429 0.02
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import time
+
+# 压测不读写生产环境的提取缓存、本地分类器训练样本和隔离文件（需在导入text_to_json之前设置）
+os.environ["EXTRACTION_MEMO"] = ""
+os.environ["LOCAL_CLASSIFIER_EXAMPLES"] = ""
+os.environ["LLM_QUARANTINE_FILE"] = ""
+
+import mock_azure_server
+from model_router import ModelRouter
+from request_hedger import RequestHedger, HEDGE_BUDGET, HEDGE_INITIAL_DELAY, HEDGE_PERCENTILE
+from text_to_json import TextProcessor, COMPACT_RECORD_OVERHEAD_TOKENS
+
+# 合成消息模板，{n} 保证每行唯一（不会被去重合并）
+ISSUE_TEMPLATES = [
+    "订单{n}的电池到货后无法充电，请尽快处理",
+    "客户反馈{n}号车的电池续航明显下降，麻烦安排售后",
+    "物流单号{n}已经三天没有更新，急用",
+    "咨询一下{n}型号的电池保修期是多久",
+]
+SALES_TEMPLATES = [
+    "本周采购6-DZM-20电池{n}组",
+    "经销商本月销量{n}台，目标完成80%",
+]
+
+
+def generate_lines(count, seed=0):
+    """生成count行合成聊天记录（与MySQL导出的单行文本格式一致）"""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        templates = SALES_TEMPLATES if rng.random() < 0.3 else ISSUE_TEMPLATES
+        message = rng.choice(templates).format(n=i + 1)
+        lines.append(f"id:{i + 1} user_id:wxid_{rng.randrange(200):04d} time:2025-01-01 10:{i % 60:02d}:00 "
+                     f"message:{message}")
+    return lines
+
+
+def percentile(values, pct):
+    """最近秩法计算分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def run_once(endpoint, server, line_count, args):
+    """对一个数据规模运行一次完整的分批提取，返回统计结果"""
+    lines = generate_lines(line_count, args.seed or 0)
+    before = server.stats.snapshot()
+
+    log = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with log:
+        processor = TextProcessor(api_key="mock", endpoint=endpoint, deployment="gpt-4o")
+        processor.max_workers = args.workers
+        processor.stream = args.stream
+        processor.compact_prompt = args.compact
+        processor.compact_output = args.compact_output
+        if args.compact_output:
+            processor.record_overhead_tokens = COMPACT_RECORD_OVERHEAD_TOKENS
+        if args.chunk_size:
+            processor.chunk_size = args.chunk_size
+        if args.fast_deployment:
+            processor.router = ModelRouter(args.fast_deployment)
+        if args.hedge:
+            processor.hedger = RequestHedger(args.hedge_percentile, initial_delay=args.hedge_initial_delay,
+                                             budget=args.hedge_budget)
+        processor.session.close()
+        processor.session = processor._create_session()
+
+        started = time.time()
+        result = processor.process_lines_in_batches(lines)
+        elapsed = time.time() - started
+        processor.close()
+
+    after = server.stats.snapshot()
+    metadata = result["metadata"]
+    timings = metadata["batch_timings"]
+    latencies = [timing["seconds"] for timing in timings]
+    tokens = (after["prompt_tokens"] - before["prompt_tokens"]) + \
+             (after["completion_tokens"] - before["completion_tokens"])
+    stats = {
+        "lines": line_count,
+        "batches": len(timings),
+        "batches_failed": metadata["batches_failed"],
+        "elapsed_seconds": round(elapsed, 3),
+        "batches_per_second": round(len(timings) / elapsed, 3) if elapsed else 0.0,
+        "lines_per_second": round(line_count / elapsed, 1) if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "tokens_per_second": round(tokens / elapsed, 1) if elapsed else 0.0,
+        "completion_tokens": after["completion_tokens"] - before["completion_tokens"],
+        "http_requests": after["requests"] - before["requests"],
+        "records": metadata["total_records"],
+        "rate_limit": metadata["rate_limit"],
+        "routes": metadata["routes"],
+        "hedging": metadata["hedging"]
+    }
+    first_records = [timing["first_record_seconds"] for timing in timings if "first_record_seconds" in timing]
+    if first_records:
+        stats["first_record_p50"] = percentile(first_records, 50)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='使用本地模拟服务压测GPT提取阶段')
+    parser.add_argument('--lines', default='100,1000,10000', help='逗号分隔的数据行数，如 100,1000,100000')
+    parser.add_argument('--workers', type=int, default=4, help='并发批次数')
+    parser.add_argument('--chunk-size', type=int, help='每批最大行数（默认使用LLM_CHUNK_SIZE）')
+    parser.add_argument('--stream', action='store_true', help='使用流式响应')
+    parser.add_argument('--compact', action='store_true', help='使用紧凑提示词')
+    parser.add_argument('--compact-output', action='store_true', help='使用紧凑列数组输出格式')
+    parser.add_argument('--hedge', action='store_true', help='启用请求对冲')
+    parser.add_argument('--hedge-percentile', type=float, default=HEDGE_PERCENTILE, help='对冲截止时间的延迟分位数')
+    parser.add_argument('--hedge-initial-delay', type=float, default=HEDGE_INITIAL_DELAY,
+                        help='延迟样本不足时的对冲截止时间（秒）')
+    parser.add_argument('--hedge-budget', type=float, default=HEDGE_BUDGET, help='对冲请求占普通请求数的最大比例')
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    parser.add_argument('--verbose', action='store_true', help='显示TextProcessor的处理日志')
+    mock_azure_server.add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server, endpoint = mock_azure_server.start_server(mock_azure_server.config_from_args(args))
+    print(f"模拟服务: {endpoint}")
+
+    results = []
+    try:
+        for line_count in [int(value) for value in args.lines.split(',') if value.strip()]:
+            stats = run_once(endpoint, server, line_count, args)
+            results.append(stats)
+            print(f"{stats['lines']:>7} 行: {stats['batches']} 批 (失败 {stats['batches_failed']})，"
+                  f"耗时 {stats['elapsed_seconds']:.2f} 秒，{stats['batches_per_second']:.2f} 批/秒，"
+                  f"延迟 p50/p95/p99 = {stats['p50']:.2f}/{stats['p95']:.2f}/{stats['p99']:.2f} 秒，"
+                  f"{stats['tokens_per_second']:.0f} token/秒")
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""GPT响应的紧凑列数组格式
+
+每种记录只输出一次列名，之后每条记录是按列顺序排列的值数组，枚举值用小整数编号：
+    {"issues": [["source_line", "date", "issue_type", ...], [1, "2025/01/01", 2, ...], ...],
+     "sales":  [["source_line", "date", "region", ...], [3, "2025/01/01", 0, ...], ...]}
+省去了每条记录重复的键名和带引号的枚举值，本地再还原为原有的 issues/sales 字典格式。
+"""
+
+# 提示词中用于标识紧凑输出格式的名称（模拟服务据此返回对应格式）
+FORMAT_NAME = "紧凑列数组"
+
+# 每种记录的列顺序
+COLUMNS = {
+    "issues": ["source_line", "date", "issue_type", "description", "urgency", "completion", "status",
+               "negative_feedback"],
+    "sales": ["source_line", "date", "region", "product_model", "quantity", "amount", "completion_rate"],
+}
+
+# 枚举列: 编号 -> 取值
+ENUMS = {
+    "issue_type": ["订单", "物流", "产品", "技术支持", "售后", "其他"],
+    "urgency": ["高", "中", "低"],
+    "status": ["处理中", "未处理", "已处理"],
+    "negative_feedback": ["否", "是"],
+    "region": ["华东", "华南", "华北", "华西", "华中"],
+}
+
+
+def instructions():
+    """紧凑输出格式的说明，附加在提取说明之后"""
+    enum_lines = "\n".join(
+        f"   - {column}: " + "，".join(f"{code}={value}" for code, value in enumerate(values))
+        for column, values in ENUMS.items()
+    )
+    example_issue = [1, "2025/01/01", 2, "电池无法充电", 1, 0, 1, 1]
+    example_sale = [3, "2025/01/01", 0, "6-DZM-20", 10, 0, 0]
+    return f"""
+输出格式（{FORMAT_NAME}）：为减少输出长度，issues和sales不使用键值对象，而是二维数组：
+1. 每个数组的第一行是列名，必须原样输出：
+   - issues: {COLUMNS["issues"]}
+   - sales: {COLUMNS["sales"]}
+2. 之后每条记录一行，按列名顺序给出值，source_line为该记录来源行的行号
+3. 枚举列输出编号（整数），不要输出文字：
+{enum_lines}
+示例: {{"issues": [{COLUMNS["issues"]}, {example_issue}], "sales": [{COLUMNS["sales"]}, {example_sale}]}}
+""".replace("'", '"')
+
+
+def expand_rows(items):
+    """把 [列名行, 值行, ...] 还原为字典列表；已经是字典的记录原样保留"""
+    if not isinstance(items, list) or not items:
+        return items
+    header = None
+    records = []
+    for item in items:
+        if isinstance(item, list):
+            if header is None and all(isinstance(name, str) for name in item):
+                header = item
+            elif header is not None:
+                records.append(dict(zip(header, item)))
+        elif isinstance(item, dict):
+            records.append(item)
+    return records
+
+
+def decode_record(record):
+    """把枚举编号还原为文字，无法识别的编号保持原值"""
+    for column, values in ENUMS.items():
+        code = record.get(column)
+        if isinstance(code, int) and not isinstance(code, bool) and 0 <= code < len(values):
+            record[column] = values[code]
+    return record
+
+
+def decode_result(result):
+    """把紧凑格式的响应还原为 {"issues": [{...}], "sales": [{...}]}"""
+    if not isinstance(result, dict):
+        return result
+    for kind in COLUMNS:
+        if kind in result:
+            result[kind] = [decode_record(record) for record in expand_rows(result[kind]) if isinstance(record, dict)]
+    return result
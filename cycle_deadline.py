@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""整个处理周期共用的截止时间
+
+process_data.sh 在每个周期开始时导出 CYCLE_DEADLINE（Unix时间戳，秒），各阶段脚本继承该环境变量:
+- 每个HTTP请求、子进程和重试等待的超时都取 默认值 与 剩余时间 中较小的一个
+- 超过截止时间后不再开始新的工作，已完成的部分保存到检查点，以 DEADLINE_EXIT_CODE 退出，
+  由下一个周期继续，而不是阻塞下一个周期
+没有设置 CYCLE_DEADLINE 时（手动运行脚本）不限制时间，各超时使用默认值。
+"""
+
+import os
+import time
+
+# 超过截止时间退出的状态码（EX_TEMPFAIL），process_data.sh 据此区分超时和失败
+DEADLINE_EXIT_CODE = 75
+
+# 剩余时间不足时，请求超时的下限（秒），避免超时为0导致请求立即失败
+MIN_TIMEOUT = 1.0
+
+_deadline = None
+
+
+class DeadlineExceeded(Exception):
+    """已超过本周期的截止时间"""
+
+
+def deadline():
+    """本周期的截止时间（Unix时间戳），未设置时返回None"""
+    if _deadline is not None:
+        return _deadline
+    value = os.getenv("CYCLE_DEADLINE", "")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def set_deadline(seconds_from_now):
+    """在当前进程中设置截止时间（命令行参数或测试使用），None为取消"""
+    global _deadline
+    _deadline = time.time() + seconds_from_now if seconds_from_now is not None else None
+
+
+def remaining(reserve=0.0):
+    """距离截止时间的秒数（减去为后续阶段保留的reserve秒），未设置截止时间时返回None"""
+    value = deadline()
+    if value is None:
+        return None
+    return value - reserve - time.time()
+
+
+def expired(reserve=0.0):
+    """是否已超过截止时间（提前reserve秒）"""
+    left = remaining(reserve)
+    return left is not None and left <= 0
+
+
+def check(stage="", reserve=0.0):
+    """已超过截止时间时抛出 DeadlineExceeded"""
+    if expired(reserve):
+        raise DeadlineExceeded(f"{stage}已超过本周期的截止时间" if stage else "已超过本周期的截止时间")
+
+
+def timeout(default, reserve=0.0):
+    """从剩余时间推导的超时: min(默认值, 剩余时间)，不低于MIN_TIMEOUT；default为None表示默认不限时"""
+    left = remaining(reserve)
+    if left is None:
+        return default
+    left = max(left, MIN_TIMEOUT)
+    return left if default is None else min(default, left)
+
+
+def request_timeout(connect=10.0, read=60.0, reserve=0.0):
+    """requests 的 (连接超时, 读取超时)"""
+    return (timeout(connect, reserve), timeout(read, reserve))
+
+
+def sleep(seconds, reserve=0.0):
+    """等待seconds秒，但不超过截止时间；返回是否完整等待（False表示已到截止时间）"""
+    left = remaining(reserve)
+    if left is not None and left < seconds:
+        time.sleep(max(left, 0.0))
+        return False
+    time.sleep(seconds)
+    return True
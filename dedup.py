@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""发送给GPT前的消息去重：精确哈希 + SimHash近似重复聚类
+
+每个簇只把代表行发送给API，提取结果再分配回簇内的其他行。
+记录中的日期来自消息时间，只有时间字段中的日期相同的行才会合并，复制给成员的记录日期与成员一致。
+"""
+
+import hashlib
+import os
+import re
+
+import spool
+
+# 去重模式: fanout 把代表行的记录复制给每个成员; count 只输出一次并记录重复次数; off 不去重
+DEDUP_MODE = os.getenv("LLM_DEDUP_MODE", "fanout")
+
+# SimHash汉明距离阈值，64位指纹下不超过3视为近似重复
+MAX_DISTANCE = int(os.getenv("LLM_DEDUP_MAX_DISTANCE", "3"))
+
+# 短于该长度的消息只做精确去重（短文本的SimHash不稳定）
+MIN_NEAR_DUP_LENGTH = 10
+
+# 分带数：64位指纹切成4段16位，汉明距离不超过3的两个指纹至少有一段完全相同
+BANDS = 4
+BAND_BITS = 64 // BANDS
+
+_DIGITS = re.compile(r"\d+")
+_DATE = re.compile(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})")
+_PUNCTUATION = re.compile(r"[\s\.,!?;:~，。！？；：、…“”‘’\"'()（）【】\[\]<>《》-]+")
+
+# 把一个字节的8个位展开到8个16位计数槽，用一次大整数加法同时累加64个位的计数
+_LANE_BITS = 16
+_SPREAD = [sum(1 << (_LANE_BITS * bit) for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+_MAX_LANE_COUNT = (1 << _LANE_BITS) - 1
+
+
+def normalize_message(line):
+    """提取并规范化消息文本：去掉标点和空白，英文转小写"""
+    message = spool.parse_line(line).get("message", "")
+    return _PUNCTUATION.sub("", str(message)).lower()
+
+
+def line_date(line):
+    """消息时间中的日期 (年, 月, 日)，时间中没有日期部分（如只有 10:23:45）时返回None"""
+    match = _DATE.search(str(spool.parse_line(line).get("time", "")))
+    return tuple(int(part) for part in match.groups()) if match else None
+
+
+def _spread(value):
+    """把64位整数的每一位放到独立的16位计数槽中"""
+    spread = 0
+    for k in range(8):
+        spread |= _SPREAD[(value >> (8 * k)) & 0xFF] << (_LANE_BITS * 8 * k)
+    return spread
+
+
+def simhash(text):
+    """计算文本的64位SimHash（基于字符3-gram）"""
+    shingles = [text[i:i + 3] for i in range(max(len(text) - 2, 1))]
+    counts = [0] * 64
+    for start in range(0, len(shingles), _MAX_LANE_COUNT):
+        packed = 0
+        chunk = shingles[start:start + _MAX_LANE_COUNT]
+        for shingle in chunk:
+            digest = hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest()
+            packed += _spread(int.from_bytes(digest, 'little'))
+        for bit in range(64):
+            counts[bit] += (packed >> (_LANE_BITS * bit)) & _MAX_LANE_COUNT
+
+    total = len(shingles)
+    fingerprint = 0
+    for bit in range(64):
+        if counts[bit] * 2 > total:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def cluster_lines(items, max_distance=MAX_DISTANCE):
+    """对 [(行号, 文本行), ...] 聚类
+
+    返回 {代表行号: [成员行号, ...]}，代表行为簇中第一次出现的行，成员列表不含代表行本身；
+    不同日期的行不会合并
+    """
+    clusters = {}
+    exact = {}
+    bands = [{} for _ in range(BANDS)]
+    fingerprints = {}
+    numbers = {}
+    dates = {}
+
+    for idx, line in items:
+        text = normalize_message(line)
+        if not text:
+            clusters[idx] = []
+            continue
+
+        # 精确重复（同一日期内）
+        day = line_date(line)
+        digest = hashlib.sha1(f"{day}|{text}".encode('utf-8')).digest()
+        if digest in exact:
+            clusters[exact[digest]].append(idx)
+            continue
+
+        # 近似重复：先按分带找候选，再比较完整的汉明距离；
+        # 数字（数量、金额、型号）或日期不同的消息不合并，避免丢失销售数据或复制错误的日期
+        representative = None
+        fingerprint = None
+        if len(text) >= MIN_NEAR_DUP_LENGTH and max_distance > 0:
+            fingerprint = simhash(text)
+            digits = _DIGITS.findall(text)
+            keys = [(fingerprint >> (BAND_BITS * b)) & ((1 << BAND_BITS) - 1) for b in range(BANDS)]
+            for b, key in enumerate(keys):
+                for candidate in bands[b].get(key, []):
+                    if numbers[candidate] == digits and dates[candidate] == day and \
+                            hamming_distance(fingerprint, fingerprints[candidate]) <= max_distance:
+                        representative = candidate
+                        break
+                if representative is not None:
+                    break
+
+        if representative is not None:
+            clusters[representative].append(idx)
+            exact[digest] = representative
+            continue
+
+        clusters[idx] = []
+        exact[digest] = idx
+        if fingerprint is not None:
+            fingerprints[idx] = fingerprint
+            numbers[idx] = digits
+            dates[idx] = day
+            for b, key in enumerate(keys):
+                bands[b].setdefault(key, []).append(idx)
+
+    return clusters
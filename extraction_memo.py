@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""按消息缓存GPT提取结果（SQLite）
+
+键为 规范化消息文本 + 公司名 + 提示词/模型版本 的哈希，值为该消息提取出的 issues/sales 记录。
+命中的消息不再发送给API，未产生任何记录的消息同样会被缓存。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import spool
+
+# 缓存文件路径，设置为空字符串可禁用缓存
+MEMO_FILE = os.getenv("EXTRACTION_MEMO", "extraction_memo.db")
+
+# 淘汰策略：最大条目数和最长保存天数
+MEMO_MAX_ENTRIES = int(os.getenv("EXTRACTION_MEMO_MAX_ENTRIES", "200000"))
+MEMO_MAX_AGE_DAYS = float(os.getenv("EXTRACTION_MEMO_MAX_AGE_DAYS", "30"))
+
+
+def normalize_line(line):
+    """规范化一行消息：去掉id和用户，只保留时间和消息内容，并合并空白"""
+    record = spool.parse_line(line)
+    message = " ".join(str(record.get("message", "")).split())
+    time_value = record.get("time", "")
+    return f"{time_value}|{message}" if time_value else message
+
+
+class ExtractionMemo:
+    def __init__(self, path=MEMO_FILE, max_entries=MEMO_MAX_ENTRIES, max_age_days=MEMO_MAX_AGE_DAYS):
+        """打开（必要时创建）缓存数据库"""
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS memo (
+            key TEXT PRIMARY KEY,
+            issues TEXT,
+            sales TEXT,
+            created_at REAL,
+            last_used_at REAL
+        )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_memo_last_used ON memo (last_used_at)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(line, company_name, version):
+        """计算一行消息的缓存键"""
+        payload = json.dumps([normalize_line(line), company_name, version], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """批量查询，返回 {key: {"issues": [...], "sales": [...]}}"""
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, issues, sales FROM memo WHERE key IN ({placeholders}) AND created_at >= ?",
+                    chunk + [now - self.max_age]
+                ).fetchall()
+                for key, issues, sales in rows:
+                    found[key] = {"issues": json.loads(issues), "sales": json.loads(sales)}
+            if found:
+                self.conn.executemany(
+                    "UPDATE memo SET last_used_at = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self.conn.commit()
+        return found
+
+    def put_many(self, entries):
+        """批量写入 {key: {"issues": [...], "sales": [...]}}"""
+        now = time.time()
+        values = [
+            (key, json.dumps(records.get("issues", []), ensure_ascii=False),
+             json.dumps(records.get("sales", []), ensure_ascii=False), now, now)
+            for key, records in entries.items()
+        ]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO memo (key, issues, sales, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                values
+            )
+            self.conn.commit()
+
+    def evict(self):
+        """淘汰过期条目，并在超过最大条目数时删除最久未使用的条目，返回删除数量"""
+        with self.lock:
+            cursor = self.conn.execute("DELETE FROM memo WHERE created_at < ?", (time.time() - self.max_age,))
+            removed = cursor.rowcount
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM memo").fetchone()
+            if count > self.max_entries:
+                cursor = self.conn.execute(
+                    "DELETE FROM memo WHERE key IN (SELECT key FROM memo ORDER BY last_used_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                removed += cursor.rowcount
+            self.conn.commit()
+        return removed
+
+    def close(self):
+        self.conn.close()
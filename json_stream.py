@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""流式响应的增量JSON解析
+
+GPT流式返回的是 {"issues": [{...}, {...}], "sales": [{...}]} 的文本片段，
+RecordStreamParser 逐段接收这些片段，每当 issues/sales 数组中的一个对象闭合就立即解析并返回，
+不需要等待整个响应生成完毕。
+
+同一个解析器也用于从截断或格式错误的响应中恢复已经完整生成的记录（salvage）。
+紧凑列数组格式（compact_schema）中数组的第一行为列名，之后的值行按列名还原为字典后返回。
+"""
+
+import json
+
+# 需要逐条输出记录的顶层数组
+RECORD_KINDS = ("issues", "sales")
+
+
+class RecordStreamParser:
+    def __init__(self, kinds=RECORD_KINDS, keep_invalid=False):
+        """keep_invalid为True时，无法解析的对象以 (类型, None) 返回，而不是直接跳过"""
+        self.kinds = set(kinds)
+        self.keep_invalid = keep_invalid
+        # 已经开始和已经闭合的记录数组
+        self.started = set()
+        self.closed = set()
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        # 顶层对象中最近一个字符串（用于识别数组所属的键）及正在收集的字符串
+        self.last_string = None
+        self.string_chars = None
+        # 当前所在的顶层数组，以及正在收集的记录文本；紧凑格式下每个数组的列名
+        self.current_kind = None
+        self.headers = {}
+        self.record_chars = None
+        self.text = []
+        self.count = 0
+
+    def feed(self, chunk):
+        """接收一段文本，返回其中闭合的记录 [(类型, 记录), ...]"""
+        self.text.append(chunk)
+        records = []
+        for ch in chunk:
+            if self.record_chars is not None:
+                self.record_chars.append(ch)
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.string_chars is not None:
+                        self.last_string = json.loads('"' + "".join(self.string_chars) + '"')
+                        self.string_chars = None
+                    continue
+                if self.string_chars is not None:
+                    self.string_chars.append(ch)
+                continue
+
+            if ch == '"':
+                self.in_string = True
+                # 只需要记录顶层对象中的字符串（键名）
+                if self.depth == 1:
+                    self.string_chars = []
+            elif ch in '{[':
+                if self.depth == 1 and ch == '[':
+                    self.current_kind = self.last_string if self.last_string in self.kinds else None
+                    if self.current_kind:
+                        self.started.add(self.current_kind)
+                elif self.depth == 2 and self.current_kind:
+                    self.record_chars = [ch]
+                self.depth += 1
+            elif ch in '}]':
+                self.depth -= 1
+                if self.depth == 2 and self.record_chars is not None:
+                    try:
+                        record = json.loads("".join(self.record_chars))
+                    except ValueError:
+                        record = None
+                    self.record_chars = None
+                    if isinstance(record, list):
+                        # 紧凑格式: 第一行是列名，之后的值行按列名还原
+                        header = self.headers.get(self.current_kind)
+                        if header is None and all(isinstance(name, str) for name in record):
+                            self.headers[self.current_kind] = record
+                            continue
+                        record = dict(zip(header, record)) if header is not None else None
+                    if isinstance(record, dict):
+                        records.append((self.current_kind, record))
+                        self.count += 1
+                    elif self.keep_invalid:
+                        records.append((self.current_kind, None))
+                elif self.depth == 1:
+                    if self.current_kind and ch == ']':
+                        self.closed.add(self.current_kind)
+                    self.current_kind = None
+        return records
+
+    def getvalue(self):
+        """返回目前收到的完整文本"""
+        return "".join(self.text)
+
+
+def salvage(text, kinds=RECORD_KINDS):
+    """从截断或格式错误的JSON文本中恢复完整生成的记录
+
+    未闭合的数组和对象视为已关闭，最后一个不完整的对象被丢弃。
+    返回 (记录, 未完成的类型)，记录为 {"issues": [...], "sales": [...]}；
+    未完成的类型为 {类型: n}，表示该类型只有source_line小于n的行结果完整（0表示该类型没有完整结果），
+    完整的类型不出现在其中。响应中没有任何记录数组时返回 None
+    """
+    parser = RecordStreamParser(kinds, keep_invalid=True)
+    events = parser.feed(text)
+    if not parser.started:
+        return None
+
+    records = {kind: [] for kind in kinds}
+    incomplete = {}
+    for kind in kinds:
+        items = [record for event_kind, record in events if event_kind == kind]
+        if kind in parser.closed and all(isinstance(record, dict) for record in items):
+            records[kind] = items
+            continue
+
+        # 数组没有闭合或其中有损坏的对象: 只保留按行号顺序排列、在第一个问题之前的记录
+        last_line = 0
+        for record in items:
+            if not isinstance(record, dict):
+                break
+            try:
+                line = int(record.get("source_line"))
+            except (TypeError, ValueError):
+                break
+            if line < last_line:
+                break
+            records[kind].append(record)
+            last_line = line
+        incomplete[kind] = last_line
+    return records, incomplete
+
+
+def iter_sse_data(response):
+    """逐条读取Server-Sent Events中的data字段，遇到 [DONE] 结束"""
+    for raw in response.iter_lines():
+        raw = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+        if not raw or not raw.startswith("data:"):
+            continue
+        data = raw[5:].strip()
+        if data == "[DONE]":
+            return
+        yield data
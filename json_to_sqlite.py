@@ -1,12 +1,35 @@
 import json
 import sqlite3
 import os
+import sys
 from datetime import datetime
 
+import cycle_deadline
+from cycle_deadline import DEADLINE_EXIT_CODE
+from jsonl_output import iter_output, IncompleteOutputError, OUTPUT_FORMAT, JSONL_OUTPUT_FILE
+
 # 固定的输入和输出文件
 INPUT_JSON = 'output.json'
+INPUT_JSONL = JSONL_OUTPUT_FILE
 OUTPUT_DB = 'customer_service.db'
 
+# 流式导入时每次批量插入的记录数
+INSERT_BATCH_SIZE = 1000
+
+# 追加模式: 保留数据库中已有的记录，只插入本次结果（增量导出时本次结果只包含新消息）；
+# 否则每次用本次结果替换整个数据库。默认跟随增量导出设置，命令行 --append / --replace 可覆盖
+APPEND_IMPORT = os.getenv("IMPORT_APPEND", os.getenv("EXPORT_INCREMENTAL", "0")) == "1"
+
+ISSUES_SQL = '''
+INSERT INTO issues (date, issue_type, description, urgency, completion, status, negative_feedback, source)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+SALES_SQL = '''
+INSERT INTO sales (date, region, product, sales_count, sales_amount, achievement_rate)
+VALUES (?, ?, ?, ?, ?, ?)
+'''
+
 def create_tables(conn):
     """创建数据库表"""
     cursor = conn.cursor()
@@ -21,10 +44,16 @@ def create_tables(conn):
         urgency TEXT,
         completion INTEGER,
         status TEXT,
-        negative_feedback TEXT
+        negative_feedback TEXT,
+        source TEXT
     )
     ''')
     
+    # 追加模式下沿用的旧数据库没有source列（记录来源，如本地分类器生成的记录为 local_classifier）
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(issues)")]
+    if "source" not in columns:
+        cursor.execute("ALTER TABLE issues ADD COLUMN source TEXT")
+    
     # 创建销售数据表
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS sales (
@@ -40,9 +69,52 @@ def create_tables(conn):
     
     conn.commit()
 
-def import_json_to_sqlite():
-    """将JSON数据导入到SQLite数据库"""
-    print(f"正在将JSON数据 ({INPUT_JSON}) 导入到SQLite数据库 ({OUTPUT_DB})...")
+def issue_row(issue):
+    """问题反馈记录 -> issues表的一行"""
+    return (
+        issue.get("date", ""),
+        issue.get("issue_type", ""),
+        issue.get("description", ""),
+        issue.get("urgency", "中"),
+        issue.get("completion", 0),
+        issue.get("status", "未处理"),
+        issue.get("negative_feedback", "否"),
+        issue.get("source")
+    )
+
+def sale_row(sale):
+    """销售记录 -> sales表的一行"""
+    return (
+        sale.get("date", ""),
+        sale.get("region", ""),
+        sale.get("product_model", ""),  # 注意：JSON中可能是product_model
+        sale.get("quantity", 0),        # 注意：JSON中可能是quantity
+        sale.get("amount", 0.0),        # 注意：JSON中可能是amount
+        sale.get("completion_rate", 0.0) # 注意：JSON中可能是completion_rate
+    )
+
+def print_db_info(issues_count, sales_count):
+    """显示数据库信息"""
+    print(f"\n数据库信息:")
+    print(f"- 数据库文件: {OUTPUT_DB}")
+    print(f"- 文件大小: {os.path.getsize(OUTPUT_DB)} 字节")
+    print(f"- 问题反馈记录: {issues_count} 条")
+    print(f"- 销售数据记录: {sales_count} 条")
+    print(f"- 总记录数: {issues_count + sales_count} 条")
+    
+    print(f"\n数据导入完成!")
+
+def count_rows(conn):
+    """数据库中issues和sales的总行数"""
+    return (conn.execute("SELECT COUNT(*) FROM issues").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM sales").fetchone()[0])
+
+def import_json_to_sqlite(append=False):
+    """将JSON数据导入到SQLite数据库
+    
+    append为True时在一个事务中追加到现有数据库，否则删除现有数据库后重新创建
+    """
+    print(f"正在将JSON数据 ({INPUT_JSON}) 导入到SQLite数据库 ({OUTPUT_DB})... (模式: {'追加' if append else '替换'})")
     
     # 检查输入文件是否存在
     if not os.path.exists(INPUT_JSON):
@@ -54,90 +126,43 @@ def import_json_to_sqlite():
         with open(INPUT_JSON, 'r', encoding='utf-8') as f:
             data = json.load(f)
         
-        # 如果数据库已存在，删除它
-        if os.path.exists(OUTPUT_DB):
+        # 替换模式: 如果数据库已存在，删除它
+        if not append and os.path.exists(OUTPUT_DB):
             print(f"删除现有数据库文件: {OUTPUT_DB}")
             os.remove(OUTPUT_DB)
         
-        # 连接到SQLite数据库（这将创建一个新的数据库文件）
+        # 连接到SQLite数据库（不存在时创建新的数据库文件）
         conn = sqlite3.connect(OUTPUT_DB)
         
         # 创建表
         create_tables(conn)
         
-        # 导入问题反馈数据
-        issues_count = 0
-        if "issues" in data and data["issues"]:
-            cursor = conn.cursor()
-            
-            # 准备SQL语句
-            sql = '''
-            INSERT INTO issues (date, issue_type, description, urgency, completion, status, negative_feedback)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            '''
+        # 问题反馈和销售数据在同一个事务中写入，失败时不会留下一半的结果
+        try:
+            issues_count = 0
+            if "issues" in data and data["issues"]:
+                values = [issue_row(issue) for issue in data["issues"]]
+                conn.executemany(ISSUES_SQL, values)
+                issues_count = len(values)
             
-            # 准备数据
-            values = []
-            for issue in data["issues"]:
-                values.append((
-                    issue.get("date", ""),
-                    issue.get("issue_type", ""),
-                    issue.get("description", ""),
-                    issue.get("urgency", "中"),
-                    issue.get("completion", 0),
-                    issue.get("status", "未处理"),
-                    issue.get("negative_feedback", "否")
-                ))
-            
-            # 执行批量插入
-            cursor.executemany(sql, values)
+            sales_count = 0
+            if "sales" in data and data["sales"]:
+                values = [sale_row(sale) for sale in data["sales"]]
+                conn.executemany(SALES_SQL, values)
+                sales_count = len(values)
             conn.commit()
-            
-            issues_count = len(values)
-            print(f"成功导入 {issues_count} 条问题反馈数据")
-        
-        # 导入销售数据
-        sales_count = 0
-        if "sales" in data and data["sales"]:
-            cursor = conn.cursor()
-            
-            # 准备SQL语句
-            sql = '''
-            INSERT INTO sales (date, region, product, sales_count, sales_amount, achievement_rate)
-            VALUES (?, ?, ?, ?, ?, ?)
-            '''
-            
-            # 准备数据
-            values = []
-            for sale in data["sales"]:
-                values.append((
-                    sale.get("date", ""),
-                    sale.get("region", ""),
-                    sale.get("product_model", ""),  # 注意：JSON中可能是product_model
-                    sale.get("quantity", 0),        # 注意：JSON中可能是quantity
-                    sale.get("amount", 0.0),        # 注意：JSON中可能是amount
-                    sale.get("completion_rate", 0.0) # 注意：JSON中可能是completion_rate
-                ))
-            
-            # 执行批量插入
-            cursor.executemany(sql, values)
-            conn.commit()
-            
-            sales_count = len(values)
-            print(f"成功导入 {sales_count} 条销售数据")
+        except Exception:
+            conn.rollback()
+            conn.close()
+            raise
+        print(f"成功导入 {issues_count} 条问题反馈数据")
+        print(f"成功导入 {sales_count} 条销售数据")
         
-        # 关闭连接
+        # 显示数据库信息（追加模式下显示数据库中的总行数）
+        if append:
+            issues_count, sales_count = count_rows(conn)
         conn.close()
-        
-        # 显示数据库信息
-        print(f"\n数据库信息:")
-        print(f"- 数据库文件: {OUTPUT_DB}")
-        print(f"- 文件大小: {os.path.getsize(OUTPUT_DB)} 字节")
-        print(f"- 问题反馈记录: {issues_count} 条")
-        print(f"- 销售数据记录: {sales_count} 条")
-        print(f"- 总记录数: {issues_count + sales_count} 条")
-        
-        print(f"\n数据导入完成!")
+        print_db_info(issues_count, sales_count)
         return True
         
     except json.JSONDecodeError:
@@ -149,9 +174,97 @@ def import_json_to_sqlite():
         traceback.print_exc()
         return False
 
+def import_jsonl_to_sqlite(follow=False, timeout=None, append=False):
+    """流式读取JSONL结果并分批写入SQLite数据库
+    
+    follow为True时可以在text_to_json.py仍在写入时启动，随记录追加逐批导入，直到读到清单行。
+    替换模式先写入临时数据库，读到完整的清单行后再替换正式数据库；
+    追加模式在正式数据库的一个事务中插入，读到清单行后才提交。输出不完整时原数据库保持不变
+    """
+    print(f"正在将JSONL数据 ({INPUT_JSONL}) 导入到SQLite数据库 ({OUTPUT_DB})... (模式: {'追加' if append else '替换'})")
+    
+    if not os.path.exists(INPUT_JSONL):
+        print(f"错误: 输入文件 '{INPUT_JSONL}' 不存在")
+        return False
+    
+    temp_db = f"{OUTPUT_DB}.tmp"
+    if append:
+        conn = sqlite3.connect(OUTPUT_DB)
+    else:
+        if os.path.exists(temp_db):
+            os.remove(temp_db)
+        conn = sqlite3.connect(temp_db)
+    try:
+        create_tables(conn)
+        
+        pending = {"issues": [], "sales": []}
+        counts = {"issues": 0, "sales": 0}
+        
+        def insert(kind):
+            if not pending[kind]:
+                return
+            conn.executemany(ISSUES_SQL if kind == "issues" else SALES_SQL, pending[kind])
+            if not append:
+                conn.commit()
+            counts[kind] += len(pending[kind])
+            pending[kind] = []
+        
+        for kind, record in iter_output(INPUT_JSONL, follow=follow, timeout=timeout):
+            if kind == "manifest":
+                break
+            pending[kind].append(issue_row(record) if kind == "issues" else sale_row(record))
+            if len(pending[kind]) >= INSERT_BATCH_SIZE:
+                insert(kind)
+        insert("issues")
+        insert("sales")
+        
+        # 读到完整的清单行后再提交（追加模式）或替换正式数据库（替换模式）
+        conn.commit()
+        totals = count_rows(conn)
+        conn.close()
+        if not append:
+            os.replace(temp_db, OUTPUT_DB)
+        print(f"成功导入 {counts['issues']} 条问题反馈数据")
+        print(f"成功导入 {counts['sales']} 条销售数据")
+        print_db_info(*totals)
+        return True
+        
+    except (IncompleteOutputError, json.JSONDecodeError) as e:
+        print(f"错误: '{INPUT_JSONL}' 不是完整的JSONL结果: {e}")
+    except Exception as e:
+        print(f"导入数据时出错: {e}")
+        import traceback
+        traceback.print_exc()
+    
+    if append:
+        conn.rollback()
+    conn.close()
+    if not append and os.path.exists(temp_db):
+        os.remove(temp_db)
+    return False
+
 def main():
     """主函数"""
-    import_json_to_sqlite()
+    import argparse
+    parser = argparse.ArgumentParser(description='将GPT提取结果导入SQLite数据库')
+    parser.add_argument('--format', choices=['json', 'jsonl'], default=OUTPUT_FORMAT,
+                        help='输入格式: json (output.json) 或 jsonl (output.jsonl)，默认取OUTPUT_FORMAT环境变量')
+    parser.add_argument('--follow', action='store_true', help='jsonl格式下等待写入端完成，边写边导入')
+    parser.add_argument('--timeout', type=float, help='--follow时最长等待秒数（不超过本周期的剩余时间）')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--append', dest='append', action='store_true', default=APPEND_IMPORT,
+                      help='追加到现有数据库（增量导出时的默认模式）')
+    mode.add_argument('--replace', dest='append', action='store_false', help='用本次结果替换整个数据库')
+    args = parser.parse_args()
+    
+    if args.format == 'jsonl':
+        # --follow 等待写入端时不超过周期截止时间
+        timeout = cycle_deadline.timeout(args.timeout) if args.follow else args.timeout
+        success = import_jsonl_to_sqlite(follow=args.follow, timeout=timeout, append=args.append)
+    else:
+        success = import_json_to_sqlite(append=args.append)
+    if not success:
+        sys.exit(DEADLINE_EXIT_CODE if args.follow and cycle_deadline.expired() else 1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
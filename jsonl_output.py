@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""GPT提取结果的JSONL输出（text_to_json.py -> json_to_sqlite.py）
+
+每行一条紧凑JSON记录，随批次完成按输入行顺序追加写入：
+    {"kind": "issues", "record": {...}}
+    {"kind": "sales", "record": {...}}
+最后一行是清单（manifest），包含记录数和metadata：
+    {"kind": "manifest", "counts": {"issues": 10, "sales": 3}, "metadata": {...}}
+没有清单的文件表示写入尚未完成（或进程中途退出），读取端不会把它当作完整结果。
+"""
+
+import json
+import os
+import time
+
+# 输出格式：json 为原有的 output.json，jsonl 为逐条追加的 output.jsonl
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "json")
+JSONL_OUTPUT_FILE = os.getenv("OUTPUT_JSONL_FILE", "output.jsonl")
+
+RECORD_KINDS = ("issues", "sales")
+
+
+class IncompleteOutputError(Exception):
+    """JSONL输出缺少清单行或记录数与清单不一致"""
+
+
+class JsonlOutputWriter:
+    def __init__(self, path=JSONL_OUTPUT_FILE):
+        """创建（覆盖）输出文件，之后的记录都追加写入"""
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8')
+        self.counts = {kind: 0 for kind in RECORD_KINDS}
+
+    def write(self, kind, records):
+        for record in records:
+            self.file.write(json.dumps({"kind": kind, "record": record}, ensure_ascii=False, separators=(',', ':')))
+            self.file.write('\n')
+        self.counts[kind] += len(records)
+
+    def flush(self):
+        """把已写入的记录刷到磁盘，读取端可以立即看到"""
+        self.file.flush()
+
+    def finish(self, metadata=None):
+        """写入清单行并关闭文件"""
+        manifest = {"kind": "manifest", "counts": self.counts, "metadata": metadata or {}}
+        self.file.write(json.dumps(manifest, ensure_ascii=False, default=str) + '\n')
+        self.file.close()
+        print(f"JSONL结果已写入: {self.path}，issues={self.counts['issues']}, sales={self.counts['sales']}")
+
+    def abort(self):
+        """不写清单直接关闭，读取端会识别为不完整的输出"""
+        if not self.file.closed:
+            self.file.close()
+
+
+def iter_output(path=JSONL_OUTPUT_FILE, follow=False, timeout=None, poll_interval=0.5):
+    """逐条读取JSONL输出，依次返回 (类型, 记录)，最后返回 ("manifest", 清单)
+
+    follow为True时，读到文件末尾会等待写入端继续追加，直到出现清单行或超过timeout秒；
+    否则文件没有清单行时抛出 IncompleteOutputError
+    """
+    counts = {kind: 0 for kind in RECORD_KINDS}
+    deadline = time.time() + timeout if timeout else None
+
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line.endswith('\n'):
+                # 文件末尾，或写入端只写了半行
+                if not follow:
+                    raise IncompleteOutputError(f"{path} 没有清单行，输出不完整")
+                if deadline and time.time() > deadline:
+                    raise IncompleteOutputError(f"等待 {path} 写入完成超时")
+                f.seek(position)
+                time.sleep(poll_interval)
+                continue
+
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            kind = entry.get("kind")
+            if kind == "manifest":
+                if entry.get("counts") != counts:
+                    raise IncompleteOutputError(f"{path} 的记录数 {counts} 与清单 {entry.get('counts')} 不一致")
+                yield kind, entry
+                return
+            counts[kind] += 1
+            yield kind, entry["record"]
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""本地消息分类器（字符n-gram TF-IDF + 多分类逻辑回归，纯Python，仅用CPU）
+
+用GPT已经标注过的数据训练，在调用API之前对消息分类，置信度足够高的消息直接在本地生成结果:
+- kind: 这条消息产生一条问题记录（issue）、销售记录（sales）还是不产生记录（none）
+- issue_type / urgency / negative_feedback: 问题记录的分类字段
+
+训练数据:
+- customer_service.db 的 issues 表: description 与原始消息基本一致，作为 issue 样本；
+  本地分类器自己生成的记录（source 为 local_classifier）不作为样本，避免用自己的预测训练自己
+- 启用本地分类器时 TextProcessor 记录的API标注样本（LOCAL_CLASSIFIER_EXAMPLES）: 每行消息及其提取结果，
+  提供 sales / none 样本；没有这些样本时无法判断消息是否产生记录，分类器不会接管任何消息
+
+首次启用前需要先积累 sales / none 样本: 设置 LOCAL_CLASSIFIER=1 但不训练模型时，
+所有消息仍发送给API，API的结果被记录为样本。
+
+销售记录需要提取数量、金额等字段，始终交给API处理。
+
+用法:
+    python local_classifier.py --retrain                  # 重新训练并保存模型
+    python local_classifier.py --predict "电池无法充电"     # 查看单条消息的分类结果
+    LOCAL_CLASSIFIER=1 python text_to_json.py             # 启用本地分类
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import spool
+
+# 是否在调用API之前使用本地分类器
+CLASSIFIER_ENABLED = os.getenv("LOCAL_CLASSIFIER", "0") == "1"
+
+# 模型文件、API标注样本文件（仅在启用本地分类器时记录，设置为空字符串可停止记录样本）和训练用数据库
+MODEL_FILE = os.getenv("LOCAL_CLASSIFIER_MODEL", "local_classifier.json")
+EXAMPLES_FILE = os.getenv("LOCAL_CLASSIFIER_EXAMPLES", "local_classifier_examples.jsonl")
+TRAINING_DB = os.getenv("LOCAL_CLASSIFIER_DB", "customer_service.db")
+
+# 所有分类字段的最低置信度，低于该值的消息发送给API
+CONFIDENCE_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.9"))
+
+# 特征和训练参数
+NGRAM_RANGE = (1, 3)
+MIN_DF = 2
+EPOCHS = 30
+LEARNING_RATE = 0.5
+L2 = 1e-4
+HOLDOUT_RATIO = 0.1
+
+# 分类字段
+KIND_HEAD = "kind"
+ISSUE_HEADS = ("issue_type", "urgency", "negative_feedback")
+
+# 本地生成的记录的 source 字段，导入数据库后据此排除出训练样本
+LOCAL_SOURCE = "local_classifier"
+
+# 聊天记录时间中的日期部分（mysql_to_txt.py 导出的时间可能只有 时:分:秒）
+DATE_PATTERN = re.compile(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})")
+
+
+def normalize_message(message):
+    """合并空白并转为小写"""
+    return " ".join(str(message).split()).lower()
+
+
+def ngrams(message):
+    """消息的字符n-gram计数"""
+    text = normalize_message(message)
+    counts = Counter()
+    for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+        for i in range(len(text) - n + 1):
+            counts[text[i:i + n]] += 1
+    return counts
+
+
+def _softmax(scores):
+    top = max(scores)
+    exps = [math.exp(score - top) for score in scores]
+    total = sum(exps)
+    return [value / total for value in exps]
+
+
+class LocalClassifier:
+    def __init__(self, vocabulary=None, heads=None, info=None):
+        """vocabulary 为 n-gram -> (特征序号, idf)，heads 为 字段 -> {"classes": [...], "weights": [[...]], "bias": [...]}"""
+        self.vocabulary = vocabulary or {}
+        self.heads = heads or {}
+        self.info = info or {}
+
+    @classmethod
+    def load(cls, path=MODEL_FILE):
+        """加载模型文件，文件不存在时返回None"""
+        if not path or not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        vocabulary = {gram: tuple(value) for gram, value in data["vocabulary"].items()}
+        return cls(vocabulary, data["heads"], data.get("info"))
+
+    def save(self, path=MODEL_FILE):
+        """写入临时文件后替换，避免正在运行的流程读到半个模型"""
+        data = {"info": self.info, "vocabulary": self.vocabulary, "heads": self.heads}
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+    def features(self, message):
+        """TF-IDF特征向量（L2归一化），返回 [(特征序号, 值), ...]"""
+        vector = []
+        for gram, count in ngrams(message).items():
+            entry = self.vocabulary.get(gram)
+            if entry:
+                vector.append((entry[0], (1 + math.log(count)) * entry[1]))
+        norm = math.sqrt(sum(value * value for _, value in vector))
+        return [(index, value / norm) for index, value in vector] if norm else []
+
+    def _probabilities(self, head, vector):
+        model = self.heads[head]
+        scores = [bias + sum(weights[index] * value for index, value in vector)
+                  for weights, bias in zip(model["weights"], model["bias"])]
+        return _softmax(scores)
+
+    def predict(self, message):
+        """对一条消息分类，返回 {字段: (取值, 置信度)}；模型无法判断消息是否产生记录时返回None"""
+        if KIND_HEAD not in self.heads:
+            return None
+        vector = self.features(message)
+        if not vector:
+            return None
+        prediction = {}
+        for head in self.heads:
+            probabilities = self._probabilities(head, vector)
+            best = max(range(len(probabilities)), key=probabilities.__getitem__)
+            prediction[head] = (self.heads[head]["classes"][best], probabilities[best])
+        return prediction
+
+    def classify_line(self, line, threshold=CONFIDENCE_THRESHOLD):
+        """对一行聊天记录分类，置信度足够高时返回该行的提取结果 {"issues": [...], "sales": [...]}，否则返回None"""
+        record = spool.parse_line(line)
+        message = str(record.get("message", "")).strip()
+        prediction = self.predict(message) if message else None
+        if not prediction:
+            return None
+        kind, confidence = prediction[KIND_HEAD]
+        if confidence < threshold:
+            return None
+        if kind == "none":
+            return {"issues": [], "sales": []}
+        if kind != "issue" or any(head not in prediction or prediction[head][1] < threshold for head in ISSUE_HEADS):
+            return None
+
+        issue = {
+            "date": _record_date(record.get("time")),
+            "issue_type": prediction["issue_type"][0],
+            "description": message,
+            "urgency": prediction["urgency"][0],
+            "completion": 0,
+            "status": "未处理",
+            "negative_feedback": prediction["negative_feedback"][0],
+            "source": LOCAL_SOURCE
+        }
+        return {"issues": [issue], "sales": []}
+
+
+def _record_date(time_value):
+    """聊天记录时间 -> 记录中的日期格式 YYYY/MM/DD，没有日期部分（如只有 10:23:45）时使用当天日期"""
+    match = DATE_PATTERN.search(str(time_value or ""))
+    if match:
+        year, month, day = match.groups()
+        return f"{year}/{int(month):02d}/{int(day):02d}"
+    return datetime.now().strftime("%Y/%m/%d")
+
+
+def example_from_records(line, records):
+    """把一行消息的API提取结果转换为训练样本；结果无法对应单一类别（如一行多条记录）时返回None"""
+    message = str(spool.parse_line(line).get("message", "")).strip()
+    issues = records.get("issues", [])
+    sales = records.get("sales", [])
+    if not message:
+        return None
+    if sales:
+        return {"message": message, "kind": "sales"}
+    if not issues:
+        return {"message": message, "kind": "none"}
+    if len(issues) > 1:
+        return None
+    example = {"message": message, "kind": "issue"}
+    for head in ISSUE_HEADS:
+        example[head] = issues[0].get(head)
+    return example
+
+
+class ExampleLog:
+    """追加记录API标注的训练样本（JSONL）"""
+
+    def __init__(self, path=EXAMPLES_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, examples):
+        if not examples:
+            return
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                for example in examples:
+                    f.write(json.dumps(example, ensure_ascii=False) + '\n')
+
+
+def load_examples(db_path=TRAINING_DB, examples_path=EXAMPLES_FILE):
+    """读取训练样本: 数据库issues表（不含本地分类器生成的记录） + API标注样本文件（同一消息以最后一次标注为准）"""
+    examples = {}
+    if db_path and os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            sql = "SELECT description, issue_type, urgency, negative_feedback FROM issues WHERE description IS NOT NULL"
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(issues)")]
+            params = ()
+            if "source" in columns:
+                sql += " AND (source IS NULL OR source != ?)"
+                params = (LOCAL_SOURCE,)
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        for description, issue_type, urgency, negative_feedback in rows:
+            examples[normalize_message(description)] = {
+                "message": description, "kind": "issue", "issue_type": issue_type,
+                "urgency": urgency, "negative_feedback": negative_feedback
+            }
+        print(f"从 {db_path} 读取了 {len(rows)} 条问题记录")
+
+    if examples_path and os.path.exists(examples_path):
+        count = 0
+        with open(examples_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    example = json.loads(line)
+                except ValueError:
+                    continue
+                examples[normalize_message(example["message"])] = example
+                count += 1
+        print(f"从 {examples_path} 读取了 {count} 条API标注样本")
+    return list(examples.values())
+
+
+def _train_head(vectors, labels, feature_count, seed):
+    """随机梯度下降训练一个多分类逻辑回归"""
+    classes = sorted(set(labels))
+    class_index = {label: i for i, label in enumerate(classes)}
+    weights = [[0.0] * feature_count for _ in classes]
+    bias = [0.0] * len(classes)
+    order = list(range(len(vectors)))
+    rng = random.Random(seed)
+
+    for epoch in range(EPOCHS):
+        rng.shuffle(order)
+        rate = LEARNING_RATE / (1 + epoch * 0.2)
+        for i in order:
+            vector = vectors[i]
+            target = class_index[labels[i]]
+            scores = [b + sum(w[index] * value for index, value in vector) for w, b in zip(weights, bias)]
+            probabilities = _softmax(scores)
+            for c, probability in enumerate(probabilities):
+                gradient = probability - (1.0 if c == target else 0.0)
+                row = weights[c]
+                for index, value in vector:
+                    row[index] -= rate * (gradient * value + L2 * row[index])
+                bias[c] -= rate * gradient
+
+    return {
+        "classes": classes,
+        "weights": [[round(w, 5) for w in row] for row in weights],
+        "bias": [round(b, 5) for b in bias]
+    }
+
+
+def train(examples, seed=0):
+    """训练所有分类字段，返回LocalClassifier"""
+    document_frequency = Counter()
+    grams = []
+    for example in examples:
+        counts = ngrams(example["message"])
+        grams.append(counts)
+        document_frequency.update(counts.keys())
+
+    min_df = MIN_DF if len(examples) >= 100 else 1
+    total = len(examples)
+    vocabulary = {}
+    for gram, df in document_frequency.items():
+        if df >= min_df:
+            vocabulary[gram] = (len(vocabulary), round(math.log((1 + total) / (1 + df)) + 1, 5))
+
+    classifier = LocalClassifier(vocabulary)
+    vectors = [classifier.features(example["message"]) for example in examples]
+
+    heads = {}
+    kinds = [example["kind"] for example in examples]
+    if len(set(kinds)) > 1:
+        heads[KIND_HEAD] = _train_head(vectors, kinds, len(vocabulary), seed)
+    else:
+        print("警告: 训练样本中只有一种消息类别（缺少销售/无记录样本），分类器不会接管任何消息")
+
+    issue_examples = [i for i, example in enumerate(examples) if example["kind"] == "issue"]
+    for head in ISSUE_HEADS:
+        labelled = [i for i in issue_examples if examples[i].get(head)]
+        if labelled:
+            heads[head] = _train_head([vectors[i] for i in labelled], [examples[i][head] for i in labelled],
+                                      len(vocabulary), seed)
+
+    classifier.heads = heads
+    classifier.info = {
+        "trained_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "examples": total,
+        "kinds": dict(Counter(kinds)),
+        "features": len(vocabulary)
+    }
+    return classifier
+
+
+def evaluate(classifier, examples, threshold=CONFIDENCE_THRESHOLD):
+    """在验证样本上统计本地接管的比例和接管部分的准确率"""
+    taken = 0
+    correct = 0
+    for example in examples:
+        prediction = classifier.predict(example["message"])
+        if not prediction:
+            continue
+        kind, confidence = prediction[KIND_HEAD]
+        heads = [KIND_HEAD] + (list(ISSUE_HEADS) if kind == "issue" else [])
+        if kind == "sales" or any(head not in prediction or prediction[head][1] < threshold for head in heads):
+            continue
+        taken += 1
+        if kind == example["kind"] and all(prediction[head][0] == example.get(head) for head in heads[1:]):
+            correct += 1
+    return {
+        "examples": len(examples),
+        "coverage": round(taken / len(examples), 4) if examples else 0.0,
+        "accuracy": round(correct / taken, 4) if taken else None
+    }
+
+
+def retrain(db_path=TRAINING_DB, examples_path=EXAMPLES_FILE, model_path=MODEL_FILE, threshold=CONFIDENCE_THRESHOLD):
+    """用留出集评估后，在全部样本上重新训练并保存模型"""
+    examples = load_examples(db_path, examples_path)
+    if not examples:
+        print("错误: 没有可用的训练样本")
+        return None
+
+    started = time.time()
+    shuffled = list(examples)
+    random.Random(0).shuffle(shuffled)
+    holdout_size = int(len(shuffled) * HOLDOUT_RATIO)
+    if holdout_size:
+        trial = train(shuffled[holdout_size:])
+        report = evaluate(trial, shuffled[:holdout_size], threshold)
+        print(f"留出集评估（阈值 {threshold}）: {report}")
+    else:
+        report = None
+
+    classifier = train(examples)
+    classifier.info["holdout"] = report
+    classifier.info["threshold"] = threshold
+    classifier.save(model_path)
+    print(f"模型已保存到 {model_path}: {classifier.info['examples']} 条样本 {classifier.info['kinds']}，"
+          f"{classifier.info['features']} 个特征，耗时 {time.time() - started:.1f} 秒")
+    return classifier
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地消息分类器')
+    parser.add_argument('--retrain', action='store_true', help='重新训练并保存模型')
+    parser.add_argument('--predict', help='对一条消息分类并显示各字段的置信度')
+    parser.add_argument('--db', default=TRAINING_DB, help='训练用的SQLite数据库')
+    parser.add_argument('--examples', default=EXAMPLES_FILE, help='API标注样本文件')
+    parser.add_argument('--model', default=MODEL_FILE, help='模型文件')
+    parser.add_argument('--threshold', type=float, default=CONFIDENCE_THRESHOLD, help='置信度阈值')
+    args = parser.parse_args()
+
+    if args.retrain:
+        if retrain(args.db, args.examples, args.model, args.threshold) is None:
+            raise SystemExit(1)
+    elif args.predict:
+        classifier = LocalClassifier.load(args.model)
+        if classifier is None:
+            print(f"错误: 模型文件 {args.model} 不存在，请先运行 --retrain")
+            raise SystemExit(1)
+        print(json.dumps(classifier.predict(args.predict), ensure_ascii=False))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""本地模拟的 Azure OpenAI chat/completions 接口
+
+用于在不消耗真实配额的情况下测试和压测 TextProcessor：
+- 延迟: 首token延迟按对数正态分布抽样，再按生成速度（token/秒）累加输出时间
+- 故障注入: 按比例返回429（带retry-after-ms）和5xx
+- 截断: 按比例或在输出超过max_tokens时截断，finish_reason为length
+- 回复: 根据请求中的行号为每一行合成一条issues/sales记录，或返回固定的回复文件
+- 分级部署: 指定名称的快速部署延迟更低，并可按比例返回不合法的枚举值（用于测试升级）
+支持普通响应和 stream: true 的SSE响应。
+
+用法:
+    python mock_azure_server.py --port 8900 --latency-ms 800 --rate-429 0.05
+    AZURE_ENDPOINT_GPT4=http://127.0.0.1:8900/openai python text_to_json.py
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import compact_schema
+from text_to_json import estimate_tokens
+
+# 请求中的数据行: 标准模式 "[3] ..."，紧凑模式 "3|@1|时间|消息"
+STANDARD_LINE = re.compile(r"^\[(\d+)\] (.*)$", re.MULTILINE)
+COMPACT_LINE = re.compile(r"^(\d+)\|[^|\n]*\|[^|\n]*\|(.*)$", re.MULTILINE)
+
+# 含有这些词的行合成为销售记录，其余合成为问题记录
+SALES_WORDS = ("销量", "采购", "订购", "购买", "买")
+
+# 请求路径中的部署名称
+DEPLOYMENT_PATH = re.compile(r"/deployments/([^/]+)/")
+
+
+class MockConfig:
+    def __init__(self, latency_ms=800.0, latency_sigma=0.5, tokens_per_second=80.0,
+                 rate_429=0.0, rate_5xx=0.0, truncate_rate=0.0, retry_after_ms=1000, reply_file=None, seed=None,
+                 fast_deployment=None, fast_speedup=3.0, fast_error_rate=0.0):
+        self.latency_ms = latency_ms            # 首token延迟的中位数
+        self.latency_sigma = latency_sigma      # 对数正态分布的sigma，0为固定延迟
+        self.tokens_per_second = tokens_per_second  # 输出生成速度，0为不模拟生成时间
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.truncate_rate = truncate_rate
+        self.retry_after_ms = retry_after_ms
+        self.fast_deployment = fast_deployment  # 快速部署的名称
+        self.fast_speedup = fast_speedup        # 快速部署的延迟和生成时间缩短的倍数
+        self.fast_error_rate = fast_error_rate  # 快速部署返回不合法结果的比例
+        self.reply = None
+        if reply_file:
+            with open(reply_file, 'r', encoding='utf-8') as f:
+                self.reply = f.read()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        """抽取一次请求的随机参数: (首token延迟秒数, 注入的状态码, 是否截断, 截断时保留的比例)"""
+        with self.lock:
+            latency = self.latency_ms / 1000.0
+            if self.latency_sigma > 0:
+                latency *= math.exp(self.random.gauss(0, self.latency_sigma))
+            roll = self.random.random()
+            if roll < self.rate_429:
+                status = 429
+            elif roll < self.rate_429 + self.rate_5xx:
+                status = self.random.choice([500, 502, 503])
+            else:
+                status = 200
+            truncate = self.random.random() < self.truncate_rate
+            cut = self.random.uniform(0.2, 0.9)
+            wrong = self.random.random() < self.fast_error_rate
+        return latency, status, truncate, cut, wrong
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.status_counts = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.truncated = 0
+
+    def record(self, status, prompt_tokens=0, completion_tokens=0, truncated=False):
+        with self.lock:
+            self.requests += 1
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.truncated += int(truncated)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "status_counts": dict(self.status_counts),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "truncated": self.truncated
+            }
+
+
+def synthesize_reply(user_content, compact=False):
+    """为请求中的每个数据行合成一条记录；compact为True时返回紧凑列数组格式"""
+    matches = STANDARD_LINE.findall(user_content) or COMPACT_LINE.findall(user_content)
+    issues = []
+    sales = []
+    for number, text in matches:
+        message = text.split("message:", 1)[-1].strip()
+        if any(word in message for word in SALES_WORDS):
+            digits = re.findall(r"\d+", message)
+            sales.append({
+                "date": "2025/01/01", "region": "华东", "product_model": "6-DZM-20",
+                "quantity": int(digits[0]) if digits else 1, "amount": 0, "completion_rate": 0,
+                "source_line": int(number)
+            })
+        else:
+            issues.append({
+                "date": "2025/01/01", "issue_type": "产品", "description": message[:200],
+                "urgency": "中", "completion": 0, "status": "未处理", "negative_feedback": "否",
+                "source_line": int(number)
+            })
+    if compact:
+        result = {}
+        for kind, records in (("issues", issues), ("sales", sales)):
+            columns = compact_schema.COLUMNS[kind]
+            rows = [[compact_schema.ENUMS[column].index(record[column]) if column in compact_schema.ENUMS
+                     else record[column] for column in columns] for record in records]
+            result[kind] = [columns] + rows
+        return json.dumps(result, ensure_ascii=False, separators=(',', ':'))
+    return json.dumps({"issues": issues, "sales": sales}, ensure_ascii=False)
+
+
+class MockAzureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        config = self.server.config
+        stats = self.server.stats
+        if "/chat/completions" not in self.path:
+            self._send_json(404, {"error": {"message": "Resource not found", "code": "404"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        messages = payload.get("messages", [])
+        user_content = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+        prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in messages)
+
+        latency, status, truncate, cut, wrong = config.draw()
+        match = DEPLOYMENT_PATH.search(self.path)
+        fast = bool(config.fast_deployment) and match is not None and match.group(1) == config.fast_deployment
+        if fast:
+            latency /= config.fast_speedup
+        if status == 429:
+            stats.record(429)
+            time.sleep(min(latency, 0.05))
+            self._send_json(429, {"error": {"message": "Rate limit is exceeded. Try again later.", "code": "429"}},
+                            {"retry-after-ms": str(config.retry_after_ms),
+                             "Retry-After": str(max(1, config.retry_after_ms // 1000))})
+            return
+        if status != 200:
+            stats.record(status)
+            time.sleep(latency)
+            self._send_json(status, {"error": {"message": "The server had an error processing your request.",
+                                               "code": str(status)}})
+            return
+
+        compact = any(compact_schema.FORMAT_NAME in m.get("content", "") for m in messages)
+        content = config.reply if config.reply is not None else synthesize_reply(user_content, compact)
+        if fast and wrong:
+            # 模拟小模型的错误: 枚举值不在允许的取值中
+            content = content.replace('"中"', '"一般"', 1)
+        completion_tokens = estimate_tokens(content)
+        max_tokens = payload.get("max_tokens") or completion_tokens
+        finish_reason = "stop"
+        if truncate or completion_tokens > max_tokens:
+            keep = cut if truncate else max_tokens / completion_tokens
+            content = content[:int(len(content) * keep)]
+            completion_tokens = estimate_tokens(content)
+            finish_reason = "length"
+        stats.record(200, prompt_tokens, completion_tokens, finish_reason == "length")
+
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        generation = completion_tokens / config.tokens_per_second if config.tokens_per_second > 0 else 0.0
+        if fast:
+            generation /= config.fast_speedup
+        time.sleep(latency)
+
+        if payload.get("stream"):
+            self._stream(content, finish_reason, usage, generation)
+            return
+
+        time.sleep(generation)
+        self._send_json(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "model": "gpt-4o",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}],
+            "usage": usage
+        }, {"x-ratelimit-remaining-requests": "1000", "x-ratelimit-remaining-tokens": "1000000"})
+
+    def _stream(self, content, finish_reason, usage, generation):
+        """以SSE分块发送，总发送时间约等于生成时间"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        chunk_size = 16
+        pieces = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)] or [""]
+        delay = generation / len(pieces)
+        events = [{"choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]} for piece in pieces]
+        events.append({"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}], "usage": usage})
+        for event in events:
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+            if delay:
+                time.sleep(delay)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端关闭连接池时空闲的keep-alive连接会被重置，不需要打印
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def start_server(config=None, host="127.0.0.1", port=0):
+    """在后台线程中启动模拟服务，返回 (server, endpoint)；endpoint 可直接作为 TextProcessor 的 endpoint"""
+    server = MockServer((host, port), MockAzureHandler)
+    server.config = config or MockConfig()
+    server.stats = MockStats()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/openai"
+
+
+def add_config_arguments(parser):
+    """添加模拟服务的命令行参数（压测脚本共用）"""
+    parser.add_argument('--latency-ms', type=float, default=800.0, help='首token延迟中位数（毫秒）')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='延迟对数正态分布的sigma，0为固定延迟')
+    parser.add_argument('--tokens-per-second', type=float, default=80.0, help='输出生成速度，0为不模拟')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='返回429的比例')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='返回5xx的比例')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='截断响应的比例')
+    parser.add_argument('--retry-after-ms', type=int, default=1000, help='429响应中建议的等待毫秒数')
+    parser.add_argument('--reply-file', help='固定回复内容文件（默认按请求合成）')
+    parser.add_argument('--seed', type=int, help='随机种子')
+    parser.add_argument('--fast-deployment', help='快速部署名称（该部署延迟更低）')
+    parser.add_argument('--fast-speedup', type=float, default=3.0, help='快速部署的延迟缩短倍数')
+    parser.add_argument('--fast-error-rate', type=float, default=0.0, help='快速部署返回不合法结果的比例')
+
+
+def config_from_args(args):
+    return MockConfig(args.latency_ms, args.latency_sigma, args.tokens_per_second, args.rate_429, args.rate_5xx,
+                      args.truncate_rate, args.retry_after_ms, args.reply_file, args.seed,
+                      args.fast_deployment, args.fast_speedup, args.fast_error_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的Azure OpenAI接口')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server, endpoint = start_server(config_from_args(args), args.host, args.port)
+    print(f"模拟服务已启动: {endpoint}（设置 AZURE_ENDPOINT_GPT4={endpoint}），按Ctrl+C停止")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"统计: {server.stats.snapshot()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(f"最终统计: {server.stats.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
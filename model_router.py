@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""按批次复杂度在快速部署和gpt-4o之间路由
+
+复杂度低的批次（短消息、没有销售数字、格式单一）先发送给更快更便宜的部署（如gpt-4o-mini），
+结果未通过校验（请求失败、字段或枚举值不合法、行号越界、疑似销售的行没有销售记录）时升级到主部署重新处理。
+每条路由分别统计批次数、成功/升级次数和平均延迟，写入结果的metadata。
+"""
+
+import os
+import re
+import threading
+
+import compact_schema
+import spool
+
+# 快速部署名称，为空时不启用路由，所有批次使用主部署
+FAST_DEPLOYMENT = os.getenv("AZURE_DEPLOYMENT_FAST", "")
+
+# 复杂度不超过该值的批次先使用快速部署（0~1）
+MAX_FAST_COMPLEXITY = float(os.getenv("LLM_ROUTE_MAX_COMPLEXITY", "0.35"))
+
+# 超过该长度的消息视为长消息
+LONG_MESSAGE_CHARS = 120
+
+# 数字 + 这些词通常表示销售数据，需要提取数量、金额，交给主部署更可靠
+SALES_HINT = re.compile(r"\d.*(销量|销售|采购|订购|购买|台|组|万|元|%)|(销量|销售|采购|订购|购买).*\d")
+
+# 多种格式混杂: 链接、表格分隔符、JSON片段、多个数字段
+MIXED_FORMAT = re.compile(r"https?://|\||\t|[{}\[\]<>]|(\d+\D+){4,}")
+
+# 每种记录的必填字段
+REQUIRED_FIELDS = {
+    "issues": ("date", "issue_type", "description", "urgency", "status", "negative_feedback"),
+    "sales": ("date", "region", "product_model", "quantity"),
+}
+
+
+def message_of(line):
+    return str(spool.parse_line(line).get("message", ""))
+
+
+def line_complexity(line):
+    """单行的复杂度（0~1）"""
+    message = message_of(line)
+    score = 0.0
+    if SALES_HINT.search(message):
+        score += 0.5
+    if len(message) > LONG_MESSAGE_CHARS:
+        score += 0.3
+    if MIXED_FORMAT.search(message):
+        score += 0.2
+    return min(score, 1.0)
+
+
+def complexity_score(lines):
+    """批次的复杂度: 各行复杂度的平均值"""
+    if not lines:
+        return 0.0
+    return sum(line_complexity(line) for line in lines) / len(lines)
+
+
+def validate_result(result, lines):
+    """校验快速部署的结果，返回发现的问题列表（空列表表示通过）"""
+    if not isinstance(result, dict) or result.get("error"):
+        kind = result.get("error_kind") if isinstance(result, dict) else None
+        return [f"请求失败（{kind or '未知错误'}）"]
+    if result.get("incomplete"):
+        return ["响应不完整"]
+
+    problems = []
+    sales_lines = set()
+    for kind, required in REQUIRED_FIELDS.items():
+        records = result.get(kind)
+        if not isinstance(records, list):
+            problems.append(f"缺少{kind}数组")
+            continue
+        for record in records:
+            if not isinstance(record, dict):
+                problems.append(f"{kind}中有非对象记录")
+                continue
+            missing = [field for field in required if record.get(field) in (None, "")]
+            if missing:
+                problems.append(f"{kind}记录缺少字段 {missing}")
+            for field, values in compact_schema.ENUMS.items():
+                if field in record and record[field] not in values:
+                    problems.append(f"{kind}记录的{field}取值不合法: {record[field]}")
+            source_line = record.get("source_line")
+            if not isinstance(source_line, int) or not 0 < source_line <= len(lines):
+                problems.append(f"{kind}记录的source_line无效: {source_line}")
+            elif kind == "sales":
+                sales_lines.add(source_line)
+
+    # 置信度不足: 疑似销售数据的行没有产生销售记录
+    missed = [position + 1 for position, line in enumerate(lines)
+              if SALES_HINT.search(message_of(line)) and position + 1 not in sales_lines]
+    if missed:
+        problems.append(f"疑似销售数据的行没有销售记录: {missed[:5]}")
+    return problems
+
+
+class ModelRouter:
+    def __init__(self, fast_deployment=FAST_DEPLOYMENT, max_complexity=MAX_FAST_COMPLEXITY):
+        self.fast_deployment = fast_deployment
+        self.max_complexity = max_complexity
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def use_fast(self, lines):
+        """批次是否先发送给快速部署"""
+        return complexity_score(lines) <= self.max_complexity
+
+    def record(self, route, seconds, succeeded, escalated=False):
+        """记录一次路由调用"""
+        with self.lock:
+            stats = self.stats.setdefault(route, {"batches": 0, "succeeded": 0, "escalated": 0, "seconds": 0.0})
+            stats["batches"] += 1
+            stats["succeeded"] += int(succeeded)
+            stats["escalated"] += int(escalated)
+            stats["seconds"] += seconds
+
+    def report(self):
+        """每条路由的统计: 批次数、成功数、升级数、平均延迟"""
+        with self.lock:
+            return {
+                route: {
+                    "batches": stats["batches"],
+                    "succeeded": stats["succeeded"],
+                    "escalated": stats["escalated"],
+                    "avg_seconds": round(stats["seconds"] / stats["batches"], 3) if stats["batches"] else 0.0
+                }
+                for route, stats in self.stats.items()
+            }
@@ -5,8 +5,17 @@ import mysql.connector
 import sys
 import os
 import time
+import json
+import argparse
+import itertools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import spool
+import cycle_deadline
+from cycle_deadline import DeadlineExceeded, DEADLINE_EXIT_CODE
+
 # MySQL连接配置 - 使用已知可连接的参数
 DB_CONFIG = {
     'host': 'localhost',
@@ -18,25 +27,66 @@ DB_CONFIG = {
     'unix_socket': ''  # 确保使用TCP/IP连接
 }
 
-# 输出文件路径
-OUTPUT_FILE = 'input.txt'
+# 输出文件路径（txt格式；jsonl格式见 spool.JSONL_FILE）
+OUTPUT_FILE = spool.TXT_FILE
 
 # 表名 - 默认为"messages"，可以更改为实际表名
 TABLE_NAME = os.getenv("DB_TABLE", "messages")
 
+# 增量导出状态文件，按表记录已导出的最大id（水位线）
+STATE_FILE = os.getenv("EXPORT_STATE_FILE", "export_state.json")
+
+# 是否默认启用增量导出（命令行 --incremental / --full 可覆盖）
+INCREMENTAL_EXPORT = os.getenv("EXPORT_INCREMENTAL", "0") == "1"
+
+# 可选的时间戳列，设置后会同时导出该列晚于水位线的旧记录（例如被更新过的消息）
+WATERMARK_TIME_COLUMN = os.getenv("EXPORT_TIME_COLUMN", "")
+
+# 流式导出时每次从服务器读取的行数
+FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "5000"))
+
+# 字段角色缓存文件，按表结构指纹缓存id/user/time/message字段的识别结果
+COLUMN_ROLES_CACHE = os.getenv("EXPORT_COLUMN_ROLES_CACHE", "column_roles_cache.json")
+
+# 字段角色覆盖文件，格式如 {"messages": {"message": "content", "time": "created_at"}}，优先于自动识别
+COLUMN_ROLES_OVERRIDE = os.getenv("EXPORT_COLUMN_ROLES_OVERRIDE", "column_roles.json")
+
+# 字段角色名称
+COLUMN_ROLES = ("id", "user", "time", "message")
+
+# 下推到WHERE子句的过滤条件：消息最小长度（默认1，即在数据库端过滤空消息）
+MIN_MESSAGE_LENGTH = int(os.getenv("EXPORT_MIN_MESSAGE_LENGTH", "1"))
+
+# 消息类型列及需要排除的类型（逗号分隔），例如 EXPORT_TYPE_COLUMN=msg_type EXPORT_EXCLUDE_TYPES=image,sticker
+TYPE_COLUMN = os.getenv("EXPORT_TYPE_COLUMN", "")
+EXCLUDE_TYPES = [t.strip() for t in os.getenv("EXPORT_EXCLUDE_TYPES", "").split(",") if t.strip()]
+
+# 额外的原始SQL过滤条件，会原样加入WHERE子句
+EXTRA_WHERE = os.getenv("EXPORT_WHERE", "")
+
+# 并行导出时默认使用的连接数（命令行 --parallel 指定，0或1表示单连接导出）
+PARALLEL_WORKERS = int(os.getenv("EXPORT_PARALLEL_WORKERS", "0"))
+
 def connect_to_mysql_with_retry(max_retries=3, retry_delay=5):
-    """带重试机制的MySQL连接函数"""
+    """带重试机制的MySQL连接函数
+    
+    设置了周期截止时间时，连接超时和重试等待都不超过剩余时间，超过截止时间时抛出 DeadlineExceeded
+    """
     for attempt in range(max_retries):
+        cycle_deadline.check("MySQL连接")
         try:
             print(f"连接尝试 {attempt+1}/{max_retries}...")
-            connection = mysql.connector.connect(**DB_CONFIG)
+            config = dict(DB_CONFIG)
+            config['connect_timeout'] = max(1, int(cycle_deadline.timeout(DB_CONFIG['connect_timeout'])))
+            connection = mysql.connector.connect(**config)
             print("连接成功!")
             return connection
         except mysql.connector.Error as e:
             print(f"连接失败: {e}")
             if attempt < max_retries - 1:
                 print(f"等待 {retry_delay} 秒后重试...")
-                time.sleep(retry_delay)
+                if not cycle_deadline.sleep(retry_delay):
+                    raise DeadlineExceeded("MySQL连接重试已超过本周期的截止时间")
             else:
                 print("达到最大重试次数，放弃连接")
                 raise
@@ -53,40 +103,141 @@ def list_tables(connection):
         print(f"获取表列表时出错: {e}")
         return []
 
-def fetch_data(connection, table_name):
-    """从指定表获取数据"""
+def load_json_file(path, description):
+    """读取JSON文件，文件不存在或损坏时返回空字典"""
+    if not os.path.exists(path):
+        return {}
     try:
-        cursor = connection.cursor(dictionary=True)
-        
-        # 查询表中的所有数据
-        query = f"SELECT * FROM {table_name} ORDER BY id DESC"
-        print(f"执行查询: {query}")
-        cursor.execute(query)
-        
-        # 获取所有行
-        rows = cursor.fetchall()
-        
-        # 获取列名
-        columns = [column[0] for column in cursor.description]
-        
-        cursor.close()
-        
-        print(f"成功从 {table_name} 获取 {len(rows)} 条记录")
-        return rows, columns
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"读取{description}失败: {e}，将忽略该文件")
+        return {}
+
+def save_json_file(data, path):
+    """原子地写入JSON文件"""
+    temp_file = f"{path}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, path)
+
+def load_state(state_file=STATE_FILE):
+    """读取增量导出状态文件"""
+    return load_json_file(state_file, "增量状态文件")
+
+def save_state(state, state_file=STATE_FILE):
+    """原子地写入增量导出状态文件"""
+    save_json_file(state, state_file)
+
+def load_watermark(table_name, state_file=STATE_FILE):
+    """获取指定表已确认的水位线，没有则返回None"""
+    return load_state(state_file).get(table_name, {}).get("committed")
+
+def save_pending_watermark(table_name, watermark, state_file=STATE_FILE):
+    """记录本次导出得到的新水位线，等待下游处理成功后再确认"""
+    state = load_state(state_file)
+    table_state = state.setdefault(table_name, {})
+    table_state["pending"] = watermark
+    save_state(state, state_file)
+    print(f"新的待确认水位线: {watermark}")
+
+def commit_watermark(state_file=STATE_FILE):
+    """将所有表的待确认水位线提升为已确认水位线"""
+    state = load_state(state_file)
+    committed = 0
+    for table_name, table_state in state.items():
+        pending = table_state.pop("pending", None)
+        if pending:
+            table_state["committed"] = pending
+            committed += 1
+            print(f"表 {table_name} 的水位线已确认: {pending}")
+    if committed:
+        save_state(state, state_file)
+    else:
+        print("没有待确认的水位线")
+    return committed
+
+def advance_watermark(watermark, row):
+    """用一行数据推进水位线"""
+    row_id = row.get("id")
+    if row_id is not None and (watermark.get("last_id") is None or row_id > watermark["last_id"]):
+        watermark["last_id"] = row_id
+    if WATERMARK_TIME_COLUMN and row.get(WATERMARK_TIME_COLUMN):
+        row_time = str(row[WATERMARK_TIME_COLUMN])
+        if not watermark.get("last_time") or row_time > watermark["last_time"]:
+            watermark["last_time"] = row_time
+
+def track_watermark(rows, watermark):
+    """在流式读取时边迭代边推进水位线"""
+    for row in rows:
+        advance_watermark(watermark, row)
+        yield row
+
+def build_watermark_filter(watermark):
+    """根据水位线构建过滤条件和参数，没有水位线时返回空条件"""
+    if not watermark or watermark.get("last_id") is None:
+        return "", []
     
-    except mysql.connector.Error as e:
-        print(f"查询数据时出错: {e}")
-        return None, None
+    condition = "id > %s"
+    params = [watermark["last_id"]]
+    if WATERMARK_TIME_COLUMN and watermark.get("last_time"):
+        condition = f"({condition} OR {quote_identifier(WATERMARK_TIME_COLUMN)} > %s)"
+        params.append(watermark["last_time"])
+    return condition, params
+
+def quote_identifier(name):
+    """为MySQL标识符加反引号"""
+    return "`" + name.replace("`", "``") + "`"
+
+def build_select_list(fields, columns):
+    """只选择已识别角色的列（以及水位线需要的列），避免读取无关的大字段"""
+    selected = []
+    for column in [fields.get(role) for role in COLUMN_ROLES] + ["id", WATERMARK_TIME_COLUMN]:
+        if column and column in columns and column not in selected:
+            selected.append(column)
+    return ", ".join(quote_identifier(column) for column in selected)
 
-def format_data_for_txt(data, columns):
-    """将数据格式化为文本格式"""
-    formatted_lines = []
+def build_where_clause(fields, watermark, id_range=None):
+    """组合水位线、id分区范围和配置的过滤条件，下推到数据库执行"""
+    conditions = []
+    params = []
     
-    if not data or not columns:
-        print("没有数据可格式化")
-        return []
+    if id_range:
+        conditions.append("id BETWEEN %s AND %s")
+        params.extend(id_range)
+    
+    watermark_condition, watermark_params = build_watermark_filter(watermark)
+    if watermark_condition:
+        conditions.append(watermark_condition)
+        params.extend(watermark_params)
     
-    # 识别关键字段
+    message_field = fields.get("message") if fields else None
+    if message_field and MIN_MESSAGE_LENGTH > 0:
+        conditions.append(f"CHAR_LENGTH({quote_identifier(message_field)}) >= %s")
+        params.append(MIN_MESSAGE_LENGTH)
+    
+    if TYPE_COLUMN and EXCLUDE_TYPES:
+        placeholders = ", ".join(["%s"] * len(EXCLUDE_TYPES))
+        type_column = quote_identifier(TYPE_COLUMN)
+        conditions.append(f"({type_column} IS NULL OR {type_column} NOT IN ({placeholders}))")
+        params.extend(EXCLUDE_TYPES)
+    
+    if EXTRA_WHERE:
+        conditions.append(f"({EXTRA_WHERE})")
+    
+    if not conditions:
+        return "", []
+    return " WHERE " + " AND ".join(conditions), params
+
+def build_export_query(table_name, watermark=None, fields=None, columns=None, id_range=None):
+    """构建导出查询；提供字段角色时只投影需要的列并下推过滤条件"""
+    select_list = build_select_list(fields, columns) if fields and columns else "*"
+    where_clause, params = build_where_clause(fields, watermark, id_range)
+    query = f"SELECT {select_list} FROM {table_name}{where_clause} ORDER BY id DESC"
+    return query, params
+
+def detect_fields(columns, sample_rows):
+    """识别ID、用户、时间和消息内容字段"""
     id_field = next((col for col in columns if col.lower() == 'id'), None)
     user_field = next((col for col in columns if col.lower() in ['user_id', 'customer', 'user', 'from_user']), None)
     time_field = next((col for col in columns if col.lower() in ['time', 'date', 'timestamp', 'created_at', 'create_time']), None)
@@ -103,7 +254,7 @@ def format_data_for_txt(data, columns):
         print(f"可用字段: {columns}")
         # 尝试找到可能包含文本内容的最长字段
         potential_text_fields = []
-        for row in data[:5]:  # 只检查前5行
+        for row in sample_rows[:5]:  # 只检查前5行
             for col in columns:
                 if isinstance(row[col], str) and len(row[col]) > 10:
                     potential_text_fields.append((col, len(row[col])))
@@ -119,63 +270,339 @@ def format_data_for_txt(data, columns):
             message_field = max(avg_lengths, key=lambda x: x[1])[0]
             print(f"使用 {message_field} 作为消息内容字段")
     
-    # 格式化每一行数据
-    for row in data:
-        line_parts = []
-        
-        # 添加ID
-        if id_field:
-            line_parts.append(f"id:{row[id_field]}")
-        
-        # 添加用户ID (如果存在)
-        if user_field and row[user_field]:
-            line_parts.append(f"user_id:{row[user_field]}")
-        
-        # 添加时间 (如果存在)
-        if time_field and row[time_field]:
-            # 处理不同格式的时间
-            time_value = row[time_field]
-            if isinstance(time_value, datetime):
-                time_str = time_value.strftime("%H:%M:%S")
-            else:
-                time_str = str(time_value)
-            line_parts.append(f"time:{time_str}")
-        
-        # 添加消息内容
-        if message_field and row[message_field]:
-            line_parts.append(f"message:{row[message_field]}")
-        
-        # 将所有部分组合成一行
-        formatted_line = " ".join(line_parts)
-        formatted_lines.append(formatted_line)
+    return {
+        "id": id_field,
+        "user": user_field,
+        "time": time_field,
+        "message": message_field
+    }
+
+def get_table_columns(connection, table_name):
+    """获取表的列名列表（不读取任何数据行）"""
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT * FROM {table_name} LIMIT 0")
+    cursor.fetchall()
+    columns = [column[0] for column in cursor.description]
+    cursor.close()
+    return columns
+
+def fetch_sample_rows(connection, table_name, limit=5):
+    """读取少量样本行，用于在无法按名称识别消息字段时推断字段"""
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute(f"SELECT * FROM {table_name} ORDER BY id DESC LIMIT %s", (limit,))
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+def schema_fingerprint(table_name, columns):
+    """根据表名和列名列表计算表结构指纹"""
+    payload = json.dumps([table_name, list(columns)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def load_role_override(table_name, columns, override_file=COLUMN_ROLES_OVERRIDE):
+    """读取手动指定的字段角色，忽略表中不存在的列"""
+    override = load_json_file(override_file, "字段角色覆盖文件").get(table_name, {})
+    valid = {}
+    for role, column in override.items():
+        if role not in COLUMN_ROLES:
+            print(f"警告: 覆盖文件中的未知字段角色 '{role}' 已忽略")
+        elif column is not None and column not in columns:
+            print(f"警告: 覆盖文件指定的列 '{column}' 不在表 {table_name} 中，已忽略")
+        else:
+            valid[role] = column
+    return valid
+
+def resolve_column_roles(connection, table_name, columns, cache_file=COLUMN_ROLES_CACHE):
+    """解析字段角色：覆盖文件优先，其次是按表结构指纹缓存的结果，最后才自动识别"""
+    override = load_role_override(table_name, columns)
+    if all(role in override for role in COLUMN_ROLES):
+        print(f"使用覆盖文件指定的字段: {override}")
+        return override
+    
+    fingerprint = schema_fingerprint(table_name, columns)
+    cache = load_json_file(cache_file, "字段角色缓存文件")
+    entry = cache.get(table_name)
+    
+    if entry and entry.get("fingerprint") == fingerprint:
+        fields = entry["roles"]
+        print(f"使用缓存的字段识别结果 (指纹 {fingerprint}): {fields}")
+    else:
+        if entry:
+            print(f"表 {table_name} 结构已变化，重新识别字段")
+        fields = detect_fields(columns, fetch_sample_rows(connection, table_name))
+        if fields["message"]:
+            cache[table_name] = {
+                "fingerprint": fingerprint,
+                "columns": list(columns),
+                "roles": fields,
+                "detected_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            }
+            save_json_file(cache, cache_file)
+            print(f"字段识别结果已缓存 (指纹 {fingerprint}): {fields}")
+        else:
+            # 未能识别消息字段（例如表中暂无数据）时不缓存，下次重新识别
+            print("未能识别消息内容字段，本次结果不缓存")
     
-    return formatted_lines
+    fields = dict(fields)
+    fields.update(override)
+    return fields
 
-def save_to_file(formatted_data, filename):
-    """保存格式化的数据到文件"""
-    if not formatted_data:
-        print("没有数据可保存")
+def build_record(row, fields):
+    """将一行数据转换为交接记录"""
+    record = {}
+    
+    # 添加ID
+    if fields["id"]:
+        record["id"] = row[fields["id"]]
+    
+    # 添加用户ID (如果存在)
+    if fields["user"] and row[fields["user"]]:
+        record["user_id"] = row[fields["user"]]
+    
+    # 添加时间 (如果存在)
+    if fields["time"] and row[fields["time"]]:
+        # 处理不同格式的时间；保留日期部分，提取的记录日期和去重时的同日判断都依赖它
+        time_value = row[fields["time"]]
+        if isinstance(time_value, datetime):
+            record["time"] = time_value.strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            record["time"] = str(time_value)
+    
+    # 添加消息内容
+    if fields["message"] and row[fields["message"]]:
+        record["message"] = row[fields["message"]]
+    
+    return record
+
+def iter_records(rows, columns, fields=None, sample_size=5):
+    """逐行生成交接记录，未提供字段角色时只预读少量样本行用于识别字段"""
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, sample_size))
+    if not sample or not columns:
+        print("没有数据可格式化")
         return
-        
+    
+    if fields is None:
+        fields = detect_fields(columns, sample)
+    for row in itertools.chain(sample, rows):
+        yield build_record(row, fields)
+
+def iter_rows(cursor, fetch_size=FETCH_SIZE):
+    """使用fetchmany分块从游标中逐行读取数据，每块之前检查周期截止时间"""
+    while True:
+        cycle_deadline.check("MySQL导出")
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+def stream_data_to_file(connection, table_name, filename, watermark=None, keep_empty=False, fields=None,
+                        columns=None, id_range=None, output_format=None):
+    """使用非缓冲游标流式导出数据，边读取边写入文件，内存占用与总行数无关
+    
+    output_format 为 txt 或 jsonl（默认取 spool.SPOOL_FORMAT）
+    返回 (导出行数, 新水位线)，查询失败时返回 (None, None)；写入失败时删除临时文件后抛出异常，
+    由调用方决定是否退出（并行导出时在工作线程中调用，不能直接退出进程）
+    """
+    new_watermark = dict(watermark or {})
+    writer = spool.open_writer(filename, output_format)
+    
     try:
-        print(f"正在保存数据到文件: {filename}")
+        # 非缓冲游标：结果集留在服务器端，按fetchmany分块拉取
+        cursor = connection.cursor(dictionary=True, buffered=False)
         
-        # 直接覆盖现有文件，不创建备份
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(formatted_data))
+        query, params = build_export_query(table_name, watermark, fields, columns, id_range)
+        print(f"执行流式查询: {query} 参数: {params} (每块 {FETCH_SIZE} 行)")
+        cursor.execute(query, params)
+        result_columns = [column[0] for column in cursor.description]
         
+        rows = track_watermark(iter_rows(cursor), new_watermark)
+        for record in iter_records(rows, result_columns, fields):
+            writer.write(record)
+            if writer.count % 100000 == 0:
+                print(f"已导出 {writer.count} 条记录...")
+        
+        cursor.close()
+    except mysql.connector.Error as e:
+        print(f"流式查询数据时出错: {e}")
+        writer.abort()
+        return None, None
+    except BaseException as e:
+        print(f"保存文件失败: {e!r}")
+        writer.abort()
+        raise
+    
+    row_count = writer.count
+    print(f"成功从 {table_name} 流式导出 {row_count} 条记录")
+    
+    if row_count == 0 and not keep_empty:
+        # 全量导出没有数据时保留原文件
+        writer.abort()
+        print("没有数据可导出")
+    else:
+        writer.commit()
         print(f"数据已成功保存到 {filename}")
         print(f"文件大小: {os.path.getsize(filename)} 字节")
-    except Exception as e:
-        print(f"保存文件失败: {e}")
-        sys.exit(1)
+    
+    new_watermark["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return row_count, new_watermark
+
+def get_id_bounds(connection, table_name, fields, watermark):
+    """获取满足过滤条件的记录的最小id、最大id和总数"""
+    where_clause, params = build_where_clause(fields, watermark)
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT MIN(id), MAX(id), COUNT(*) FROM {table_name}{where_clause}", params)
+    min_id, max_id, total = cursor.fetchone()
+    cursor.close()
+    return min_id, max_id, total
+
+def split_id_range(min_id, max_id, partitions):
+    """按MIN/MAX把id区间均匀切分为若干闭区间"""
+    step = max(1, -(-(max_id - min_id + 1) // partitions))
+    ranges = []
+    low = min_id
+    while low <= max_id:
+        high = min(low + step - 1, max_id)
+        ranges.append((low, high))
+        low = high + 1
+    return ranges
+
+def sample_id_ranges(connection, table_name, fields, watermark, min_id, max_id, total, partitions):
+    """按记录数采样分区边界，id分布不均匀（有大段空洞）时各分区行数更接近"""
+    where_clause, params = build_where_clause(fields, watermark)
+    cursor = connection.cursor()
+    boundaries = []
+    for k in range(1, partitions):
+        cursor.execute(
+            f"SELECT id FROM {table_name}{where_clause} ORDER BY id LIMIT 1 OFFSET %s",
+            params + [total * k // partitions]
+        )
+        row = cursor.fetchone()
+        if row and row[0] > min_id and (not boundaries or row[0] > boundaries[-1]):
+            boundaries.append(row[0])
+    cursor.close()
+    
+    lows = [min_id] + boundaries
+    highs = [boundary - 1 for boundary in boundaries] + [max_id]
+    return list(zip(lows, highs))
+
+def export_partition(table_name, index, id_range, segment_file, watermark, fields, columns, output_format=None):
+    """在独立连接上导出一个id分区到自己的分段文件"""
+    connection = connect_to_mysql_with_retry()
+    try:
+        print(f"分区 {index} 开始导出: id {id_range[0]} - {id_range[1]}")
+        return stream_data_to_file(
+            connection, table_name, segment_file, watermark,
+            keep_empty=True, fields=fields, columns=columns, id_range=id_range, output_format=output_format
+        )
+    finally:
+        connection.close()
+
+def remove_partial_files(filename, segment_files):
+    """删除并行导出的分段文件及合并时的临时文件"""
+    for segment_file in segment_files:
+        spool.remove_file(segment_file)
+    spool.remove_file(f"{filename}.tmp")
+
+def parallel_export(connection, table_name, filename, workers, watermark=None, keep_empty=False,
+                    fields=None, columns=None, sample_boundaries=False, output_format=None):
+    """按id范围分区，用多个连接并行流式导出，最后按id顺序合并
+    
+    返回值与 stream_data_to_file 相同: (导出行数, 新水位线)
+    """
+    min_id, max_id, total = get_id_bounds(connection, table_name, fields, watermark)
+    if not total:
+        print("没有需要并行导出的记录，改用单连接导出")
+        return stream_data_to_file(connection, table_name, filename, watermark, keep_empty, fields, columns,
+                                   output_format=output_format)
+    
+    if sample_boundaries:
+        ranges = sample_id_ranges(connection, table_name, fields, watermark, min_id, max_id, total, workers)
+    else:
+        ranges = split_id_range(min_id, max_id, workers)
+    print(f"共 {total} 条记录 (id {min_id} - {max_id})，分为 {len(ranges)} 个分区，使用 {workers} 个连接并行导出")
+    
+    # 分区按id从大到小排列，合并时即为全局倒序
+    ranges.sort(reverse=True)
+    segment_files = [f"{filename}.part{index:03d}" for index in range(len(ranges))]
+    
+    start_time = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(export_partition, table_name, index, id_range, segment_files[index],
+                                watermark, fields, columns, output_format)
+                for index, id_range in enumerate(ranges)
+            ]
+            results = []
+            for index, future in enumerate(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"分区 {index} 导出失败: {e!r}")
+                    results.append((None, None))
+        
+        if any(row_count is None for row_count, _ in results):
+            print("部分分区导出失败，放弃本次并行导出")
+            remove_partial_files(filename, segment_files)
+            return None, None
+        
+        row_count = sum(count for count, _ in results)
+        if row_count == 0 and not keep_empty:
+            remove_partial_files(filename, segment_files)
+            print("没有数据可导出")
+        else:
+            # 分区已按id从大到小排列，依次拼接即为全局倒序
+            spool.merge_files(segment_files, filename, output_format)
+            print(f"分段文件已合并到 {filename}")
+            print(f"文件大小: {os.path.getsize(filename)} 字节")
+    except BaseException:
+        # 合并失败或被中断时不留下分段文件和合并用的临时文件
+        remove_partial_files(filename, segment_files)
+        raise
+    
+    elapsed = time.time() - start_time
+    print(f"并行导出 {row_count} 条记录，耗时 {elapsed:.2f} 秒 ({row_count / max(elapsed, 1e-6):.0f} 条/秒)")
+    
+    new_watermark = dict(watermark or {})
+    for _, partition_watermark in results:
+        advance_watermark(new_watermark, {
+            "id": partition_watermark.get("last_id"),
+            WATERMARK_TIME_COLUMN: partition_watermark.get("last_time")
+        })
+    new_watermark["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return row_count, new_watermark
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='从MySQL导出聊天数据到文本文件')
+    parser.add_argument('--incremental', action='store_true', help='增量导出，只导出水位线之后的新记录')
+    parser.add_argument('--full', action='store_true', help='强制全量导出，忽略已保存的水位线')
+    parser.add_argument('--commit', action='store_true', help='确认上次导出的水位线（下游处理成功后调用）')
+    parser.add_argument('--parallel', type=int, default=PARALLEL_WORKERS, help='按id范围分区并行导出使用的连接数')
+    parser.add_argument('--format', choices=['txt', 'jsonl'], default=spool.SPOOL_FORMAT,
+                        help='交接文件格式: txt为单行文本(input.txt)，jsonl为每行一条JSON记录(input.jsonl)')
+    parser.add_argument('--sample-boundaries', action='store_true', help='并行导出时按记录数采样分区边界，而不是按MIN/MAX均分')
+    return parser.parse_args()
 
 def main():
     """主函数"""
-    print("开始从MySQL导出数据到文本文件...")
+    args = parse_args()
+    
+    if args.commit:
+        commit_watermark()
+        return
+    
+    incremental = (INCREMENTAL_EXPORT or args.incremental) and not args.full
+    print(f"开始从MySQL导出数据到文本文件... (模式: {'增量' if incremental else '全量'})")
     
     # 连接数据库
-    connection = connect_to_mysql_with_retry()
+    try:
+        connection = connect_to_mysql_with_retry()
+    except DeadlineExceeded as e:
+        print(f"导出取消: {e}")
+        sys.exit(DEADLINE_EXIT_CODE)
     
     try:
         # 列出所有表
@@ -193,19 +620,42 @@ def main():
                 print("数据库中没有表，无法继续")
                 return
         
-        # 获取数据
-        data, columns = fetch_data(connection, table_to_query)
+        # 增量模式下读取上次确认的水位线
+        watermark = load_watermark(table_to_query) if incremental else None
+        if watermark:
+            print(f"使用水位线: {watermark}")
         
-        if data:
-            # 格式化数据
-            formatted_data = format_data_for_txt(data, columns)
-            
-            # 保存到文件
-            save_to_file(formatted_data, OUTPUT_FILE)
-            
-            print("数据导出完成!")
+        # 解析字段角色（表结构不变时直接使用缓存结果）
+        columns = get_table_columns(connection, table_to_query)
+        fields = resolve_column_roles(connection, table_to_query, columns)
+        
+        # 流式导出数据（增量模式下没有新记录时会清空输出文件，避免下游重复处理上一轮的数据）
+        output_file = spool.spool_path(args.format)
+        if args.parallel > 1:
+            row_count, new_watermark = parallel_export(
+                connection, table_to_query, output_file, args.parallel, watermark,
+                keep_empty=incremental, fields=fields, columns=columns,
+                sample_boundaries=args.sample_boundaries, output_format=args.format
+            )
         else:
-            print("没有数据可导出")
+            row_count, new_watermark = stream_data_to_file(
+                connection, table_to_query, output_file, watermark,
+                keep_empty=incremental, fields=fields, columns=columns, output_format=args.format
+            )
+        
+        # 导出失败时以非零状态退出，process_data.sh 不会继续处理上一轮的交接文件
+        if row_count is None:
+            if cycle_deadline.expired():
+                print("导出超过本周期的截止时间，已放弃本次导出")
+                sys.exit(DEADLINE_EXIT_CODE)
+            sys.exit(1)
+        
+        # 记录新的水位线（全量导出同样会刷新水位线，便于之后切换到增量模式）
+        print("数据导出完成!")
+        save_pending_watermark(table_to_query, new_watermark)
+    except DeadlineExceeded as e:
+        print(f"导出取消: {e}")
+        sys.exit(DEADLINE_EXIT_CODE)
     finally:
         # 关闭连接
         connection.close()
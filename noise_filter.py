@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""GPT处理前的本地噪声过滤
+
+问候语、"好的/收到/谢谢"、纯表情、贴图占位符和空消息不会产生任何问题或销售记录，
+在发送给API之前直接丢弃，并按规则统计丢弃数量便于核查。
+
+规则文件（JSON，可选）格式:
+{
+    "keywords": ["好的", "收到"],                 # 整条消息只由这些词组成时视为噪声
+    "patterns": {"order_ack": "^订单已收到$"},      # 规则名 -> 正则，匹配规范化后的消息
+    "replace_defaults": false                      # true 时不再使用内置规则
+}
+"""
+
+import json
+import os
+import re
+from collections import Counter
+
+import spool
+
+# 规则文件路径
+RULES_FILE = os.getenv("NOISE_RULES_FILE", "noise_rules.json")
+
+# 是否启用噪声过滤
+FILTER_ENABLED = os.getenv("NOISE_FILTER", "1") == "1"
+
+# 内置关键词：整条消息只由这些词（可重复组合）构成时视为噪声
+DEFAULT_KEYWORDS = [
+    "好的", "好滴", "好嘞", "好", "嗯嗯", "嗯", "哦哦", "哦", "噢", "恩", "ok", "okay", "行", "可以",
+    "收到", "收到了", "知道了", "明白", "明白了", "了解", "了解了", "没问题",
+    "谢谢", "谢谢你", "谢谢您", "多谢", "感谢", "辛苦了", "辛苦",
+    "你好", "您好", "在吗", "在不在", "在", "早", "早上好", "下午好", "晚上好", "晚安", "再见", "拜拜",
+    "哈哈", "哈", "呵呵", "嘿嘿",
+]
+
+# emoji字符和微信表情/贴图/图片等占位符（如 [微笑][动画表情][图片]）
+EMOJI = r"[\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D]"
+PLACEHOLDER = r"\[[^\[\]]{1,8}\]"
+
+# 内置正则规则，匹配规范化后（去掉空白和标点、转小写）的消息
+DEFAULT_PATTERNS = {
+    "emoji": rf"^{EMOJI}+$",
+    "placeholder": rf"^(?:{PLACEHOLDER})+$",
+}
+
+_PUNCTUATION = re.compile(r"[\s\.,!?;:~，。！？；：、…“”‘’\"'()（）<>《》-]+")
+
+
+def normalize_message(line):
+    """提取消息内容，去掉空白和标点并转为小写（保留方括号以识别表情占位符）"""
+    message = spool.parse_line(line).get("message", "")
+    return _PUNCTUATION.sub("", str(message)).lower()
+
+
+class NoiseFilter:
+    def __init__(self, keywords=None, patterns=None):
+        """编译关键词和正则规则"""
+        keywords = sorted(set(keywords if keywords is not None else DEFAULT_KEYWORDS), key=len, reverse=True)
+        patterns = dict(DEFAULT_PATTERNS if patterns is None else patterns)
+        if keywords:
+            # 关键词之间允许夹杂表情，如 "好的👍" "收到[OK]"
+            alternatives = [re.escape(k.lower()) for k in keywords] + [EMOJI, PLACEHOLDER]
+            patterns["keyword"] = "^(?:" + "|".join(alternatives) + ")+$"
+        self.rules = [(name, re.compile(pattern)) for name, pattern in patterns.items()]
+        self.counts = Counter()
+        self.samples = []
+
+    @classmethod
+    def load(cls, rules_file=RULES_FILE):
+        """从规则文件加载，文件不存在时使用内置规则"""
+        if not rules_file or not os.path.exists(rules_file):
+            return cls()
+
+        with open(rules_file, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+
+        if config.get("replace_defaults"):
+            keywords = config.get("keywords", [])
+            patterns = config.get("patterns", {})
+        else:
+            keywords = DEFAULT_KEYWORDS + config.get("keywords", [])
+            patterns = dict(DEFAULT_PATTERNS, **config.get("patterns", {}))
+        print(f"已加载噪声过滤规则: {rules_file}")
+        return cls(keywords, patterns)
+
+    def reset(self):
+        """清空丢弃统计"""
+        self.counts = Counter()
+        self.samples = []
+
+    def match(self, line):
+        """返回命中的规则名，不是噪声时返回None"""
+        text = normalize_message(line)
+        if not text:
+            return "empty"
+        for name, pattern in self.rules:
+            if pattern.match(text):
+                return name
+        return None
+
+    def filter(self, items, max_samples=20):
+        """过滤 [(行号, 文本行), ...]，返回保留的行号列表，并累计各规则的丢弃数量"""
+        kept = []
+        for idx, line in items:
+            rule = self.match(line)
+            if rule is None:
+                kept.append(idx)
+                continue
+            self.counts[rule] += 1
+            if len(self.samples) < max_samples:
+                self.samples.append({"line": idx + 1, "rule": rule, "text": line[:100]})
+        return kept
+
+    def report(self):
+        """返回丢弃统计，写入结果的metadata用于核查"""
+        return {
+            "dropped": sum(self.counts.values()),
+            "by_rule": dict(self.counts),
+            "samples": self.samples
+        }
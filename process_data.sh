@@ -8,6 +8,15 @@ LOG_DIR="./logs"
 mkdir -p $LOG_DIR
 LOG_FILE="${LOG_DIR}/process_data_$(date '+%Y%m%d').log"
 
+# 周期设置：每CYCLE_INTERVAL秒开始一个周期，每个周期的时间预算为CYCLE_BUDGET秒
+# 各阶段通过环境变量CYCLE_DEADLINE得知截止时间，请求超时由剩余时间推导，超时的阶段保存检查点后以状态码75退出
+CYCLE_INTERVAL=${CYCLE_INTERVAL:-300}
+CYCLE_BUDGET=${CYCLE_BUDGET:-270}
+# 阶段超过截止时间STAGE_GRACE秒仍未退出时强制终止；每个阶段至少可以运行STAGE_MIN_SECONDS秒
+STAGE_GRACE=${STAGE_GRACE:-20}
+STAGE_MIN_SECONDS=${STAGE_MIN_SECONDS:-30}
+DEADLINE_EXIT_CODE=75
+
 # 颜色定义
 GREEN='\033[0;32m'
 RED='\033[0;31m'
@@ -44,8 +53,25 @@ print_warning() {
     log "! $1"
 }
 
+# 在周期截止时间内运行一个阶段，超过截止时间加宽限期后由timeout终止（退出码124）
+run_stage() {
+    local limit=$(( CYCLE_DEADLINE + STAGE_GRACE - $(date +%s) ))
+    if [ $limit -lt $STAGE_MIN_SECONDS ]; then
+        limit=$STAGE_MIN_SECONDS
+    fi
+    timeout --kill-after=10 "$limit" "$@"
+}
+
+# 阶段是否因周期截止时间而退出
+is_deadline_status() {
+    [ "$1" -eq $DEADLINE_EXIT_CODE ] || [ "$1" -eq 124 ] || [ "$1" -eq 137 ]
+}
+
 # 执行单次数据处理流程
 run_data_process() {
+    # 本周期的截止时间，各阶段的Python脚本从环境变量读取
+    export CYCLE_DEADLINE=$(( $(date +%s) + CYCLE_BUDGET ))
+
     # 显示脚本开始信息
     log "================================================"
     log "      客服数据处理流程自动化脚本 v2.0 (后台定时版)"
@@ -55,20 +81,30 @@ run_data_process() {
     # 步骤1: 从MySQL导出数据到TXT
     print_title "步骤1: 从MySQL导出数据到TXT"
     log "执行: python mysql_to_txt.py"
-    if python mysql_to_txt.py >> "$LOG_FILE" 2>&1; then
+    if run_stage python mysql_to_txt.py >> "$LOG_FILE" 2>&1; then
         print_success "MySQL数据成功导出到input.txt"
     else
-        print_error "MySQL数据导出失败，错误代码: $?"
+        status=$?
+        if is_deadline_status $status; then
+            print_warning "MySQL数据导出超过本周期截止时间，已终止"
+        else
+            print_error "MySQL数据导出失败，错误代码: $status"
+        fi
         return 1
     fi
 
     # 步骤2: 使用GPT处理TXT数据并生成JSON
     print_title "步骤2: 使用GPT处理TXT数据并生成JSON"
-    log "执行: python text_to_json.py"
-    if python text_to_json.py >> "$LOG_FILE" 2>&1; then
+    log "执行: python text_to_json.py --resume"
+    if run_stage python text_to_json.py --resume >> "$LOG_FILE" 2>&1; then
         print_success "TXT数据成功处理并生成output.json"
     else
-        print_error "TXT数据处理失败，错误代码: $?"
+        status=$?
+        if is_deadline_status $status; then
+            print_warning "TXT数据处理超过本周期截止时间，已完成的批次保存在检查点中（退出码 $status）"
+        else
+            print_error "TXT数据处理失败，错误代码: $status"
+        fi
         print_warning "本次流程中断，将在下次迭代重试"
         return 1
     fi
@@ -76,7 +112,7 @@ run_data_process() {
     # 步骤3: 将JSON数据导入到SQLite
     print_title "步骤3: 将JSON数据导入到SQLite"
     log "执行: python json_to_sqlite.py"
-    if python json_to_sqlite.py >> "$LOG_FILE" 2>&1; then
+    if run_stage python json_to_sqlite.py >> "$LOG_FILE" 2>&1; then
         print_success "JSON数据成功导入到customer_service.db"
     else
         print_error "JSON数据导入失败，错误代码: $?"
@@ -84,14 +120,28 @@ run_data_process() {
         return 1
     fi
 
+    # 结果已导入SQLite后才确认增量导出的水位线，之前任何一步失败时下次迭代会重新导出这些记录；
+    # 飞书上传失败不影响水位线，未上传的行由下次迭代从数据库中补传
+    log "执行: python mysql_to_txt.py --commit"
+    if python mysql_to_txt.py --commit >> "$LOG_FILE" 2>&1; then
+        print_success "增量导出水位线已确认"
+    else
+        print_warning "增量导出水位线确认失败，下次迭代将重新导出"
+    fi
+
     # 步骤4: 将SQLite数据上传到飞书
     print_title "步骤4: 将SQLite数据上传到飞书"
     log "执行: python sqlite_to_feishu.py"
-    if python sqlite_to_feishu.py --db customer_service.db --config feishu_config.json >> "$LOG_FILE" 2>&1; then
+    if run_stage python sqlite_to_feishu.py --db customer_service.db --config feishu_config.json >> "$LOG_FILE" 2>&1; then
         print_success "SQLite数据成功上传到飞书"
     else
-        print_error "SQLite数据上传失败，错误代码: $?"
-        print_warning "飞书上传失败，但前面的步骤已完成"
+        status=$?
+        if is_deadline_status $status; then
+            print_warning "飞书上传超过本周期截止时间，剩余数据将在下次迭代上传"
+        else
+            print_error "SQLite数据上传失败，错误代码: $status"
+            print_warning "飞书上传失败，但前面的步骤已完成"
+        fi
         return 1
     fi
 
@@ -104,24 +154,29 @@ run_data_process() {
     return 0
 }
 
-# 主循环函数 - 每5分钟执行一次
+# 主循环函数 - 每CYCLE_INTERVAL秒（默认5分钟）开始一次
 main_loop() {
-    log "启动后台定时执行模式，每5分钟执行一次"
+    log "启动后台定时执行模式，每 ${CYCLE_INTERVAL} 秒执行一次，每个周期的时间预算为 ${CYCLE_BUDGET} 秒"
     
     while true; do
-        # 记录迭代开始时间
+        # 记录迭代开始时间，下一次迭代在开始后CYCLE_INTERVAL秒进行，不受本次耗时影响
         ITERATION_START=$(date '+%Y-%m-%d %H:%M:%S')
+        NEXT_START=$(( $(date +%s) + CYCLE_INTERVAL ))
         log "开始新的迭代 - $ITERATION_START"
         
         # 执行数据处理流程
         run_data_process
         
-        # 计算下次执行时间（5分钟后）
-        log "本次执行完成，将在5分钟后再次执行"
-        log "--------------------------------------------"
-        
-        # 休眠5分钟 (300秒)
-        sleep 300
+        # 休眠到下一个周期开始
+        SLEEP_SECONDS=$(( NEXT_START - $(date +%s) ))
+        if [ $SLEEP_SECONDS -gt 0 ]; then
+            log "本次执行完成，将在 ${SLEEP_SECONDS} 秒后再次执行"
+            log "--------------------------------------------"
+            sleep $SLEEP_SECONDS
+        else
+            log "本次执行超过了周期间隔，立即开始下一次迭代"
+            log "--------------------------------------------"
+        fi
     done
 }
 
@@ -138,7 +193,7 @@ elif [ "$1" = "--run-loop" ]; then
 else
     # 显示使用说明
     echo "使用方法:"
-    echo "  $0 --daemon    在后台运行脚本（每5分钟执行一次）"
+    echo "  $0 --daemon    在后台运行脚本（每5分钟执行一次，可用CYCLE_INTERVAL/CYCLE_BUDGET调整）"
     echo "  $0             显示此帮助信息"
     echo ""
     echo "脚本将创建日志文件: $LOG_FILE"
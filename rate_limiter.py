@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Azure OpenAI 调用的共享限流与重试等待
+
+按部署配额（每分钟请求数RPM、每分钟token数TPM）各维护一个令牌桶，所有并发批次共用，
+请求发出前先取得令牌，使整体吞吐保持在配额之下，而不是撞上429后集体重试。
+响应头中的 x-ratelimit-remaining-* 用于校正本地桶的余量，429/5xx 时按
+Retry-After（或带随机抖动的指数退避）等待后重试。
+"""
+
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import cycle_deadline
+
+# 部署配额，0表示不在本地限制（仍然遵循服务端返回的Retry-After和剩余额度）
+RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "0"))
+TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "0"))
+
+# 实际使用配额的比例，留出余量给估算误差和其他调用方
+HEADROOM = float(os.getenv("LLM_RATE_HEADROOM", "0.9"))
+
+# 重试参数
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "2"))
+BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "60"))
+
+# 可以重试的HTTP状态码
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Azure按1秒/10秒的窗口评估配额，桶容量取10秒的配额，避免一分钟的额度在开头一次性打出去
+BURST_SECONDS = 10
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        """per_minute为每分钟补充的数量，容量为BURST_SECONDS秒的额度"""
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * BURST_SECONDS, 1.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """返回取得amount个令牌还需要等待的秒数"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+    def clamp(self, remaining):
+        """服务端报告的剩余额度比本地估计少时，以服务端为准"""
+        self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    def __init__(self, rpm=RPM_LIMIT, tpm=TPM_LIMIT, headroom=HEADROOM):
+        """创建RPM/TPM两个令牌桶，limit为0的桶不启用"""
+        self.lock = threading.Lock()
+        self.requests = TokenBucket(rpm * headroom) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm * headroom) if tpm > 0 else None
+        # 收到429后所有并发批次都暂停到这个时间点
+        self.blocked_until = 0.0
+        self.waited_seconds = 0.0
+        self.throttled = 0
+        self.retries = 0
+
+    def acquire(self, tokens, reserve=0.0):
+        """阻塞直到可以发出一个预计消耗tokens个token的请求
+
+        等待不超过本周期的截止时间（提前reserve秒），到达截止时间时不取令牌，抛出 DeadlineExceeded
+        """
+        while True:
+            left = cycle_deadline.remaining(reserve)
+            if left is not None and left <= 0:
+                raise cycle_deadline.DeadlineExceeded("等待限流超过了本周期的截止时间")
+            with self.lock:
+                now = time.monotonic()
+                wait = self.blocked_until - now
+                if self.requests:
+                    wait = max(wait, self.requests.wait_time(1, now))
+                if self.tokens:
+                    wait = max(wait, self.tokens.wait_time(tokens, now))
+                if wait <= 0:
+                    if self.requests:
+                        self.requests.take(1)
+                    if self.tokens:
+                        self.tokens.take(tokens)
+                    return
+                if left is not None:
+                    wait = min(wait, left)
+                self.waited_seconds += wait
+            time.sleep(wait)
+
+    def settle(self, reserved, used):
+        """请求完成后按实际用量退还多预留的token"""
+        if self.tokens and used is not None and used < reserved:
+            with self.lock:
+                self.tokens.give_back(reserved - used)
+
+    def observe(self, headers):
+        """根据响应头中的剩余额度校正本地令牌桶"""
+        with self.lock:
+            remaining = _header_number(headers, "x-ratelimit-remaining-requests")
+            if self.requests and remaining is not None:
+                self.requests.clamp(remaining)
+            remaining = _header_number(headers, "x-ratelimit-remaining-tokens")
+            if self.tokens and remaining is not None:
+                self.tokens.clamp(remaining)
+
+    def pause(self, seconds):
+        """被限流时让所有并发批次一起暂停"""
+        with self.lock:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def note_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def report(self):
+        """返回限流统计，写入结果的metadata"""
+        return {
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "waited_seconds": round(self.waited_seconds, 3)
+        }
+
+
+def _header_number(headers, name):
+    value = headers.get(name) if headers else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(headers):
+    """解析服务端建议的等待秒数（retry-after-ms 或 Retry-After），没有时返回None"""
+    milliseconds = _header_number(headers, "retry-after-ms")
+    if milliseconds is not None:
+        return milliseconds / 1000.0
+
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    # HTTP日期格式
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """第attempt次重试（从0开始）的等待秒数：指数退避加全抖动，避免并发批次同时重试"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""GPT请求对冲（hedged requests），降低长尾延迟
+
+一个批次的请求超过截止时间（该部署最近请求延迟的第N百分位数）仍未返回时，
+再发送一份相同的请求（可以发往另一个端点或部署），先成功返回的结果生效，另一份被取消:
+- 流式响应在读取下一段数据时停止并关闭连接
+- 非流式请求无法中断正在等待的HTTP调用，其结果被丢弃，也不再重试
+
+对冲请求数不超过普通请求数的 HEDGE_BUDGET 比例，避免服务整体变慢时请求量翻倍。
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+# 是否启用请求对冲
+HEDGE_ENABLED = os.getenv("LLM_HEDGE", "0") == "1"
+
+# 截止时间取最近请求延迟的第几百分位数，至少积累多少个样本后才按分位数计算，之前使用固定的初始截止时间
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_INITIAL_DELAY = float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "60"))
+HEDGE_WINDOW = 200
+
+# 对冲请求占普通请求数的最大比例
+HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.1"))
+
+# 对冲请求的目标，默认与原请求相同；端点不同时可以指定单独的API密钥
+HEDGE_ENDPOINT = os.getenv("LLM_HEDGE_ENDPOINT", "")
+HEDGE_DEPLOYMENT = os.getenv("LLM_HEDGE_DEPLOYMENT", "")
+HEDGE_API_KEY = os.getenv("LLM_HEDGE_API_KEY", "")
+
+
+class HedgeCancelled(Exception):
+    """请求已被对冲的另一份请求取代"""
+
+
+class Attempt:
+    """一次请求（原请求或对冲请求）"""
+
+    def __init__(self, race, hedge):
+        self.race = race
+        self.hedge = hedge
+        self.cancelled = threading.Event()
+
+    def check(self):
+        """已被取消时抛出 HedgeCancelled"""
+        if self.cancelled.is_set():
+            raise HedgeCancelled("请求已被对冲请求取代")
+
+
+class _Race:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = []
+        self.winner = None
+
+    def claim(self, attempt):
+        with self.lock:
+            if self.winner is None:
+                self.winner = attempt
+                for other in self.attempts:
+                    if other is not attempt:
+                        other.cancelled.set()
+            return self.winner is attempt
+
+
+class RequestHedger:
+    def __init__(self, percentile=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES,
+                 initial_delay=HEDGE_INITIAL_DELAY, budget=HEDGE_BUDGET):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.budget = budget
+        self.lock = threading.Lock()
+        # 每个部署最近成功请求的延迟
+        self.latencies = {}
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+
+    def observe(self, key, seconds):
+        """记录一次成功请求的延迟"""
+        with self.lock:
+            self.latencies.setdefault(key, deque(maxlen=HEDGE_WINDOW)).append(seconds)
+
+    def deadline(self, key):
+        """发送对冲请求前等待的秒数"""
+        with self.lock:
+            return self._deadline(key)
+
+    def _deadline(self, key):
+        samples = sorted(self.latencies.get(key, ()))
+        if len(samples) < self.min_samples:
+            return self.initial_delay
+        rank = max(1, -(-len(samples) * self.percentile // 100))
+        return samples[int(rank) - 1]
+
+    def _reserve(self):
+        with self.lock:
+            if self.hedged + 1 > max(1.0, self.budget * self.calls):
+                self.over_budget += 1
+                return False
+            self.hedged += 1
+            return True
+
+    def run(self, key, call, succeeded):
+        """执行 call(attempt)，超过截止时间仍未返回时发送对冲请求 call(对冲attempt)
+
+        succeeded(结果) 判断结果是否成功；返回第一个成功的结果，
+        所有请求都失败时返回原请求的结果
+        """
+        with self.lock:
+            self.calls += 1
+        race = _Race()
+        results = queue.Queue()
+        started = time.time()
+
+        def start(hedge):
+            attempt = Attempt(race, hedge)
+            with race.lock:
+                race.attempts.append(attempt)
+
+            def target():
+                try:
+                    result = call(attempt)
+                except Exception as e:
+                    result = e
+                results.put((attempt, result, time.time() - started))
+
+            threading.Thread(target=target, daemon=True).start()
+            return attempt
+
+        primary = start(False)
+        pending = 1
+        hedge = None
+        failures = {}
+        deadline = self.deadline(key)
+
+        while True:
+            timeout = None
+            if hedge is None:
+                timeout = max(0.0, started + deadline - time.time())
+            try:
+                attempt, result, elapsed = results.get(timeout=timeout)
+            except queue.Empty:
+                # 超过截止时间: 预算允许时发送对冲请求，否则只等待原请求
+                if race.winner is None and self._reserve():
+                    print(f"请求 {time.time() - started:.1f} 秒未返回（截止时间 {deadline:.1f} 秒），发送对冲请求")
+                    hedge = start(True)
+                    pending += 1
+                else:
+                    hedge = False
+                continue
+
+            pending -= 1
+            ok = not isinstance(result, Exception) and succeeded(result)
+            if race.winner is attempt or (race.winner is None and ok and race.claim(attempt)):
+                if ok:
+                    self.observe(key, elapsed)
+                if attempt.hedge:
+                    with self.lock:
+                        self.hedge_wins += 1
+                    print(f"对冲请求先返回，用时 {elapsed:.1f} 秒")
+                return self._unwrap(result)
+            failures[attempt] = result
+            if pending == 0:
+                return self._unwrap(failures.get(primary, result))
+
+    @staticmethod
+    def _unwrap(result):
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def report(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "over_budget": self.over_budget,
+                "deadlines": {key: round(self._deadline(key), 3) for key in self.latencies}
+            }
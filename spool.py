@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MySQL导出与GPT处理之间的交接文件（spool）
+
+支持两种格式：
+- txt:   原有的 "id:.. user_id:.. time:.. message:.." 单行文本格式 (input.txt)
+- jsonl: 每行一条紧凑JSON记录 (input.jsonl)，消息中的换行、分隔符等由JSON转义，不会破坏行格式
+
+GPT处理阶段的去重、缓存、打包都需要所有行，两种格式都一次性读入内存。
+"""
+
+import json
+import os
+import shutil
+
+# 交接文件格式：txt 或 jsonl
+SPOOL_FORMAT = os.getenv("SPOOL_FORMAT", "txt")
+
+# 两种格式对应的文件路径
+TXT_FILE = 'input.txt'
+JSONL_FILE = os.getenv("SPOOL_FILE", "input.jsonl")
+
+
+def spool_path(spool_format=None):
+    """返回指定格式的交接文件路径"""
+    return JSONL_FILE if (spool_format or SPOOL_FORMAT) == 'jsonl' else TXT_FILE
+
+
+def format_record(record):
+    """将一条记录渲染为单行文本，消息中的换行会被替换为空格"""
+    line_parts = []
+
+    if record.get("id") is not None:
+        line_parts.append(f"id:{record['id']}")
+    if record.get("user_id"):
+        line_parts.append(f"user_id:{record['user_id']}")
+    if record.get("time"):
+        line_parts.append(f"time:{record['time']}")
+    if record.get("message"):
+        message = " ".join(str(record["message"]).splitlines())
+        line_parts.append(f"message:{message}")
+
+    return " ".join(line_parts)
+
+
+def parse_line(line):
+    """将单行文本解析回记录，无法识别的行整行作为message"""
+    record = {}
+    rest = line.strip()
+
+    for key in ("id", "user_id"):
+        if rest.startswith(f"{key}:"):
+            value, _, rest = rest[len(key) + 1:].partition(" ")
+            record[key] = value
+
+    if rest.startswith("time:"):
+        time_value, sep, message = rest[5:].partition(" message:")
+        record["time"] = time_value.strip()
+        rest = f"message:{message}" if sep else ""
+
+    if rest.startswith("message:"):
+        record["message"] = rest[8:]
+    elif rest:
+        record["message"] = rest
+
+    return record
+
+
+class TextWriter:
+    """写入原有的单行文本格式"""
+
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.file = open(self.temp_path, 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, record):
+        if self.count:
+            self.file.write('\n')
+        self.file.write(format_record(record))
+        self.count += 1
+
+    def commit(self):
+        """写完后再替换，下游不会读到写了一半的文件"""
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class SpoolWriter:
+    """写入JSONL格式"""
+
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.file = open(self.temp_path, 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + '\n')
+        self.count += 1
+
+    def commit(self):
+        """写完后再替换，下游不会读到写了一半的文件"""
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def open_writer(path, spool_format=None):
+    """按格式创建写入器"""
+    if (spool_format or SPOOL_FORMAT) == 'jsonl':
+        return SpoolWriter(path)
+    return TextWriter(path)
+
+
+def merge_files(segment_paths, path, spool_format=None):
+    """按给定顺序合并分段文件，合并后删除分段"""
+    jsonl = (spool_format or SPOOL_FORMAT) == 'jsonl'
+    temp_path = f"{path}.tmp"
+    wrote_any = False
+    with open(temp_path, 'w', encoding='utf-8') as out:
+        for segment_path in segment_paths:
+            if os.path.getsize(segment_path) == 0:
+                continue
+            # txt格式的行之间用换行分隔，最后一行没有换行；jsonl每条记录自带换行
+            if wrote_any and not jsonl:
+                out.write('\n')
+            with open(segment_path, 'r', encoding='utf-8') as f:
+                shutil.copyfileobj(f, out)
+            wrote_any = True
+    os.replace(temp_path, path)
+    for segment_path in segment_paths:
+        os.remove(segment_path)
+
+
+def remove_file(path):
+    """删除数据文件（如果存在）"""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def read_lines(path, spool_format=None):
+    """读取交接文件，返回渲染后的文本行列表；jsonl格式每条记录只解析一次"""
+    if (spool_format or SPOOL_FORMAT) == 'jsonl':
+        with open(path, 'r', encoding='utf-8') as f:
+            return [format_record(json.loads(line)) for line in f if line.strip()]
+    with open(path, 'r', encoding='utf-8') as f:
+        text_data = f.read()
+    return text_data.strip().split('\n') if text_data.strip() else []
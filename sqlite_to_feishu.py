@@ -8,6 +8,35 @@ import os
 import sys
 import subprocess
 
+import cycle_deadline
+from cycle_deadline import DeadlineExceeded, DEADLINE_EXIT_CODE
+
+# 追加模式: 不删除表格中的现有记录，只上传数据库中尚未上传的行（id大于已上传的最大id）；
+# 否则先清空表格再上传全部数据。默认跟随增量导出设置，命令行 --append / --replace 可覆盖
+APPEND_UPLOAD = os.getenv("UPLOAD_APPEND", os.getenv("EXPORT_INCREMENTAL", "0")) == "1"
+
+# 记录每个表已上传到飞书的最大行id
+UPLOAD_STATE_FILE = os.getenv("FEISHU_UPLOAD_STATE", "feishu_upload_state.json")
+
+def load_upload_state():
+    """读取已上传的最大行id: {"issues": id, "sales": id}"""
+    try:
+        with open(UPLOAD_STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return {"issues": int(state.get("issues", 0)), "sales": int(state.get("sales", 0))}
+    except FileNotFoundError:
+        return {"issues": 0, "sales": 0}
+    except (ValueError, TypeError, AttributeError) as e:
+        print(f"警告: 无法读取上传状态文件 {UPLOAD_STATE_FILE}: {e}，将从头上传")
+        return {"issues": 0, "sales": 0}
+
+def save_upload_state(state):
+    """原子地保存已上传的最大行id"""
+    temp_file = f"{UPLOAD_STATE_FILE}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(temp_file, UPLOAD_STATE_FILE)
+
 class FeishuUploader:
     def __init__(self, config_path="feishu_config.json"):
         """初始化飞书上传器"""
@@ -35,6 +64,25 @@ class FeishuUploader:
         self.initial_retry_delay = 2  # 初始重试延迟（秒）
         self.max_retry_delay = 30  # 最大重试延迟（秒）
         
+        # 请求超时（秒），设置了周期截止时间时不超过剩余时间
+        self.connect_timeout = 10
+        self.read_timeout = 30
+        self.token_refresh_timeout = 60
+        
+        # 已上传到飞书的最大行id，每成功上传一批后更新
+        self.upload_state = load_upload_state()
+    
+    def _mark_uploaded(self, kind, batch_rows):
+        """记录一批已上传行中的最大id（行来自read_from_sqlite，带有id字段）"""
+        ids = [row["id"] for row in batch_rows if row.get("id") is not None]
+        if ids:
+            self.upload_state[kind] = max(ids)
+            save_upload_state(self.upload_state)
+    
+    def _timeout(self):
+        """每个请求的 (连接超时, 读取超时)"""
+        return cycle_deadline.request_timeout(self.connect_timeout, self.read_timeout)
+        
     def _refresh_token_with_manager(self):
         """使用token_manager.py刷新令牌"""
         print("令牌已过期，使用token_manager.py刷新...")
@@ -44,7 +92,8 @@ class FeishuUploader:
             
             # 运行token_manager.py来更新令牌
             result = subprocess.run([sys.executable, token_manager_path, "--force"], 
-                                   check=True, capture_output=True, text=True)
+                                   check=True, capture_output=True, text=True,
+                                   timeout=cycle_deadline.timeout(self.token_refresh_timeout))
             
             print(result.stdout)
             
@@ -56,6 +105,9 @@ class FeishuUploader:
             self.token_expires_at = config.get('token_expires_at', 0)
             print(f"令牌已刷新: {self.access_token[:10]}...{self.access_token[-10:]}")
             
+        except subprocess.TimeoutExpired:
+            print("刷新令牌超时")
+            raise Exception("无法刷新飞书访问令牌")
         except subprocess.CalledProcessError as e:
             print(f"刷新令牌失败: {e}")
             if e.stdout:
@@ -64,15 +116,19 @@ class FeishuUploader:
                 print(f"错误: {e.stderr}")
             raise Exception("无法刷新飞书访问令牌")
             
-    def upload_issues_to_feishu(self, issues_data):
-        """将问题反馈数据上传到飞书表格"""
+    def upload_issues_to_feishu(self, issues_data, append=False):
+        """将问题反馈数据上传到飞书表格
+        
+        append为True时不删除现有记录，遇到上传失败的批次即停止，剩余数据由下一次上传补齐
+        """
         if not issues_data:
             print("没有问题反馈数据需要上传")
             return 0
         
-        # 先删除现有记录
-        print("正在删除问题反馈表中的现有记录...")
-        self.delete_all_records(self.issues_table_id)
+        # 替换模式: 先删除现有记录
+        if not append:
+            print("正在删除问题反馈表中的现有记录...")
+            self.delete_all_records(self.issues_table_id)
         
         if not self.bitable_id:
             raise ValueError("未提供多维表格ID")
@@ -135,19 +191,28 @@ class FeishuUploader:
             
             if success:
                 success_count += len(batch_records)
+                self._mark_uploaded("issues", issues_data[i:i+self.batch_size])
+            elif append:
+                # 追加模式按id顺序上传，失败的批次及之后的数据留到下一次上传
+                print(f"问题反馈数据批次 {batch_num} 上传失败，剩余数据将在下一次上传")
+                break
         
         print(f"问题反馈数据上传完成: 成功 {success_count}/{len(records)} 条")
         return success_count
     
-    def upload_sales_to_feishu(self, sales_data):
-        """将销售数据上传到飞书表格"""
+    def upload_sales_to_feishu(self, sales_data, append=False):
+        """将销售数据上传到飞书表格
+        
+        append为True时不删除现有记录，遇到上传失败的批次即停止，剩余数据由下一次上传补齐
+        """
         if not sales_data:
             print("没有销售数据需要上传")
             return 0
         
-        # 先删除现有记录
-        print("正在删除销售数据表中的现有记录...")
-        self.delete_all_records(self.sales_table_id)
+        # 替换模式: 先删除现有记录
+        if not append:
+            print("正在删除销售数据表中的现有记录...")
+            self.delete_all_records(self.sales_table_id)
         
         if not self.bitable_id:
             raise ValueError("未提供多维表格ID")
@@ -197,6 +262,11 @@ class FeishuUploader:
             
             if success:
                 success_count += len(batch_records)
+                self._mark_uploaded("sales", sales_data[i:i+self.batch_size])
+            elif append:
+                # 追加模式按id顺序上传，失败的批次及之后的数据留到下一次上传
+                print(f"销售数据批次 {batch_num} 上传失败，剩余数据将在下一次上传")
+                break
         
         print(f"销售数据上传完成: 成功 {success_count}/{len(records)} 条")
         return success_count
@@ -204,6 +274,8 @@ class FeishuUploader:
     def _upload_batch_with_retry(self, url, headers, data, batch_desc):
         """带重试机制的批量上传"""
         for retry in range(self.max_retries):
+            # 超过周期截止时间后不再开始新的请求
+            cycle_deadline.check(f"上传{batch_desc}")
             try:
                 # 检查并刷新令牌
                 if retry > 0:
@@ -211,7 +283,7 @@ class FeishuUploader:
                     self._refresh_token_with_manager()
                     headers["Authorization"] = f"Bearer {self.access_token}"
                 
-                response = requests.post(url, headers=headers, json=data)
+                response = requests.post(url, headers=headers, json=data, timeout=self._timeout())
                 response_data = response.json()
                 
                 if response_data.get("code") == 0:
@@ -240,22 +312,24 @@ class FeishuUploader:
                         wait_time = self.initial_retry_delay * (2 ** retry)
                         wait_time = min(wait_time, self.max_retry_delay)
                         print(f"检测到API限流，等待 {wait_time} 秒后重试...")
-                        time.sleep(wait_time)
+                        cycle_deadline.sleep(wait_time)
                     else:
                         # 其他错误，等待较短时间
                         wait_time = self.initial_retry_delay * (retry + 1)
                         print(f"将在 {wait_time} 秒后重试 ({retry+1}/{self.max_retries})...")
-                        time.sleep(wait_time)
+                        cycle_deadline.sleep(wait_time)
+            except DeadlineExceeded:
+                raise
             except Exception as e:
                 print(f"上传{batch_desc}时出错: {e}")
                 try:
                     wait_time = self.initial_retry_delay * (retry + 1)
                     print(f"将在 {wait_time} 秒后重试 ({retry+1}/{self.max_retries})...")
-                    time.sleep(wait_time)
+                    cycle_deadline.sleep(wait_time)
                 except AttributeError:
                     # 防御性编程：如果initial_retry_delay不存在
                     print(f"将在 {(retry+1)*2} 秒后重试 ({retry+1}/{self.max_retries})...")
-                    time.sleep((retry+1)*2)
+                    cycle_deadline.sleep((retry+1)*2)
         
         print(f"上传{batch_desc}失败，已达到最大重试次数")
         return False
@@ -280,8 +354,9 @@ class FeishuUploader:
             if page_token:
                 params["page_token"] = page_token
             
+            cycle_deadline.check("获取记录")
             try:
-                response = requests.get(url, headers=headers, params=params)
+                response = requests.get(url, headers=headers, params=params, timeout=self._timeout())
                 response_data = response.json()
                 
                 if response_data.get("code") == 0:
@@ -331,8 +406,9 @@ class FeishuUploader:
             }
             
             for retry in range(self.max_retries):
+                cycle_deadline.check(f"删除批次 {batch_num}")
                 try:
-                    response = requests.post(url, headers=headers, json=data)
+                    response = requests.post(url, headers=headers, json=data, timeout=self._timeout())
                     response_data = response.json()
                     
                     if response_data.get("code") == 0:
@@ -346,13 +422,13 @@ class FeishuUploader:
                         continue
                     else:
                         print(f"删除批次 {batch_num} 失败: {response_data}")
-                        time.sleep(2 * (retry + 1))
+                        cycle_deadline.sleep(2 * (retry + 1))
                 except Exception as e:
                     print(f"删除批次 {batch_num} 时出错: {e}")
-                    time.sleep(2 * (retry + 1))
+                    cycle_deadline.sleep(2 * (retry + 1))
             
             # 批次间暂停，避免API限流
-            time.sleep(1)
+            cycle_deadline.sleep(1)
         
         print(f"删除完成: 成功 {success_count}/{len(all_record_ids)} 条")
         return success_count
@@ -364,7 +440,7 @@ class FeishuUploader:
         data = {"app_id": self.app_id, "app_secret": self.app_secret}
         
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = requests.post(url, headers=headers, json=data, timeout=self._timeout())
             result = response.json()
             
             if response.status_code == 200 and result.get("code") == 0:
@@ -388,7 +464,7 @@ class FeishuUploader:
         }
         
         try:
-            response = requests.get(url, headers=headers)
+            response = requests.get(url, headers=headers, timeout=self._timeout())
             result = response.json()
             
             if response.status_code == 200 and result.get("code") == 0:
@@ -413,17 +489,22 @@ class FeishuUploader:
             print(f"❌ 测试权限时出错: {e}")
             return False
 
-def read_from_sqlite(db_file):
-    """从SQLite数据库读取数据"""
+def read_from_sqlite(db_file, after=None):
+    """从SQLite数据库读取数据
+    
+    after为 {"issues": id, "sales": id} 时只读取id更大的行（追加模式下尚未上传的行），按id排序
+    """
+    after = after or {}
     conn = sqlite3.connect(db_file)
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     
     # 读取问题反馈数据
-    cursor.execute("SELECT * FROM issues")
+    cursor.execute("SELECT * FROM issues WHERE id > ? ORDER BY id", (after.get("issues", 0),))
     issues = []
     for row in cursor.fetchall():
         issue = {
+            "id": row["id"],
             "date": row["date"],
             "issue_type": row["issue_type"],
             "description": row["description"],
@@ -435,10 +516,11 @@ def read_from_sqlite(db_file):
         issues.append(issue)
     
     # 读取销售数据
-    cursor.execute("SELECT * FROM sales")
+    cursor.execute("SELECT * FROM sales WHERE id > ? ORDER BY id", (after.get("sales", 0),))
     sales = []
     for row in cursor.fetchall():
         sale = {
+            "id": row["id"],
             "date": row["date"],
             "region": row["region"],
             "product": row["product"],
@@ -460,6 +542,10 @@ def main():
     parser.add_argument('--db', default='customer_service.db', help='SQLite数据库文件路径')
     parser.add_argument('--config', default='feishu_config.json', help='飞书配置文件路径')
     parser.add_argument('--debug', action='store_true', help='启用调试模式')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--append', dest='append', action='store_true', default=APPEND_UPLOAD,
+                      help='只追加尚未上传的行，不删除表格中的现有记录（增量导出时的默认模式）')
+    mode.add_argument('--replace', dest='append', action='store_false', help='清空表格后上传全部数据')
     
     args = parser.parse_args()
     
@@ -497,8 +583,8 @@ def main():
     
     # 读取SQLite数据
     try:
-        print(f"正在从SQLite数据库读取数据: {args.db}")
-        data = read_from_sqlite(args.db)
+        print(f"正在从SQLite数据库读取数据: {args.db} (模式: {'追加' if args.append else '替换'})")
+        data = read_from_sqlite(args.db, load_upload_state() if args.append else None)
         print(f"成功读取数据: 问题反馈 {len(data['issues'])} 条, 销售数据 {len(data['sales'])} 条")
     except Exception as e:
         print(f"读取SQLite数据时出错: {e}")
@@ -521,12 +607,12 @@ def main():
         # 上传问题反馈数据
         issues_count = 0
         if issues_table_id and data["issues"]:
-            issues_count = uploader.upload_issues_to_feishu(data["issues"])
+            issues_count = uploader.upload_issues_to_feishu(data["issues"], append=args.append)
         
         # 上传销售数据
         sales_count = 0
         if sales_table_id and data["sales"]:
-            sales_count = uploader.upload_sales_to_feishu(data["sales"])
+            sales_count = uploader.upload_sales_to_feishu(data["sales"], append=args.append)
         
         end_time = time.time()
         duration = end_time - start_time
@@ -540,6 +626,10 @@ def main():
         print("="*50)
         
         print("\n数据上传完成!")
+    except DeadlineExceeded as e:
+        # 替换模式每个周期重新上传全部数据，追加模式从已上传的最大id继续，未完成的部分由下一个周期补齐
+        print(f"上传取消: {e}，剩余数据将在下一个周期上传")
+        sys.exit(DEADLINE_EXIT_CODE)
     except Exception as e:
         print(f"上传数据到飞书时出错: {e}")
         import traceback
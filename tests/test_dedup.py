@@ -0,0 +1,11 @@
+import dedup
+
+
+def test_cluster_lines_merges_only_same_date():
+    """导出的时间带日期时，相同的消息只在同一天内合并"""
+    lines = [
+        "id:1 time:2025-03-01 09:00:00 message:电池无法充电，需要售后处理",
+        "id:2 time:2025-03-01 15:30:00 message:电池无法充电，需要售后处理",
+        "id:3 time:2025-03-02 09:00:00 message:电池无法充电，需要售后处理",
+    ]
+    assert dedup.cluster_lines(list(enumerate(lines))) == {0: [1], 2: []}
@@ -0,0 +1,26 @@
+import time
+
+import pytest
+
+import cycle_deadline
+from rate_limiter import RateLimiter
+
+
+@pytest.fixture
+def deadline():
+    yield cycle_deadline.set_deadline
+    cycle_deadline.set_deadline(None)
+
+
+def test_acquire_stops_waiting_at_cycle_deadline(deadline):
+    """Retry-After暂停比剩余时间长时，等到截止时间就抛出DeadlineExceeded，不取走预留的token"""
+    limiter = RateLimiter(rpm=0, tpm=600)
+    limiter.pause(60)
+    level = limiter.tokens.level
+    deadline(0.2)
+
+    started = time.monotonic()
+    with pytest.raises(cycle_deadline.DeadlineExceeded):
+        limiter.acquire(10)
+    assert time.monotonic() - started < 5
+    assert limiter.tokens.level == level
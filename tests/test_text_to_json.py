@@ -0,0 +1,155 @@
+import json
+
+import pytest
+
+import text_to_json
+
+
+def _issue(source_line, description):
+    return {
+        "source_line": source_line, "date": "2025/03/01", "issue_type": "其他", "description": description,
+        "urgency": "中", "completion": 0, "status": "未处理", "negative_feedback": "否"
+    }
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """在临时目录中运行，不读写提取缓存和本地分类器样本，隔离文件写入临时目录"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(text_to_json, "MEMO_FILE", "")
+    monkeypatch.setattr(text_to_json, "CLASSIFIER_ENABLED", False)
+    monkeypatch.setattr(text_to_json, "OUTPUT_FORMAT", "json")
+    monkeypatch.setattr(text_to_json, "QUARANTINE_FILE", str(tmp_path / "quarantine.jsonl"))
+    return tmp_path
+
+
+def test_main_writes_output_when_only_quarantined_lines(workdir, monkeypatch):
+    """只有被隔离的行（内容过滤）时写出结果并正常退出，重复运行结果相同"""
+    messages = ["电池无法充电，需要售后处理", "BAD 这一行会被内容过滤拒绝", "物流延误了三天还没有到货"]
+    (workdir / "input.txt").write_text(
+        "\n".join(f"id:{n} time:10:00:00 message:{message}" for n, message in enumerate(messages, 1)),
+        encoding="utf-8")
+
+    def fake_route(self, batch_lines, batch_text, company_name):
+        if "BAD" in batch_text:
+            return {"error": "内容过滤", "error_kind": "content_filter"}
+        issues = [_issue(n, line.split("message:", 1)[1]) for n, line in enumerate(batch_lines, 1)]
+        return {"issues": issues, "sales": []}
+
+    monkeypatch.setattr(text_to_json.TextProcessor, "_route_text", fake_route)
+
+    for resume in (False, True):
+        text_to_json.main(resume=resume)
+
+        with open(workdir / "output.json", encoding="utf-8") as f:
+            result = json.load(f)
+        assert [issue["description"] for issue in result["issues"]] == [messages[0], messages[2]]
+        assert result["metadata"]["quarantined_lines"] == 1
+        assert result["metadata"]["batches_failed"] == 0
+        assert result["metadata"]["batches_partial"] == 0
+        (workdir / "output.json").unlink()
+
+    with open(workdir / "quarantine.jsonl", encoding="utf-8") as f:
+        quarantined = [json.loads(line) for line in f]
+    assert {entry["line"] for entry in quarantined} == {2}
+
+
+def test_main_exits_nonzero_when_batches_fail(workdir, monkeypatch):
+    """可重试的失败（如服务端错误）不写出结果，以非零状态退出"""
+    (workdir / "input.txt").write_text("id:1 time:10:00:00 message:电池无法充电，需要售后处理", encoding="utf-8")
+
+    def failing_route(self, batch_lines, batch_text, company_name):
+        return {"error": "服务端错误", "error_kind": "server_error"}
+
+    monkeypatch.setattr(text_to_json.TextProcessor, "_route_text", failing_route)
+
+    with pytest.raises(SystemExit) as exit_info:
+        text_to_json.main()
+    assert exit_info.value.code == 1
+    assert not (workdir / "output.json").exists()
+
+
+def test_salvage_keeps_issues_when_truncated_inside_issues(workdir, monkeypatch):
+    """截断发生在issues数组中: 保留已完整的issues记录，只重新处理不完整的行和类型"""
+    messages = ["电池无法充电，需要售后处理", "物流延误了三天还没有到货", "华东区本月销量120台", "客户投诉包装破损"]
+    lines = [f"id:{n} time:10:00:00 message:{message}" for n, message in enumerate(messages, 1)]
+    requests_seen = []
+
+    def fake_route(self, batch_lines, batch_text, company_name):
+        requests_seen.append(len(batch_lines))
+        if len(requests_seen) == 1:
+            # 第一次请求的响应在第3条issue中间被截断，sales数组还没有开始
+            complete = [_issue(n, f"原响应{n}") for n in (1, 2)]
+            text = json.dumps({"issues": complete}, ensure_ascii=False)[:-2] + ', {"source_line": 3, "desc'
+            records, incomplete = text_to_json.salvage(text)
+            records["incomplete"] = incomplete
+            return records
+        issues = [_issue(n, f"重新处理{line}") for n, line in enumerate(batch_lines, 1) if "销量" not in line]
+        sales = [{"source_line": n, "date": "2025/03/01", "region": "华东", "product": "", "sales_count": 120}
+                 for n, line in enumerate(batch_lines, 1) if "销量" in line]
+        return {"issues": issues, "sales": sales}
+
+    monkeypatch.setattr(text_to_json.TextProcessor, "_route_text", fake_route)
+    processor = text_to_json.TextProcessor()
+    processor.dedup_mode = "off"
+    processor.noise_filter = None
+    try:
+        result = processor.process_lines_in_batches(lines)
+    finally:
+        processor.close()
+
+    descriptions = [issue["description"] for issue in result["issues"]]
+    # 第1行的issue来自原响应，第2行及之后的issue来自重新处理，不重复
+    assert descriptions[0] == "原响应1"
+    assert len(descriptions) == 3
+    assert all(description.startswith("重新处理") for description in descriptions[1:])
+    assert len(result["sales"]) == 1
+    assert result["metadata"]["batches_failed"] == 0
+    assert result["metadata"]["batches_partial"] == 0
+    # 所有行的sales都不完整，拆成两半重新处理，而不是原样重发整个批次
+    assert requests_seen[0] == 4 and max(requests_seen[1:]) < 4
+
+
+class _BrokenStream:
+    """流式响应在读取途中断开；内容已被消费，读取 text 会抛出RuntimeError"""
+    status_code = 200
+    headers = {}
+
+    def iter_lines(self):
+        yield b'data: {"choices": [{"delta": {"content": "{\\"issues\\": ["}}]}'
+        raise RuntimeError("连接中断")
+
+    @property
+    def text(self):
+        raise RuntimeError("The content for this response was already consumed")
+
+    def close(self):
+        pass
+
+
+def test_stream_error_returns_error_result(workdir, monkeypatch):
+    """流式响应读取失败时返回错误结果，而不是在读取 response.text 时抛出异常"""
+    processor = text_to_json.TextProcessor()
+    processor.stream = True
+    monkeypatch.setattr(processor.session, "post", lambda *args, **kwargs: _BrokenStream())
+    try:
+        result = processor.process_text("id:1 time:10:00:00 message:电池无法充电")
+    finally:
+        processor.close()
+
+    assert result["error_kind"] == "invalid_response"
+    assert result["raw_response"] is None
+
+
+def test_main_closes_processor_for_empty_input(workdir, monkeypatch):
+    """输入为空时写出空结果，并关闭用于保存的TextProcessor"""
+    (workdir / "input.txt").write_text("", encoding="utf-8")
+    closed = []
+    close = text_to_json.TextProcessor.close
+    monkeypatch.setattr(text_to_json.TextProcessor, "close", lambda self: closed.append(self) or close(self))
+
+    text_to_json.main()
+
+    with open(workdir / "output.json", encoding="utf-8") as f:
+        assert json.load(f)["metadata"]["total_records"] == 0
+    assert len(closed) == 1
@@ -4,14 +4,82 @@
 import json
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 import sys
-import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# 固定的输入和输出文件
-INPUT_FILE = 'input.txt'
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+import copy
+import random
+import re
+
+import spool
+import dedup
+import compact_schema
+import model_router
+import cycle_deadline
+from cycle_deadline import DeadlineExceeded, DEADLINE_EXIT_CODE
+from model_router import ModelRouter, FAST_DEPLOYMENT
+from request_hedger import RequestHedger, HedgeCancelled, HEDGE_ENABLED, HEDGE_ENDPOINT, HEDGE_DEPLOYMENT, \
+    HEDGE_API_KEY
+from noise_filter import NoiseFilter, FILTER_ENABLED
+from batch_checkpoint import BatchCheckpoint
+from extraction_memo import ExtractionMemo, MEMO_FILE
+from local_classifier import LocalClassifier, ExampleLog, example_from_records, CLASSIFIER_ENABLED, \
+    CONFIDENCE_THRESHOLD, EXAMPLES_FILE, MODEL_FILE
+import rate_limiter
+from rate_limiter import RateLimiter
+from json_stream import RecordStreamParser, iter_sse_data, salvage
+from jsonl_output import JsonlOutputWriter, OUTPUT_FORMAT, JSONL_OUTPUT_FILE
+
+# 固定的输入和输出文件（SPOOL_FORMAT=jsonl 时从 spool.JSONL_FILE 读取）
+INPUT_FILE = spool.TXT_FILE
 OUTPUT_FILE = 'output.json'
 
+# 提示词版本，修改提示词或输出格式时需要更新，使旧的提取缓存失效
+PROMPT_VERSION = "2025-03-v2"
+
+# 系统消息（标准模式）
+SYSTEM_PROMPT = "你是一个专业的数据分析助手，擅长从文本中提取结构化信息并生成符合特定格式的JSON数据。"
+
+# 这些失败与批次中的具体内容有关，拆分批次重试可以隔离出问题行
+BISECT_ERRORS = {"truncated", "content_filter", "invalid_json"}
+
+# 拆分到最小行数仍然失败的行写入该文件（JSONL），设置为空字符串则只打印不保存
+QUARANTINE_FILE = os.environ.get("LLM_QUARANTINE_FILE", "quarantine.jsonl")
+
+# 周期截止时间前为后续阶段（导入SQLite、上传飞书）保留的秒数，GPT请求不会占用这段时间
+DEADLINE_RESERVE = float(os.getenv("LLM_DEADLINE_RESERVE", "60"))
+
+# 估算输出token时，每条记录除描述文本外的固定开销（JSON键名、枚举值、日期等）
+RECORD_OVERHEAD_TOKENS = 60
+# 紧凑列数组输出没有键名，枚举为整数，每条记录的固定开销（列名行按批次分摊）
+COMPACT_RECORD_OVERHEAD_TOKENS = 25
+
+_encoding = None
+
+def estimate_tokens(text):
+    """估算文本的token数
+    
+    安装了tiktoken时使用gpt-4o的编码精确计算；否则按中日韩字符每字1个token、
+    其他字符每3个字符1个token保守估算
+    """
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk + 2) // 3
+
 class TextProcessor:
     def __init__(self, api_key=None, endpoint=None, deployment=None, api_version=None):
         """初始化处理器，设置Azure OpenAI API参数"""
@@ -22,98 +90,767 @@ class TextProcessor:
         self.api_version = api_version or os.environ.get("AZURE_API_VERSION_GPT4", "2024-08-01-preview")
         
         # 构建完整的API URL
-        self.api_url = f"{self.endpoint}/deployments/{self.deployment}/chat/completions?api-version={self.api_version}"
+        self.api_url = self._deployment_url(self.deployment)
         
         print(f"API URL: {self.api_url}")
         
-        # 设置批处理参数
+        # 设置批处理参数：批次按token预算打包，同时受最大行数限制
         self.max_tokens_per_request = 4000
-        self.max_input_tokens = 100000  # 设置一个非常大的值，实际上不限制输入大小
-        self.chunk_size = 50  # 每个批次处理的行数
+        self.max_input_tokens = int(os.environ.get("LLM_MAX_INPUT_TOKENS", "12000"))  # 单次请求的输入token预算（含提示词）
+        self.output_budget_ratio = 0.8  # 预期输出token不超过max_tokens的比例，为估算误差留出余量
+        self.chunk_size = int(os.environ.get("LLM_CHUNK_SIZE", "200"))  # 每个批次最多处理的行数
+        self.max_workers = int(os.environ.get("LLM_MAX_WORKERS", "1"))  # 并发处理的批次数，1为逐批顺序处理
+        
+        # 请求对冲: 超过该部署延迟分位数仍未返回的请求再发送一份，先成功的结果生效
+        self.hedger = RequestHedger() if HEDGE_ENABLED else None
+        self.hedge_endpoint = HEDGE_ENDPOINT or None
+        self.hedge_deployment = HEDGE_DEPLOYMENT or None
+        self.hedge_headers = {"api-key": HEDGE_API_KEY} if HEDGE_API_KEY else None
+        
+        # HTTP连接参数：复用keep-alive连接池，连接数与并发数一致（对冲时加倍）
+        self.connect_timeout = float(os.environ.get("LLM_CONNECT_TIMEOUT", "10"))
+        self.read_timeout = float(os.environ.get("LLM_READ_TIMEOUT", "180"))
+        # 设置了周期截止时间时，请求超时不超过剩余时间（提前deadline_reserve秒）
+        self.deadline_reserve = DEADLINE_RESERVE
+        self.session = self._create_session()
+        
+        # 所有并发批次共用的RPM/TPM限流器，以及429/5xx/网络错误的重试次数
+        self.rate_limiter = RateLimiter()
+        self.max_retries = rate_limiter.MAX_RETRIES
+        
+        # 输入来源，写入结果的metadata
+        self.source_file = INPUT_FILE
+        
+        # 按消息缓存提取结果，未变化的消息不再重复发送给API
+        self.memo = ExtractionMemo(MEMO_FILE) if MEMO_FILE else None
+        # 紧凑提示词: 固定说明放入系统消息（便于服务端缓存提示词前缀），用户ID替换为批次内短代号，去掉id/time前缀
+        self.compact_prompt = os.environ.get("LLM_COMPACT_PROMPT", "0") == "1"
+        # 紧凑输出: 模型返回列名行 + 值数组、枚举为整数编号，本地还原为原有的记录字典
+        self.compact_output = os.environ.get("LLM_COMPACT_OUTPUT", "0") == "1"
+        self.record_overhead_tokens = COMPACT_RECORD_OVERHEAD_TOKENS if self.compact_output else RECORD_OVERHEAD_TOKENS
+        # 分级路由: 复杂度低的批次先使用快速部署，校验失败时升级到主部署
+        self.router = ModelRouter(FAST_DEPLOYMENT) if FAST_DEPLOYMENT else None
+        self.memo_version = (f"{PROMPT_VERSION}{'-compact' if self.compact_prompt else ''}"
+                             f"{'-columns' if self.compact_output else ''}:{self.deployment}"
+                             f"{'+' + FAST_DEPLOYMENT if self.router else ''}")
+        
+        # 流式模式: 使用SSE接收响应，边接收边解析并统计每个批次首条记录的延迟
+        self.stream = os.environ.get("LLM_STREAM", "0") == "1"
+        
+        # 失败批次拆分重试的最小行数，以及隔离文件的写入锁
+        self.bisect_min_lines = max(int(os.environ.get("LLM_BISECT_MIN_LINES", "1")), 1)
+        self.quarantine_lock = threading.Lock()
+        
+        # 结果输出（jsonl_output.JsonlOutputWriter，由调用方设置）: 设置后记录随批次完成逐条追加写入，不再保存在返回结果中
+        self.output_writer = None
+        
+        # 批次结果检查点（由调用方设置），已完成的批次不再重复发送
+        self.checkpoint = None
+        
+        # 本地噪声过滤规则（问候语、纯表情等不发送给API）
+        self.noise_filter = NoiseFilter.load() if FILTER_ENABLED else None
+        
+        # 重复/近似重复消息只发送一条代表行: fanout / count / off
+        self.dedup_mode = dedup.DEDUP_MODE
+        
+        # 本地分类器: 置信度不低于阈值的消息直接在本地生成结果；启用时API的提取结果记录为分类器的训练样本
+        self.local_classifier = LocalClassifier.load() if CLASSIFIER_ENABLED else None
+        if CLASSIFIER_ENABLED and self.local_classifier is None:
+            print(f"警告: 本地分类器模型 {MODEL_FILE} 不存在，请先运行 python local_classifier.py --retrain")
+        self.classifier_threshold = CONFIDENCE_THRESHOLD
+        self.example_log = ExampleLog(EXAMPLES_FILE) if CLASSIFIER_ENABLED and EXAMPLES_FILE else None
+    
+    def _deployment_url(self, deployment, endpoint=None):
+        return f"{endpoint or self.endpoint}/deployments/{deployment}/chat/completions?api-version={self.api_version}"
+    
+    def _create_session(self):
+        """创建带连接池的HTTP会话，所有批次共用，TCP/TLS握手只需进行一次"""
+        session = requests.Session()
+        pool_size = max(self.max_workers, 1) * (2 if self.hedger else 1)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            "Content-Type": "application/json",
+            "api-key": self.api_key
+        })
+        return session
+    
+    def close(self):
+        """关闭HTTP连接池和提取缓存"""
+        self.session.close()
+        if self.memo:
+            self.memo.close()
     
     def process_text_in_batches(self, text_data, company_name="新文蓄电池"):
         """分批处理大量文本数据"""
         # 将文本分割成行
         lines = text_data.strip().split('\n')
+        return self.process_lines_in_batches(lines, company_name)
+    
+    def process_lines_in_batches(self, lines, company_name="新文蓄电池"):
+        """分批处理文本行序列
+        
+        lines 为文本行列表；噪声过滤、缓存、去重、打包等每个阶段都会访问每一行
+        """
         total_lines = len(lines)
         print(f"总共读取了 {total_lines} 行数据")
         
-        # 如果行数很少，直接处理
-        if total_lines <= self.chunk_size:
-            return self.process_text(text_data, company_name)
+        # 每行的提取结果: 行号 -> {"issues": [...], "sales": [...]}
+        line_records = {}
+        pending = list(range(total_lines))
+        
+        # 本地噪声过滤，丢弃的行不产生任何记录
+        noise_report = None
+        if self.noise_filter:
+            self.noise_filter.reset()
+            pending = self.noise_filter.filter((i, lines[i]) for i in pending)
+            noise_report = self.noise_filter.report()
+            print(f"噪声过滤丢弃 {noise_report['dropped']} 行: {noise_report['by_rule']}")
+        
+        # 查询提取缓存，命中的行不再发送给API
+        memo_keys = {}
+        if self.memo:
+            memo_keys = {i: self.memo.make_key(lines[i], company_name, self.memo_version) for i in pending}
+            hits = self.memo.get_many(set(memo_keys.values()))
+            for i in pending:
+                if memo_keys[i] in hits:
+                    line_records[i] = hits[memo_keys[i]]
+            pending = [i for i in pending if i not in line_records]
+            print(f"提取缓存命中 {len(line_records)} 行，需要调用API的 {len(pending)} 行")
+        memo_hits = len(line_records)
+        
+        # 本地分类器置信度足够高的行不再发送给API
+        local_classified = 0
+        if self.local_classifier and pending:
+            remaining = []
+            for i in pending:
+                records = self.local_classifier.classify_line(lines[i], self.classifier_threshold)
+                if records is None:
+                    remaining.append(i)
+                else:
+                    line_records[i] = records
+            local_classified = len(pending) - len(remaining)
+            pending = remaining
+            print(f"本地分类器处理了 {local_classified} 行，需要调用API的 {len(pending)} 行")
+        
+        # 重复和近似重复的消息聚类，每个簇只发送代表行: 代表行号 -> [成员行号, ...]
+        clusters = {}
+        if self.dedup_mode != "off" and pending:
+            clusters = dedup.cluster_lines((i, lines[i]) for i in pending)
+            clusters = {rep: members for rep, members in clusters.items() if members}
+            duplicates = sum(len(members) for members in clusters.values())
+            if duplicates:
+                member_set = {idx for members in clusters.values() for idx in members}
+                pending = [i for i in pending if i not in member_set]
+                print(f"去重: {len(clusters)} 个重复簇合并了 {duplicates} 行，需要调用API的 {len(pending)} 行")
         
-        # 计算需要的批次数
-        num_batches = math.ceil(total_lines / self.chunk_size)
+        # 按token预算划分批次，每个批次是若干行号
+        batches = self._pack_batches(lines, pending, company_name)
+        num_batches = len(batches)
         print(f"数据将分为 {num_batches} 批处理")
         
-        # 初始化结果
+        # 每行所属的批次（簇成员跟随代表行），该批次完成后这一行的结果才能确定
+        line_batch = {idx: b for b, batch in enumerate(batches) for idx in batch}
+        for rep, members in clusters.items():
+            for member in members:
+                line_batch[member] = line_batch[rep]
+        completed = set()
+        
+        # 无法对应到具体行的记录，排在所属批次最后一行之后: 行号 -> [{"issues": [...], "sales": [...]}, ...]
+        unattributed = {}
+        batch_timings = []
+        
+        # 按输入行顺序输出结果: 设置了output_writer时逐批追加写入，否则合并到列表中
         all_issues = []
         all_sales = []
+        counts = {"issues": 0, "sales": 0}
+        next_line = 0
+        
+        def emit(records):
+            for kind, target in (("issues", all_issues), ("sales", all_sales)):
+                items = records.get(kind, [])
+                counts[kind] += len(items)
+                if self.output_writer:
+                    self.output_writer.write(kind, items)
+                else:
+                    target.extend(items)
         
-        # 分批处理
-        for i in range(num_batches):
-            start_idx = i * self.chunk_size
-            end_idx = min((i + 1) * self.chunk_size, total_lines)
-            batch_lines = lines[start_idx:end_idx]
-            batch_text = '\n'.join(batch_lines)
+        def flush():
+            """输出从next_line开始、结果已经确定的连续行"""
+            nonlocal next_line
+            while next_line < total_lines:
+                b = line_batch.get(next_line)
+                if b is not None and b not in completed:
+                    break
+                records = line_records.pop(next_line, None)
+                if records:
+                    emit(records)
+                for extra in unattributed.pop(next_line, []):
+                    emit(extra)
+                next_line += 1
+            if self.output_writer:
+                self.output_writer.flush()
+        
+        def on_complete(i, batch_result, elapsed):
+            batch = batches[i]
+            succeeded = isinstance(batch_result, dict) and not batch_result.get("error")
+            # 结果完整（所有记录都能对应到行）的行，可以写入提取缓存
+            memo_ready = set()
+            # 拆分重试后仍被隔离或失败的行（批次内位置），这些行没有完整结果
+            quarantined = batch_result.get("quarantined", []) if isinstance(batch_result, dict) else []
+            unresolved = set(quarantined) | set(batch_result.get("failed_lines", []) if isinstance(batch_result, dict) else [])
+            if succeeded:
+                attributed, extra = self._attribute_records(batch_result, batch)
+                line_records.update(attributed)
+                if extra["issues"] or extra["sales"]:
+                    unattributed.setdefault(batch[-1], []).append(extra)
+                else:
+                    # 未产生记录的行也视为完整结果（空结果）
+                    settled = [idx for position, idx in enumerate(batch) if position not in unresolved]
+                    for idx in settled:
+                        line_records.setdefault(idx, {"issues": [], "sales": []})
+                    memo_ready.update(settled)
+            if self.example_log and memo_ready:
+                examples = (example_from_records(lines[idx], line_records[idx]) for idx in sorted(memo_ready))
+                self.example_log.append([example for example in examples if example])
+            # 被隔离的行已写入隔离文件，不再重试，不算作失败；只有仍可重试的失败行使批次成为partial/error
+            failed = unresolved - set(quarantined)
+            if not succeeded and quarantined and not failed and len(quarantined) == len(batch):
+                status = "quarantined"
+            elif not succeeded:
+                status = "deadline" if batch_result.get("error_kind") == "deadline" else "error"
+            elif batch_result.get("resumed"):
+                status = "resumed"
+            else:
+                status = "partial" if failed else "ok"
+            timing = {
+                "batch": i + 1,
+                "lines": len(batch),
+                "seconds": round(elapsed, 3),
+                "status": status
+            }
+            if quarantined:
+                timing["quarantined"] = len(quarantined)
+            first_record_seconds = batch_result.pop("first_record_seconds", None) if isinstance(batch_result, dict) else None
+            if first_record_seconds is not None and timing["status"] == "ok":
+                timing["first_record_seconds"] = first_record_seconds
+            batch_timings.append(timing)
             
-            print(f"处理第 {i+1}/{num_batches} 批 (行 {start_idx+1} 到 {end_idx})")
+            # 把代表行的提取结果分配给簇内其他行
+            for rep in batch:
+                members = clusters.get(rep)
+                if not members or rep not in line_records:
+                    continue
+                for member in members:
+                    line_records[member] = copy.deepcopy(line_records[rep])
+                if rep in memo_ready:
+                    memo_ready.update(members)
             
-            # 处理当前批次
-            batch_result = self.process_text(batch_text, company_name)
+            if self.memo and memo_ready:
+                self.memo.put_many({memo_keys[idx]: line_records[idx] for idx in memo_ready})
             
-            # 检查结果是否有效
-            if isinstance(batch_result, dict) and not batch_result.get("error"):
-                # 合并结果
-                all_issues.extend(batch_result.get("issues", []))
-                all_sales.extend(batch_result.get("sales", []))
-                print(f"第 {i+1} 批处理完成，累计: issues={len(all_issues)}, sales={len(all_sales)}")
-            else:
-                print(f"第 {i+1} 批处理失败: {batch_result.get('error', '未知错误')}")
+            # count模式: 重复行只输出代表行的记录，并标注重复次数
+            if self.dedup_mode == "count":
+                for rep in batch:
+                    members = clusters.get(rep, [])
+                    for member in members:
+                        line_records.pop(member, None)
+                    if members:
+                        for records in line_records.get(rep, {}).values():
+                            for record in records:
+                                record["duplicate_count"] = 1 + len(members)
+            
+            completed.add(i)
+            flush()
+        
+        # 噪声行和缓存命中的行不需要等待批次，开头的部分可以立即输出
+        flush()
+        
+        # 执行批次，每个批次完成后按输入行顺序输出已经确定的结果
+        run_started = time.time()
+        self._run_batches(lines, batches, company_name, on_complete)
+        run_elapsed = time.time() - run_started
+        batch_timings.sort(key=lambda timing: timing["batch"])
+        # 超过截止时间后失败或不完整的批次同样视为被截止时间取消
+        deadline_exceeded = any(timing["status"] == "deadline" for timing in batch_timings) or (
+            cycle_deadline.expired(self.deadline_reserve)
+            and any(timing["status"] in ("error", "partial") for timing in batch_timings))
+        
+        if self.memo:
+            removed = self.memo.evict()
+            if removed:
+                print(f"提取缓存淘汰了 {removed} 条过期条目")
         
         # 合并所有批次的结果
         combined_result = {
             "issues": all_issues,
             "sales": all_sales,
             "metadata": {
-                "total_records": len(all_issues) + len(all_sales),
-                "total_issues": len(all_issues),
-                "total_sales": len(all_sales),
+                "total_records": counts["issues"] + counts["sales"],
+                "total_issues": counts["issues"],
+                "total_sales": counts["sales"],
                 "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "source_file": INPUT_FILE,
-                "batches_processed": num_batches
+                "source_file": self.source_file,
+                "total_lines": total_lines,
+                "noise_filter": noise_report,
+                "memo_hits": memo_hits,
+                "local_classified": local_classified,
+                "deduplicated_lines": sum(len(members) for members in clusters.values()),
+                "batches_processed": num_batches,
+                "batches_failed": sum(1 for timing in batch_timings if timing["status"] == "error"),
+                "batches_resumed": sum(1 for timing in batch_timings if timing["status"] == "resumed"),
+                "batches_partial": sum(1 for timing in batch_timings if timing["status"] == "partial"),
+                "quarantined_lines": sum(timing.get("quarantined", 0) for timing in batch_timings),
+                "batches_deadline": sum(1 for timing in batch_timings if timing["status"] == "deadline"),
+                "max_workers": self.max_workers,
+                "rate_limit": self.rate_limiter.report(),
+                "routes": self.router.report() if self.router else None,
+                "hedging": self.hedger.report() if self.hedger else None,
+                "elapsed_seconds": round(run_elapsed, 3),
+                "deadline_exceeded": deadline_exceeded,
+                "batch_timings": batch_timings
             }
         }
         
-        print(f"所有批次处理完成，总计: issues={len(all_issues)}, sales={len(all_sales)}")
+        print(f"所有批次处理完成，总计: issues={counts['issues']}, sales={counts['sales']}，耗时 {run_elapsed:.2f} 秒")
         return combined_result
     
-    def process_text(self, text_data, company_name="新文蓄电池"):
-        """使用Azure OpenAI处理文本数据并返回结构化JSON"""
-        # 构建提示词
-        prompt = self._build_prompt(text_data, company_name)
+    def _pack_batches(self, lines, pending, company_name):
+        """按输入和预期输出的token预算把行打包成批次
         
-        # 准备请求头和请求体
-        headers = {
-            "Content-Type": "application/json",
-            "api-key": self.api_key
+        输入预算为 max_input_tokens 减去提示词本身；输出预算为 max_tokens 的 output_budget_ratio，
+        每行的预期输出按"描述文本 + 固定记录开销"估算，避免长消息批次被截断(finish_reason=length)
+        """
+        prompt_tokens = estimate_tokens(self._build_prompt("", company_name))
+        input_budget = max(self.max_input_tokens - prompt_tokens, 1)
+        output_budget = int(self.max_tokens_per_request * self.output_budget_ratio)
+        
+        batches = []
+        batch = []
+        batch_input = batch_output = 0
+        for idx in pending:
+            line = lines[idx]
+            line_tokens = estimate_tokens(line) + 3  # 行号前缀
+            message = spool.parse_line(line).get("message", "")
+            expected_output = estimate_tokens(message) + self.record_overhead_tokens if message.strip() else 0
+            
+            if batch and (batch_input + line_tokens > input_budget
+                          or batch_output + expected_output > output_budget
+                          or len(batch) >= self.chunk_size):
+                batches.append(batch)
+                batch = []
+                batch_input = batch_output = 0
+            
+            batch.append(idx)
+            batch_input += line_tokens
+            batch_output += expected_output
+        
+        if batch:
+            batches.append(batch)
+        
+        if batches:
+            print(f"按token预算打包: 输入预算 {input_budget}，输出预算 {output_budget}，"
+                  f"平均每批 {len(pending) / len(batches):.1f} 行")
+        return batches
+    
+    def _format_batch(self, batch_lines):
+        """为批次中的每一行加上行号，便于模型在记录中注明来源行
+        
+        紧凑模式下每行编码为 "行号|用户代号|时间|消息"，用户代号（@1、@2...）只用于在批次内区分用户。
+        输出的记录中没有用户字段，结果不做代号还原，避免改写消息中本来就有的"@数字"
+        """
+        if not self.compact_prompt:
+            return '\n'.join(f"[{n}] {line}" for n, line in enumerate(batch_lines, 1))
+        
+        aliases = {}
+        encoded = []
+        for n, line in enumerate(batch_lines, 1):
+            record = spool.parse_line(line)
+            user_id = record.get("user_id", "")
+            if user_id and user_id not in aliases:
+                aliases[user_id] = f"@{len(aliases) + 1}"
+            encoded.append(f"{n}|{aliases.get(user_id, '')}|{record.get('time', '')}|{record.get('message', '')}")
+        return '\n'.join(encoded)
+    
+    def _attribute_records(self, batch_result, batch):
+        """根据记录中的source_line把提取结果分配到对应的输入行
+        
+        返回 (行号 -> {"issues": [...], "sales": [...]}, 无法对应到行的记录)
+        """
+        attributed = {}
+        extra = {"issues": [], "sales": []}
+        for kind in ("issues", "sales"):
+            for record in batch_result.get(kind, []) or []:
+                if not isinstance(record, dict):
+                    continue
+                source_line = record.pop("source_line", None)
+                try:
+                    position = int(source_line)
+                except (TypeError, ValueError):
+                    position = 0
+                if 1 <= position <= len(batch):
+                    attributed.setdefault(batch[position - 1], {"issues": [], "sales": []})[kind].append(record)
+                else:
+                    extra[kind].append(record)
+        return attributed, extra
+    
+    def _run_batches(self, lines, batches, company_name, on_complete):
+        """执行所有批次，每个批次完成后（按完成顺序，在调用线程中）调用 on_complete(批次序号, 批次结果, 耗时秒数)"""
+        num_batches = len(batches)
+        
+        def run_batch(i):
+            batch = batches[i]
+            print(f"处理第 {i+1}/{num_batches} 批 ({len(batch)} 行, 行 {batch[0]+1} 到 {batch[-1]+1})")
+            started = time.time()
+            batch_result = self._process_batch(lines, batch, company_name, i)
+            return batch_result, 0.0 if batch_result.get("resumed") else time.time() - started
+        
+        def report(i, batch_result, elapsed):
+            if isinstance(batch_result, dict) and not batch_result.get("error"):
+                print(f"第 {i+1} 批处理完成，耗时 {elapsed:.2f} 秒: "
+                      f"issues={len(batch_result.get('issues', []))}, sales={len(batch_result.get('sales', []))}")
+            else:
+                print(f"第 {i+1} 批处理失败 (耗时 {elapsed:.2f} 秒): {batch_result.get('error', '未知错误')}")
+        
+        if self.max_workers <= 1:
+            for i in range(num_batches):
+                outcome = run_batch(i)
+                report(i, *outcome)
+                on_complete(i, *outcome)
+            return
+        
+        print(f"使用 {self.max_workers} 个并发线程处理批次")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(run_batch, i): i for i in range(num_batches)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    outcome = ({"error": f"批次执行异常: {e}"}, 0.0)
+                report(i, *outcome)
+                on_complete(i, *outcome)
+    
+    def _process_batch(self, lines, batch, company_name, batch_index):
+        """处理一个批次（或拆分出的子批次），返回记录中的source_line相对于该批次
+        
+        响应被截断时先保留其中完整的记录，只重新处理结果不完整的行；
+        因截断、内容过滤或无法解析的JSON失败时，把批次对半拆分递归重试，直到bisect_min_lines行。
+        仍然失败的行写入隔离文件，位置（批次内从0开始）记录在结果的"quarantined"中，
+        其他原因失败的子批次位置记录在"failed_lines"中。
+        """
+        batch_text = self._format_batch([lines[idx] for idx in batch])
+        
+        checkpoint_key = None
+        if self.checkpoint:
+            checkpoint_key = self.checkpoint.make_key(batch_text, company_name, self.memo_version)
+            saved = self.checkpoint.get(checkpoint_key)
+            if saved is not None:
+                print(f"第 {batch_index+1} 批的 {len(batch)} 行已在检查点中完成，跳过API调用")
+                saved["resumed"] = True
+                return saved
+        
+        batch_result = self._route_text([lines[idx] for idx in batch], batch_text, company_name)
+        if isinstance(batch_result, dict) and not batch_result.get("error") and batch_result.get("incomplete"):
+            batch_result = self._complete_salvaged(lines, batch, company_name, batch_index, batch_result)
+        if isinstance(batch_result, dict) and not batch_result.get("error"):
+            if checkpoint_key and not batch_result.get("failed_lines"):
+                self.checkpoint.save(checkpoint_key, batch_result)
+            return batch_result
+        
+        error_kind = batch_result.get("error_kind") if isinstance(batch_result, dict) else None
+        if error_kind not in BISECT_ERRORS:
+            return batch_result
+        
+        if len(batch) <= self.bisect_min_lines:
+            self._quarantine(lines, batch, batch_result)
+            return {"error": batch_result.get("error"), "error_kind": error_kind,
+                    "quarantined": list(range(len(batch)))}
+        
+        mid = len(batch) // 2
+        print(f"第 {batch_index+1} 批中的 {len(batch)} 行处理失败（{error_kind}），拆分为 {mid} + {len(batch) - mid} 行重试")
+        left = self._process_batch(lines, batch[:mid], company_name, batch_index)
+        right = self._process_batch(lines, batch[mid:], company_name, batch_index)
+        merged = self._merge_halves(left, right, mid, len(batch))
+        if checkpoint_key and not merged.get("error") and not merged.get("failed_lines"):
+            self.checkpoint.save(checkpoint_key, merged)
+        return merged
+    
+    def _route_text(self, batch_lines, batch_text, company_name):
+        """按批次复杂度选择部署: 简单批次先使用快速部署，结果未通过校验时升级到主部署"""
+        if not self.router:
+            return self.process_text(batch_text, company_name)
+        
+        if self.router.use_fast(batch_lines):
+            started = time.time()
+            result = self.process_text(batch_text, company_name, deployment=self.router.fast_deployment)
+            if isinstance(result, dict) and result.get("error_kind") == "deadline":
+                return result
+            problems = model_router.validate_result(result, batch_lines)
+            self.router.record(self.router.fast_deployment, time.time() - started, not problems, bool(problems))
+            if not problems:
+                return result
+            print(f"快速部署 {self.router.fast_deployment} 的结果未通过校验，升级到 {self.deployment}: {problems[:3]}")
+        
+        started = time.time()
+        result = self.process_text(batch_text, company_name)
+        succeeded = isinstance(result, dict) and not result.get("error")
+        self.router.record(self.deployment, time.time() - started, succeeded)
+        return result
+    
+    def _complete_salvaged(self, lines, batch, company_name, batch_index, salvaged):
+        """保留截断响应中已经完整的记录，只把结果不完整的行重新处理后合并
+        
+        salvaged["incomplete"] 为 {类型: n}，表示该类型只有source_line小于n的行结果完整。
+        完整与否按类型分别判断: 截断发生在issues数组中时sales还没有开始，所有行的sales都需要重新处理，
+        但已经完整的issues记录仍然保留，重新处理的结果只取不完整的类型
+        """
+        incomplete = salvaged.pop("incomplete")
+        
+        def settled(kind, line):
+            return kind not in incomplete or line < incomplete[kind]
+        
+        if all(kind in incomplete and incomplete[kind] <= 1 for kind in ("issues", "sales")):
+            # 没有任何一种类型有完整的结果，按普通截断处理（拆分批次）
+            return {"error": "截断的响应中没有可用的完整结果", "error_kind": "truncated"}
+        
+        pending = [p for p in range(len(batch)) if not all(settled(kind, p + 1) for kind in incomplete)]
+        if len(pending) == len(batch) == 1:
+            # 单行无法再缩小请求，原样重新处理可能再次截断
+            return {"error": "截断的响应中该行的结果不完整", "error_kind": "truncated"}
+        
+        merged = {"issues": [], "sales": [], "salvaged": True, "quarantined": [], "failed_lines": []}
+        for kind in ("issues", "sales"):
+            for record in salvaged.get(kind, []) or []:
+                try:
+                    keep = settled(kind, int(record.get("source_line")))
+                except (AttributeError, TypeError, ValueError):
+                    keep = kind not in incomplete
+                if keep:
+                    merged[kind].append(record)
+        kept = len(merged["issues"]) + len(merged["sales"])
+        print(f"第 {batch_index+1} 批: 从截断的响应中保留 {kept} 条完整记录，重新处理剩余的 {len(pending)} 行")
+        
+        pending_batch = [batch[p] for p in pending]
+        if len(pending) == len(batch):
+            # 所有行都有不完整的类型: 原样重发会得到同样的截断，拆成两半重新处理
+            mid = len(pending) // 2
+            left = self._process_batch(lines, pending_batch[:mid], company_name, batch_index)
+            right = self._process_batch(lines, pending_batch[mid:], company_name, batch_index)
+            rerun = self._merge_halves(left, right, mid, len(pending))
+        else:
+            rerun = self._process_batch(lines, pending_batch, company_name, batch_index)
+        merged["quarantined"] = [pending[q] for q in rerun.get("quarantined", [])]
+        merged["failed_lines"] = [pending[q] for q in rerun.get("failed_lines", [])]
+        if rerun.get("error"):
+            if not merged["quarantined"] and not merged["failed_lines"]:
+                merged["failed_lines"] = pending
+            return merged
+        
+        # 重新处理的行只取原响应中不完整的那部分类型，避免重复
+        for kind in ("issues", "sales"):
+            for record in rerun.get(kind, []) or []:
+                try:
+                    position = pending[int(record.get("source_line")) - 1]
+                except (AttributeError, TypeError, ValueError, IndexError):
+                    merged[kind].append(record)
+                    continue
+                if not settled(kind, position + 1):
+                    record["source_line"] = position + 1
+                    merged[kind].append(record)
+        return merged
+    
+    @staticmethod
+    def _merge_halves(left, right, mid, size):
+        """合并拆分后两个子批次的结果，右半部分的source_line和行位置加上mid"""
+        merged = {"issues": [], "sales": [], "quarantined": [], "failed_lines": [], "bisected": True}
+        errors = []
+        for part, start, end in ((left, 0, mid), (right, mid, size)):
+            merged["quarantined"].extend(position + start for position in part.get("quarantined", []))
+            merged["failed_lines"].extend(position + start for position in part.get("failed_lines", []))
+            if part.get("error"):
+                errors.append(part)
+                if not part.get("quarantined") and not part.get("failed_lines"):
+                    # 与内容无关的失败（网络、HTTP错误等），整个子批次都没有结果
+                    merged["failed_lines"].extend(range(start, end))
+                continue
+            for kind in ("issues", "sales"):
+                for record in part.get(kind, []) or []:
+                    if isinstance(record, dict) and start:
+                        try:
+                            record["source_line"] = int(record["source_line"]) + start
+                        except (KeyError, TypeError, ValueError):
+                            pass
+                    merged[kind].append(record)
+        
+        if len(errors) == 2:
+            merged["error"] = errors[0]["error"]
+            merged["error_kind"] = errors[0].get("error_kind")
+        return merged
+    
+    def _quarantine(self, lines, batch, batch_result):
+        """把无法处理的行追加写入隔离文件，供人工检查"""
+        print(f"隔离 {len(batch)} 行: {batch_result.get('error_kind')}")
+        if not QUARANTINE_FILE:
+            return
+        with self.quarantine_lock:
+            with open(QUARANTINE_FILE, 'a', encoding='utf-8') as f:
+                for idx in batch:
+                    f.write(json.dumps({
+                        "line": idx + 1,
+                        "text": lines[idx],
+                        "error_kind": batch_result.get("error_kind"),
+                        "error": str(batch_result.get("error", ""))[:500],
+                        "source_file": self.source_file,
+                        "quarantined_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    }, ensure_ascii=False) + '\n')
+    
+    def _post_with_retry(self, payload, stream=False, api_url=None, headers=None, hedge_attempt=None):
+        """经过限流器发送请求，429/5xx和网络错误按Retry-After或抖动退避重试
+        
+        api_url 默认为主部署的地址；hedge_attempt 为对冲中的一次请求，被取消后不再重试
+        返回 (最后一次的响应, 预留的token数)，由调用方按实际用量结算；重试用尽仍是网络错误时抛出异常
+        """
+        # Azure按 提示词token + max_tokens 计入TPM
+        reserved_tokens = sum(estimate_tokens(message["content"]) for message in payload["messages"])
+        reserved_tokens += payload["max_tokens"]
+        
+        attempt = 0
+        while True:
+            # 收到429时由限流器让所有批次一起暂停，下一次acquire会等待到暂停结束（不超过截止时间）
+            self.rate_limiter.acquire(reserved_tokens, self.deadline_reserve)
+            throttled = False
+            try:
+                if hedge_attempt:
+                    hedge_attempt.check()
+                timeout = cycle_deadline.request_timeout(self.connect_timeout, self.read_timeout, self.deadline_reserve)
+                response = self.session.post(
+                    api_url or self.api_url, json=payload, headers=headers, timeout=timeout, stream=stream
+                )
+            except requests.exceptions.RequestException as e:
+                # 没有得到响应，无法知道实际用量，按未计入TPM退还预留的额度，重试时重新预留
+                self.rate_limiter.settle(reserved_tokens, 0)
+                if attempt >= self.max_retries:
+                    raise
+                delay = rate_limiter.backoff_delay(attempt)
+                print(f"API请求出错: {e}，{delay:.1f} 秒后重试 ({attempt + 1}/{self.max_retries})")
+            else:
+                self.rate_limiter.observe(response.headers)
+                if response.status_code not in rate_limiter.RETRYABLE_STATUS or attempt >= self.max_retries:
+                    return response, reserved_tokens
+                
+                # 被拒绝的请求不计入TPM，退还预留的额度
+                self.rate_limiter.settle(reserved_tokens, 0)
+                response.close()
+                suggested = rate_limiter.retry_after(response.headers)
+                if suggested is not None:
+                    # 在服务端建议的时间上加少量抖动，避免并发批次同时恢复
+                    delay = suggested + random.uniform(0, 1)
+                else:
+                    delay = rate_limiter.backoff_delay(attempt)
+                if response.status_code == 429:
+                    self.rate_limiter.pause(delay)
+                    throttled = True
+                print(f"API返回HTTP {response.status_code}，{delay:.1f} 秒后重试 ({attempt + 1}/{self.max_retries})")
+            
+            self.rate_limiter.note_retry()
+            if not throttled and not cycle_deadline.sleep(delay, self.deadline_reserve):
+                raise DeadlineExceeded("重试等待超过了本周期的截止时间")
+            attempt += 1
+    
+    def _read_stream(self, response, hedge_attempt=None):
+        """读取SSE流式响应，边接收边解析记录，返回与非流式响应相同结构的数据
+        
+        hedge_attempt 被对冲的另一份请求取代时关闭连接并抛出 HedgeCancelled
+        """
+        started = time.time()
+        parser = RecordStreamParser()
+        finish_reason = None
+        usage = None
+        first_record_seconds = None
+        
+        for data in iter_sse_data(response):
+            if hedge_attempt and hedge_attempt.cancelled.is_set():
+                response.close()
+                hedge_attempt.check()
+            if cycle_deadline.expired(self.deadline_reserve):
+                response.close()
+                cycle_deadline.check("流式响应", self.deadline_reserve)
+            chunk = json.loads(data)
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            for choice in chunk.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    if parser.feed(content) and first_record_seconds is None:
+                        first_record_seconds = time.time() - started
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+        
+        if first_record_seconds is not None:
+            print(f"流式响应: 首条记录用时 {first_record_seconds:.2f} 秒，共 {parser.count} 条记录")
+        response_data = {
+            "choices": [{"message": {"content": parser.getvalue()}, "finish_reason": finish_reason}],
+            "first_record_seconds": first_record_seconds
         }
+        if usage:
+            response_data["usage"] = usage
+        return response_data
+    
+    @staticmethod
+    def _error_kind(finish_reason, default):
+        """根据完成原因区分失败类型: 截断、内容过滤或其他"""
+        if finish_reason == "length":
+            return "truncated"
+        if finish_reason == "content_filter":
+            return "content_filter"
+        return default
+    
+    def process_text(self, text_data, company_name="新文蓄电池", deployment=None):
+        """使用Azure OpenAI处理文本数据并返回结构化JSON
+        
+        deployment 指定使用的部署，默认为主部署。
+        启用对冲时，请求超过截止时间仍未返回会再发送一份，先成功返回的结果生效
+        """
+        if not self.hedger:
+            return self._request_text(text_data, company_name, deployment)
         
+        key = deployment or self.deployment
+        
+        def call(attempt):
+            if not attempt.hedge:
+                return self._request_text(text_data, company_name, deployment, hedge_attempt=attempt)
+            return self._request_text(text_data, company_name, self.hedge_deployment or key,
+                                      self.hedge_endpoint, attempt)
+        
+        return self.hedger.run(key, call, lambda result: isinstance(result, dict) and not result.get("error"))
+    
+    def _request_text(self, text_data, company_name, deployment=None, endpoint=None, hedge_attempt=None):
+        """发送一次提取请求并解析响应；endpoint 和 hedge_attempt 用于对冲请求"""
+        # 准备请求体（请求头已设置在会话中）
         payload = {
-            "messages": [
-                {"role": "system", "content": "你是一个专业的数据分析助手，擅长从文本中提取结构化信息并生成符合特定格式的JSON数据。"},
-                {"role": "user", "content": prompt}
-            ],
+            "messages": self._build_messages(text_data, company_name),
             "temperature": 0.3,
             "max_tokens": self.max_tokens_per_request,
             "response_format": {"type": "json_object"}
         }
+        if self.stream:
+            payload["stream"] = True
+        
+        # 紧凑输出格式在本地还原为原有的记录字典
+        if self.compact_output:
+            decode = compact_schema.decode_result
+        else:
+            decode = lambda result: result
         
         print("正在调用Azure OpenAI API处理文本...")
         
         # 发送请求到Azure OpenAI
         try:
-            response = requests.post(self.api_url, headers=headers, json=payload)
+            api_url = self._deployment_url(deployment or self.deployment, endpoint) if deployment or endpoint else None
+            headers = self.hedge_headers if endpoint else None
+            response, reserved_tokens = self._post_with_retry(payload, self.stream, api_url, headers, hedge_attempt)
             
             # 检查HTTP状态码
             if response.status_code != 200:
@@ -131,39 +868,54 @@ class TextProcessor:
                             error_msg += "\n建议: 请检查API密钥是否正确，或者API密钥是否已过期。"
                         elif "quota" in error_msg.lower():
                             error_msg += "\n建议: 您的API配额可能已用尽，请检查账户余额或提高配额限制。"
-                        elif "content filter" in error_msg.lower():
+                        elif "content filter" in error_msg.lower() or "content_filter" in error_msg.lower():
                             error_msg += "\n建议: 输入内容可能触发了内容过滤器，请检查并修改输入文本。"
                 except:
                     error_msg += f"\n无法解析错误详情: {response.text[:200]}..."
                 
                 print(error_msg)
-                return {"error": error_msg}
+                # 被拒绝的请求不计入TPM，退还预留的额度
+                self.rate_limiter.settle(reserved_tokens, 0)
+                # 内容过滤只和部分输入行有关，其余HTTP错误与批次内容无关
+                filtered = response.status_code == 400 and (
+                    "content_filter" in error_msg.lower() or "content filter" in error_msg.lower())
+                return {"error": error_msg, "error_kind": "content_filter" if filtered else "http"}
             
             # 解析响应
             try:
-                response_data = response.json()
+                if self.stream:
+                    response_data = self._read_stream(response, hedge_attempt)
+                else:
+                    response_data = response.json()
+                
+                # 按实际用量退还预留的TPM额度；没有返回用量时（如格式异常的响应）按已全部使用处理
+                usage = (response_data.get("usage") or {}) if isinstance(response_data, dict) else {}
+                self.rate_limiter.settle(reserved_tokens, usage.get("total_tokens"))
                 
                 # 检查API返回的JSON结构是否符合预期
                 if "choices" not in response_data or len(response_data["choices"]) == 0:
                     error_msg = "API返回的数据格式不符合预期，缺少'choices'字段"
                     print(error_msg)
-                    return {"error": error_msg, "raw_response": response_data}
+                    return {"error": error_msg, "error_kind": "invalid_response", "raw_response": response_data}
+                
+                finish_reason = response_data["choices"][0].get("finish_reason")
                 
                 if "message" not in response_data["choices"][0]:
                     error_msg = "API返回的数据格式不符合预期，缺少'message'字段"
                     print(error_msg)
-                    return {"error": error_msg, "raw_response": response_data}
+                    return {"error": error_msg, "error_kind": self._error_kind(finish_reason, "invalid_response"),
+                            "raw_response": response_data}
                 
                 if "content" not in response_data["choices"][0]["message"]:
                     error_msg = "API返回的数据格式不符合预期，缺少'content'字段"
                     print(error_msg)
-                    return {"error": error_msg, "raw_response": response_data}
+                    return {"error": error_msg, "error_kind": self._error_kind(finish_reason, "invalid_response"),
+                            "raw_response": response_data}
                 
                 json_response = response_data["choices"][0]["message"]["content"]
                 
                 # 检查是否有截断或不完整的情况
-                if "finish_reason" in response_data["choices"][0]:
-                    finish_reason = response_data["choices"][0]["finish_reason"]
+                if finish_reason is not None:
                     if finish_reason != "stop":
                         print(f"警告: API响应可能不完整，完成原因: {finish_reason}")
                         if finish_reason == "length":
@@ -172,25 +924,39 @@ class TextProcessor:
                 print("API调用成功，正在解析JSON响应...")
                 
                 try:
-                    structured_data = json.loads(json_response)
+                    structured_data = decode(json.loads(json_response))
                     
                     # 验证返回的JSON结构是否符合预期
                     if "issues" not in structured_data or "sales" not in structured_data:
                         print("警告: 返回的JSON缺少预期的'issues'或'sales'字段")
                     
+                    if response_data.get("first_record_seconds") is not None and isinstance(structured_data, dict):
+                        structured_data["first_record_seconds"] = round(response_data["first_record_seconds"], 3)
                     return structured_data
                 except json.JSONDecodeError as e:
                     # 如果返回的不是有效JSON，尝试提取JSON部分
-                    import re
                     json_match = re.search(r'```json\n(.*?)\n```', json_response, re.DOTALL)
                     if json_match:
                         try:
-                            structured_data = json.loads(json_match.group(1))
+                            structured_data = decode(json.loads(json_match.group(1)))
                             return structured_data
                         except json.JSONDecodeError as e2:
                             error_msg = f"无法解析提取的JSON: {str(e2)}"
                             print(error_msg)
-                            return {"error": error_msg, "extracted_text": json_match.group(1)}
+                            return {"error": error_msg, "error_kind": self._error_kind(finish_reason, "invalid_json"),
+                                    "extracted_text": json_match.group(1)}
+                    
+                    # 从截断或格式错误的响应中恢复已经完整生成的记录，不完整的行由调用方重新处理
+                    recovered = salvage(json_response)
+                    if recovered:
+                        records, incomplete = recovered
+                        records = decode(records)
+                        if records["issues"] or records["sales"] or not incomplete:
+                            print(f"JSON无法完整解析（{e}），已恢复 {len(records['issues'])} 条issues、"
+                                  f"{len(records['sales'])} 条sales完整记录")
+                            if incomplete:
+                                records["incomplete"] = incomplete
+                            return records
                     
                     # 如果仍然失败，返回详细的错误信息
                     error_msg = f"无法解析API返回的JSON: {str(e)}"
@@ -210,13 +976,22 @@ class TextProcessor:
                     print(f"错误上下文: ...{error_context}...")
                     print(f"错误位置: 第{error_pos}个字符")
                     
-                    return {"error": error_msg, "raw_response": json_response}
+                    return {"error": error_msg, "error_kind": self._error_kind(finish_reason, "invalid_json"),
+                            "raw_response": json_response}
                     
+            except (HedgeCancelled, DeadlineExceeded):
+                raise
             except Exception as e:
                 error_msg = f"解析API响应时出错: {str(e)}"
                 print(error_msg)
-                return {"error": error_msg, "raw_response": response.text[:500]}
-                
+                error_kind = "deadline" if cycle_deadline.expired(self.deadline_reserve) else "invalid_response"
+                # 流式响应的内容已经被读取过，response.text 会抛出RuntimeError
+                raw_response = None if self.stream else response.text[:500]
+                return {"error": error_msg, "error_kind": error_kind, "raw_response": raw_response}
+        
+        except DeadlineExceeded as e:
+            print(f"请求取消: {e}")
+            return {"error": str(e), "error_kind": "deadline"}
         except requests.exceptions.RequestException as e:
             error_msg = f"API请求失败: {str(e)}"
             print(error_msg)
@@ -229,11 +1004,37 @@ class TextProcessor:
             elif "TooManyRedirects" in str(e.__class__):
                 print("建议: 重定向次数过多，请检查API端点URL是否正确。")
             
-            return {"error": error_msg}
+            # 超时由周期截止时间导致时，按截止时间取消处理
+            if cycle_deadline.expired(self.deadline_reserve):
+                return {"error": error_msg, "error_kind": "deadline"}
+            return {"error": error_msg, "error_kind": "network"}
     
-    def _build_prompt(self, text_data, company_name):
-        """构建提示词，指导Azure OpenAI如何处理文本"""
-        prompt = f"""
+    def _build_messages(self, text_data, company_name):
+        """构建对话消息
+        
+        标准模式: 通用系统消息 + 包含说明和文本的用户消息
+        紧凑模式: 说明全部放入固定的系统消息，用户消息只包含编码后的文本
+        """
+        if self.compact_prompt:
+            return [
+                {"role": "system", "content": self._build_instructions(company_name)},
+                {"role": "user", "content": text_data}
+            ]
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": self._build_prompt(text_data, company_name)}
+        ]
+    
+    def _build_instructions(self, company_name):
+        """构建固定的提取说明（不含待分析文本）"""
+        if self.compact_prompt:
+            line_format = """6. 每行格式为"行号|用户代号|时间|消息"，应提取消息作为问题描述，时间作为时间；用户代号（如@1）只用于区分本批次内的不同用户，时间可能为空
+7. 请在每条issues和sales记录中增加整数字段source_line，填写该记录来源行的行号（每行开头的数字）"""
+        else:
+            line_format = """6. 对于格式为"id:XX user_id:XX time:XX message:XX"的行，应提取message作为问题描述，time作为时间
+7. 每行开头方括号中的数字是行号（如"[3] ..."），请在每条issues和sales记录中增加整数字段source_line，填写该记录来源行的行号"""
+        
+        instructions = f"""
 请分析以下来自{company_name}经销商的客服聊天内容和反馈消息，并提取关键信息生成两个结构化的JSON数据，分别对应问题反馈表和销售数据表。
 
 文本内容包含多种格式：
@@ -274,10 +1075,19 @@ class TextProcessor:
 3. 对于格式不规范的行（如多条消息合并在一行），请尝试分割并单独处理每条消息
 4. 请确保每条有效信息都被解析，不要忽略任何格式的内容
 5. 请注意生成和文本中有效信息数量相同的JSON记录，如果判断是无效信息可以忽略
-6. 对于格式为"id:XX user_id:XX time:XX message:XX"的行，应提取message作为问题描述，time作为时间
+{line_format}
 
 请确保输出的JSON格式正确，包含两个数组：issues和sales。
-
+"""
+        if self.compact_output:
+            instructions += compact_schema.instructions()
+        if self.compact_prompt:
+            instructions += "\n用户消息即为需要分析的文本内容，请返回完整的JSON格式数据，不要包含任何其他解释或说明。\n"
+        return instructions
+    
+    def _build_prompt(self, text_data, company_name):
+        """构建提示词，指导Azure OpenAI如何处理文本"""
+        prompt = self._build_instructions(company_name) + f"""
 以下是需要分析的文本内容：
 
 {text_data}
@@ -332,34 +1142,68 @@ class TextProcessor:
                 except Exception as e3:
                     print(f"所有保存尝试均失败: {str(e3)}")
 
-def main():
+def read_input(spool_format=None):
+    """读取交接文件，返回 (文本行列表, 输入文件路径)"""
+    input_file = spool.spool_path(spool_format)
+    return spool.read_lines(input_file, spool_format), input_file
+
+def main(resume=False):
     """主函数"""
-    print(f"开始处理文件: {INPUT_FILE}")
+    input_file = spool.spool_path()
+    print(f"开始处理文件: {input_file}")
     
     # 读取输入文件
     try:
-        with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-            text_data = f.read()
-        print(f"成功读取文件: {INPUT_FILE}")
-        print(f"文件大小: {os.path.getsize(INPUT_FILE)} 字节")
+        lines, input_file = read_input()
+        print(f"成功读取文件: {input_file}")
+        print(f"文件大小: {os.path.getsize(input_file)} 字节")
         
         # 计算行数
-        line_count = text_data.count('\n') + 1
-        print(f"文件包含 {line_count} 行数据")
+        print(f"文件包含 {len(lines)} 行数据")
     except FileNotFoundError:
-        print(f"错误: 找不到文件 '{INPUT_FILE}'")
-        return
+        print(f"错误: 找不到文件 '{input_file}'")
+        sys.exit(1)
     except Exception as e:
         print(f"读取文件时出错: {e}")
+        sys.exit(1)
+    
+    # 增量导出没有新记录时输入为空，无需调用API
+    if not lines:
+        print("输入文件为空，没有新数据需要处理")
+        result = {
+            "issues": [],
+            "sales": [],
+            "metadata": {
+                "total_records": 0,
+                "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "source_file": input_file
+            }
+        }
+        if OUTPUT_FORMAT == 'jsonl':
+            JsonlOutputWriter(JSONL_OUTPUT_FILE).finish(result["metadata"])
+        else:
+            processor = TextProcessor()
+            try:
+                processor.save_json(result, OUTPUT_FILE)
+            finally:
+                processor.close()
         return
     
     # 处理文本
+    output_writer = None
     try:
         processor = TextProcessor()
+        processor.source_file = input_file
+        processor.checkpoint = BatchCheckpoint(resume=resume)
+        
+        # jsonl模式下记录随批次完成逐条追加到 output.jsonl
+        if OUTPUT_FORMAT == 'jsonl':
+            output_writer = JsonlOutputWriter(JSONL_OUTPUT_FILE)
+            processor.output_writer = output_writer
         
         print("开始处理文本数据...")
         # 使用分批处理方法处理大量数据
-        result = processor.process_text_in_batches(text_data)
+        result = processor.process_lines_in_batches(lines)
         
         # 添加处理时间戳
         if isinstance(result, dict) and "metadata" not in result:
@@ -368,16 +1212,50 @@ def main():
         if isinstance(result, dict) and "metadata" in result:
             result["metadata"]["generation_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        # 保存结果
-        processor.save_json(result, OUTPUT_FILE)
+        # 超过周期截止时间: 不写出不完整的结果，已完成的批次保留在检查点中，下一个周期使用--resume继续
+        if result["metadata"].get("deadline_exceeded"):
+            if output_writer:
+                output_writer.abort()
+            processor.close()
+            print(f"已超过本周期的截止时间，未完成的批次已取消，已完成的批次保存在检查点 {processor.checkpoint.path} 中")
+            sys.exit(DEADLINE_EXIT_CODE)
+        
+        # 有批次失败: 结果不完整，同样不写出结果并以非零状态退出，
+        # 避免process_data.sh确认增量导出的水位线后这些消息不再被导出。
+        # 失败的批次不会写入检查点，下一个周期使用--resume时只重新处理这些批次。
+        # 被隔离的行（如被内容过滤拒绝）重试也不会成功，已写入隔离文件供人工检查，不阻塞流程
+        metadata = result["metadata"]
+        failures = {
+            "失败批次": metadata.get("batches_failed", 0),
+            "部分失败批次": metadata.get("batches_partial", 0)
+        }
+        if metadata.get("quarantined_lines"):
+            print(f"警告: {metadata['quarantined_lines']} 行被隔离，已写入 {QUARANTINE_FILE or '日志'}，结果中不包含这些行")
+        if any(failures.values()):
+            if output_writer:
+                output_writer.abort()
+            processor.close()
+            summary = ", ".join(f"{name} {count}" for name, count in failures.items())
+            print(f"处理未全部成功（{summary}），不写出结果，已完成的批次保存在检查点 {processor.checkpoint.path} 中")
+            sys.exit(1)
+        
+        # 保存结果（jsonl模式写入清单行），成功后不再需要检查点
+        if output_writer:
+            output_writer.finish(result["metadata"])
+            output_path = JSONL_OUTPUT_FILE
+        else:
+            processor.save_json(result, OUTPUT_FILE)
+            output_path = OUTPUT_FILE
+        processor.checkpoint.clear()
+        processor.close()
         
         # 验证输出文件
-        if os.path.exists(OUTPUT_FILE) and os.path.getsize(OUTPUT_FILE) > 0:
-            print(f"验证成功: 输出文件 {OUTPUT_FILE} 已创建并包含数据")
+        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            print(f"验证成功: 输出文件 {output_path} 已创建并包含数据")
             
             # 统计并显示记录数量
-            issues_count = len(result.get("issues", []))
-            sales_count = len(result.get("sales", []))
+            issues_count = result["metadata"].get("total_issues", len(result.get("issues", [])))
+            sales_count = result["metadata"].get("total_sales", len(result.get("sales", [])))
             total_count = issues_count + sales_count
             
             print("\n" + "="*50)
@@ -386,12 +1264,15 @@ def main():
             print(f"- 销售数据: {sales_count} 条")
             print("="*50 + "\n")
         else:
-            print(f"警告: 输出文件 {OUTPUT_FILE} 不存在或为空")
+            print(f"警告: 输出文件 {output_path} 不存在或为空")
         
     except Exception as e:
+        if output_writer:
+            output_writer.abort()
         print(f"处理文本时出错: {e}")
         import traceback
         traceback.print_exc()
+        sys.exit(1)
 
 # 简单测试函数
 def test_api_connection():
@@ -410,8 +1291,14 @@ def test_api_connection():
         return False
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='使用Azure OpenAI把聊天文本提取为结构化JSON')
+    parser.add_argument('--test', action='store_true', help='只测试API连接')
+    parser.add_argument('--resume', action='store_true', help='从检查点恢复，跳过上次已完成的批次')
+    args = parser.parse_args()
+    
     # 如果带--test参数，则运行测试
-    if len(sys.argv) > 1 and sys.argv[1] == "--test":
+    if args.test:
         test_api_connection()
     else:
-        main() 
\ No newline at end of file
+        main(resume=args.resume) 
\ No newline at end of file
@@ -7,6 +7,8 @@ from datetime import datetime
 import sys
 import os
 
+import cycle_deadline
+
 def update_feishu_token(config_path="feishu_config.json"):
     """更新飞书租户访问令牌并保存到配置文件"""
     print(f"开始更新飞书访问令牌 (配置文件: {config_path})...")
@@ -34,7 +36,7 @@ def update_feishu_token(config_path="feishu_config.json"):
         data = {"app_id": app_id, "app_secret": app_secret}
         
         print("正在请求新的访问令牌...")
-        response = requests.post(url, headers=headers, json=data)
+        response = requests.post(url, headers=headers, json=data, timeout=cycle_deadline.request_timeout(10, 30))
         result = response.json()
         
         if response.status_code == 200 and result.get("code") == 0: